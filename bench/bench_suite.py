@@ -0,0 +1,236 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Latency and throughput of `conda launch` and the app server, over the examples/ notebooks and
+    two synthetic ones (many small cells; large outputs):
+
+        python bench/bench_suite.py [--only launch,parse,export,server] [--repeat 5]
+                                    [--requests 200] [--concurrency 1,4,16] [--server URL]
+
+    launch  seconds per `conda launch --mode quiet` run: the first one (cold) and the median of the
+            others (warm: env built, zygote started, templates compiled)
+    parse   seconds to create a NotebookApp: with the parsed notebook cache emptied (cold) and not
+    export  seconds to render an executed notebook, per format
+    server  throughput and p50/p90/p99 latency of app server requests at each concurrency (see
+            ipyapp.loadgen), for the same request (served from the result cache) and for requests
+            with different arguments (executed every time).  An app server is started on a free
+            port unless one is given with --server.
+
+    Each run is appended to a JSON lines history file (bench/history.jsonl) with the commit it ran
+    on, and compared with the previous run there.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from urllib         import urlencode
+except ImportError:
+    from urllib.parse   import urlencode
+
+from ipyapp.config    import TEMPLATE
+from ipyapp.execute   import NotebookApp, notebooks
+from ipyapp.exporters import get_exporter
+from ipyapp.loadgen   import load, fetch
+
+ROOT     = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES = os.path.join(ROOT, 'examples')
+HISTORY  = os.path.join(ROOT, 'bench', 'history.jsonl')
+FORMATS  = ['html', 'md', 'py']
+
+# notebook name -> (app arguments, the argument to vary to get past the result cache)
+NOTEBOOKS = {
+    'adder':        (dict(a='1', b='2', c='3'), 'a'),
+    'strmult':      (dict(s='foo', n='3'), 'n'),
+    'abops':        (dict(a='8', b='15'), 'a'),
+    'many_cells':   (dict(n='1'), 'n'),
+    'large_output': (dict(n='1'), 'n'),
+}
+
+def synthetic_notebook(codes):
+    " notebook JSON running the code strings `codes`, taking an int argument `n` "
+    cells = [dict(cell_type='code', input=code, language='python', outputs=[], collapsed=False, metadata={})
+             for code in ['n = 1'] + codes]
+    cells.append(dict(cell_type='raw', source='{"inputs": {"n": "int"}}', metadata={}))
+    return dict(nbformat=3, nbformat_minor=0, metadata={'name': ''}, worksheets=[dict(cells=cells, metadata={})])
+
+def write_synthetic(directory, cells=200, output_kb=500):
+    " write the synthetic notebooks to `directory` "
+    many  = ['x%s = n + %s' % (i, i) for i in range(cells)]
+    large = ["print('%%s' %% n * %s)" % (output_kb * 1024),
+             "from IPython.display import HTML\n"
+             "HTML('<table>' + '<tr><td>%%s</td><td>row</td></tr>' %% n * %s + '</table>')" % (output_kb * 1024 // 32)]
+    for name, codes in [('many_cells', many), ('large_output', large)]:
+        with open(os.path.join(directory, name + '.ipynb'), 'w') as f:
+            json.dump(synthetic_notebook(codes), f)
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def timed(func, *args, **kwargs):
+    " seconds taken by `func(*args, **kwargs)` "
+    started = time.time()
+    func(*args, **kwargs)
+    return time.time() - started
+
+def bench_launch(path, args, repeat):
+    " cold and warm seconds of `conda launch` runs of the app at `path` "
+    cmd = ['conda', 'launch', '--mode', 'quiet', path] + ['%s=%s' % pair for pair in sorted(args.items())]
+    with open(os.devnull, 'w') as devnull:
+        runs = [timed(subprocess.check_call, cmd, stdout=devnull, stderr=devnull) for _ in range(repeat + 1)]
+    return dict(cold=runs[0], warm=median(runs[1:]))
+
+def bench_parse(path, repeat):
+    " cold and warm seconds to create a NotebookApp for `path` "
+    def cold():
+        notebooks.entries.clear()
+        NotebookApp(path)
+    return dict(cold=median([timed(cold) for _ in range(repeat)]),
+                warm=median([timed(NotebookApp, path) for _ in range(repeat)]))
+
+def bench_export(path, args, repeat):
+    " seconds to export the app at `path`, once it has run, per format "
+    nba = NotebookApp(path, mode='quiet')
+    nba.set_nbargs(**args)
+    (nb, err) = nba.startapp()
+    results = {}
+    for format in FORMATS:
+        exporter = get_exporter(format, TEMPLATE)
+        results[format] = median([timed(exporter.from_notebook_node, nb, resources=dict(nbapp=nba.name))
+                                  for _ in range(repeat)])
+    return results
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def start_server(search, wait=60):
+    " an app server serving the apps in the `search` directories, and its URL, once it answers "
+    port = free_port()
+    code = "from ipyapp.server import serve; serve(port=%d, open_web=False, search=%r)" % (port, search)
+    with open(os.devnull, 'w') as devnull:
+        proc = subprocess.Popen([sys.executable, '-c', code], stdout=devnull, stderr=devnull)
+    url = "http://127.0.0.1:%d" % port
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        try:
+            fetch(url + '/', timeout=5)
+            return proc, url
+        except (IOError, socket.error):
+            time.sleep(0.2)
+    proc.kill()
+    raise RuntimeError('app server did not start on port %d' % port)
+
+def bench_server(url, names, requests, concurrencies):
+    " app server throughput and latency per app, concurrency, and cached or executed requests "
+    results = {}
+    for name in names:
+        args, vary = NOTEBOOKS[name]
+        cached = ["%s/%s?%s" % (url, name, urlencode(sorted(args.items())))]
+        executed = ["%s/%s?%s" % (url, name, urlencode(sorted(dict(args, **{vary: str(i)}).items())))
+                    for i in range(requests)]
+        fetch(cached[0]) # the first run builds the env and fills the result cache
+        for concurrency in concurrencies:
+            for kind, urls in [('cached', cached), ('executed', executed)]:
+                stats = load(urls, requests, concurrency)
+                results['%s c%s %s' % (name, concurrency, kind)] = dict(
+                    (key, stats[key]) for key in ('throughput', 'p50', 'p90', 'p99', 'errors'))
+    return results
+
+def flatten(results, prefix=''):
+    " {'launch.adder.cold': seconds, ...} "
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        elif isinstance(value, (int, float)):
+            flat[prefix + key] = value
+    return flat
+
+def compare(results, previous):
+    " print the results, and how they changed since the `previous` run (if any) "
+    flat, before = flatten(results), flatten(previous['results']) if previous else {}
+    if previous:
+        print("compared with %s (%s)" % (previous['commit'][:10], previous['time']))
+    print("%-50s %12s %12s %8s" % ("measure", "now", "before", "change"))
+    for key in sorted(flat):
+        old = before.get(key)
+        change = "%+7.1f%%" % (100.0 * (flat[key] - old) / old) if old else ""
+        print("%-50s %12.4f %12s %8s" % (key, flat[key], "%.4f" % old if old is not None else "", change))
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def main():
+    p = argparse.ArgumentParser(description="benchmark conda launch and the app server")
+    p.add_argument("--only",        default="launch,parse,export,server", help="benchmarks to run (default: all)")
+    p.add_argument("--notebooks",   default=",".join(sorted(NOTEBOOKS)), help="apps to run (default: all)")
+    p.add_argument("--repeat",      type=int, default=5,   help="runs per measure (default: 5)")
+    p.add_argument("--requests",    type=int, default=200, help="app server requests per load (default: 200)")
+    p.add_argument("--concurrency", default="1,4,16",      help="app server requests in flight (default: 1,4,16)")
+    p.add_argument("--server",      help="URL of a running app server serving the apps (default: start one)")
+    p.add_argument("--history",     default=HISTORY,       help="results history file (default: bench/history.jsonl)")
+    args = p.parse_args()
+
+    only  = args.only.split(',')
+    names = args.notebooks.split(',')
+    synthetic = tempfile.mkdtemp(prefix='conda-launch-bench-')
+    try:
+        write_synthetic(synthetic)
+        paths = dict((name, os.path.join(synthetic if name in ('many_cells', 'large_output') else EXAMPLES,
+                                         name + '.ipynb')) for name in names)
+        results = {}
+        if 'launch' in only:
+            results['launch'] = dict((name, bench_launch(paths[name], NOTEBOOKS[name][0], args.repeat))
+                                     for name in names)
+        if 'parse' in only:
+            results['parse'] = dict((name, bench_parse(paths[name], args.repeat)) for name in names)
+        if 'export' in only:
+            results['export'] = dict((name, bench_export(paths[name], NOTEBOOKS[name][0], args.repeat))
+                                     for name in names)
+        if 'server' in only:
+            concurrencies = [int(c) for c in args.concurrency.split(',')]
+            proc, url = (None, args.server) if args.server else start_server([EXAMPLES, synthetic])
+            try:
+                results['server'] = bench_server(url, names, args.requests, concurrencies)
+            finally:
+                if proc is not None:
+                    proc.terminate()
+                    proc.wait()
+    finally:
+        shutil.rmtree(synthetic, ignore_errors=True)
+
+    previous = None
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            lines = [line for line in f if line.strip()]
+        previous = json.loads(lines[-1]) if lines else None
+    record = dict(commit=commit(), time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                  host=platform.node(), results=results)
+    compare(results, previous)
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+    print("results appended to %s" % args.history)
+
+if __name__ == '__main__':
+    main()
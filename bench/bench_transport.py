@@ -0,0 +1,142 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Parent/child notebook transport: the old pipe of JSON text against the temp file transport.
+
+    Runs both over a synthetic notebook, saved with large image outputs from its author's last run,
+    and reports for one run the time taken, the peak memory allocated by parent and child together
+    (python 3) and the bytes actually written to the pipes or files between them:
+
+        python bench/bench_transport.py [--cells 40] [--image-kb 500] [--repeat 5]
+
+    The old transport: the parent `json.dumps` the notebook into the child's STDIN, the child parses
+    it, runs it and `json.dumps` all of it back to STDOUT, and the parent runs the ANSI regex over all
+    of that and parses it again.  The new one (ipyapp.transport): the parent writes the `Payload` (the
+    notebook without saved outputs, serialized once per version of the file, as the app server keeps
+    it) into a file, and the child's `write_reply` sends back only the executed code cells, already
+    cleaned of ANSI codes, to be spliced into the notebook the parent already holds.
+
+    The child is a thread of this process, reading and writing the same pipes and files a `conda
+    launch` child would, so that tracemalloc sees both sides.
+"""
+
+from __future__ import print_function
+
+import argparse
+import base64
+import json
+import os
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError: # python 2
+    tracemalloc = None
+
+from IPython.nbformat.current import reads_json as nb_read_json, to_notebook_json
+
+from ipyapp.transport import (ANSI_ESCAPE, Payload, strip_outputs, write_notebook, read_notebook, write_reply,
+                              read_reply, apply_reply, temp_path, remove)
+
+def synthetic_notebook(cells, image):
+    """ notebook JSON with an input cell, then `cells` markdown and code cell pairs, as saved after a run:
+        every code cell with the `image`
+    """
+    nbcells = [dict(cell_type='code', input='a = 1', language='python', outputs=[], collapsed=False,
+                    metadata={})]
+    for n in range(cells):
+        nbcells.append(dict(cell_type='markdown', source='## Section %s\n' % n + 'Some text. ' * 200))
+        nbcells.append(dict(cell_type='code', input='plot(%s)' % n, language='python', collapsed=False,
+                            metadata={}, prompt_number=n + 1,
+                            outputs=[dict(output_type='display_data', png=image, metadata={})]))
+    return dict(nbformat=3, nbformat_minor=0, metadata={'name': 'bench'},
+                worksheets=[dict(cells=nbcells, metadata={})])
+
+def execute(nb, image):
+    " stand in for the kernel: give every code cell the `image` and a coloured stream output "
+    for ws in nb.worksheets:
+        for cell in ws.cells:
+            if cell.cell_type == 'code':
+                cell.outputs = to_notebook_json([
+                    dict(output_type='stream', stream='stdout', text='\x1b[32mdone\x1b[0m\n'),
+                    dict(output_type='display_data', png=image, metadata={})])
+    return nb
+
+def old_child(stdin, stdout, image, written):
+    " the child's side of the pipe: notebook JSON from `stdin`, all of the executed notebook to `stdout` "
+    nb = execute(nb_read_json(stdin.read().decode('utf-8')), image)
+    stdin.close()
+    data = json.dumps(nb).encode('utf-8')
+    stdout.write(data)
+    stdout.close()
+    written.append(len(data))
+
+def old_transport(nbjson, payload, image):
+    " the pipe of JSON text, parent and child: returns the bytes written to the pipes "
+    (child_in, parent_out), (parent_in, child_out) = os.pipe(), os.pipe()
+    written = []
+    child = threading.Thread(target=old_child, args=(os.fdopen(child_in, 'rb'), os.fdopen(child_out, 'wb'),
+                                                     image, written))
+    child.start()
+    sent = json.dumps(nbjson).encode('utf-8')          # parent: notebook to STDIN
+    with os.fdopen(parent_out, 'wb') as stdin:
+        stdin.write(sent)
+    with os.fdopen(parent_in, 'rb') as stdout:
+        printed = stdout.read().decode('utf-8')        # parent: all of it from STDOUT
+    child.join()
+    nb_read_json(ANSI_ESCAPE.sub('', printed))         # parent
+    return len(sent) + sum(written)
+
+def new_transport(nbjson, payload, image):
+    " the temp file transport, parent and child: returns the bytes written to the files "
+    cells = nbjson['worksheets'][0]['cells']
+    path  = write_notebook(payload.fill(metadata=nbjson['metadata'], input=strip_outputs(cells[0]))) # parent
+    reply = temp_path('.json')
+    try:
+        nb = execute(read_notebook(path), image)       # child
+        write_reply(reply, nb, nb)                     # child: just the code cells
+        apply_reply(nbjson, read_reply(reply))         # parent
+        return os.path.getsize(path) + os.path.getsize(reply)
+    finally:
+        remove(path, reply)
+
+def measure(transport, nbjson, payload, image, repeat):
+    " (best seconds, peak bytes allocated or None, bytes written) of `repeat` runs of `transport` "
+    best = None
+    for _ in range(repeat):
+        started = time.time()
+        written = transport(nbjson, payload, image)
+        elapsed = time.time() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        transport(nbjson, payload, image)
+        peak = tracemalloc.get_traced_memory()[1] - baseline
+        tracemalloc.stop()
+    return best, peak, written
+
+def main():
+    p = argparse.ArgumentParser(description="compare notebook transports between parent and child")
+    p.add_argument("--cells",    type=int, default=40,  help="code cells, each with an image (default: 40)")
+    p.add_argument("--image-kb", type=int, default=500, help="size of each image in KB (default: 500)")
+    p.add_argument("--repeat",   type=int, default=5,   help="runs to take the best time of (default: 5)")
+    args = p.parse_args()
+
+    image   = base64.b64encode(os.urandom(args.image_kb * 1024 * 3 // 4)).decode('ascii')
+    nbjson  = to_notebook_json(synthetic_notebook(args.cells, image))
+    payload = Payload(nbjson, 0) # once per version of the notebook file, not per run
+    mb = lambda n: "%8.1f MB" % (n / 1e6) if n is not None else "     n/a"
+    print("%-10s %10s %12s %14s" % ("transport", "seconds", "peak alloc", "bytes written"))
+    for name, transport in [("pipe", old_transport), ("tempfile", new_transport)]:
+        seconds, peak, written = measure(transport, nbjson, payload, image, args.repeat)
+        print("%-10s %10.3f %12s %14s" % (name, seconds, mb(peak), mb(written)))
+
+if __name__ == '__main__':
+    main()
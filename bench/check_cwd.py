@@ -0,0 +1,137 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Apps from different directories, run at once from threads of one process, each run in their own
+    directory, and the process's working directory stays where it was:
+
+        python bench/check_cwd.py [--apps 8] [--pool] [--aio] [--timeout 120]
+
+    Every app is a copy of the same notebook in a directory of its own, next to a file naming that
+    directory, which the notebook reads by its relative path and returns along with `os.getcwd()`.
+    With --pool the apps run in pooled kernels (as on the app server) instead of `conda launch`
+    children, and with --aio they run as coroutines of the asyncio engine (see ipyapp.aio) instead of
+    threads.
+
+    For CI: exits with status 0 only if every app reported, in time, that it ran in its own directory
+    and the process's directory did not change; otherwise it prints a FAIL line per app to STDERR and
+    exits with status 1.  (Warnings an app prints to STDERR don't fail it, errors do.)
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from ipyapp.execute import NotebookApp
+
+NOTEBOOK = dict(nbformat=3, nbformat_minor=0, metadata={'name': ''}, worksheets=[dict(metadata={}, cells=[
+    dict(cell_type='code', input='n = 0', language='python', outputs=[], collapsed=False, metadata={}),
+    dict(cell_type='code', input="import os\ncwd = os.getcwd()\nmarker = open('marker.txt').read()",
+         language='python', outputs=[], collapsed=False, metadata={}),
+    dict(cell_type='raw', source='{"inputs": {"n": "int"}}', metadata={}),
+])])
+
+def make_apps(root, count):
+    " `count` app directories under `root`, each with the notebook and its marker file "
+    paths = []
+    for n in range(count):
+        directory = os.path.join(root, 'app%s' % n)
+        os.makedirs(directory)
+        with open(os.path.join(directory, 'marker.txt'), 'w') as f:
+            f.write(directory)
+        path = os.path.join(directory, 'cwdcheck.ipynb')
+        with open(path, 'w') as f:
+            json.dump(NOTEBOOK, f)
+        paths.append(path)
+    return paths
+
+def verify(path, result, outcomes):
+    " record whether the app at `path` ran in its own directory (None) or what it saw instead "
+    expected = os.path.realpath(os.path.dirname(path))
+    if os.path.realpath(result['cwd']) != expected or result['marker'] != os.path.dirname(path):
+        outcomes[path] = 'ran in %s, read the marker of %s' % (result['cwd'], result['marker'])
+    else:
+        outcomes[path] = None
+
+def app(path, timeout):
+    " the checking app at `path`, ready to run "
+    nba = NotebookApp(path, output='cwd,marker', timeout=timeout)
+    nba.set_nbargs(n='1')
+    return nba
+
+def check(path, pool, timeout, outcomes):
+    " run the app at `path`, record whether it ran in its own directory "
+    try:
+        (result, err) = app(path, timeout).startapp(pool=pool)
+        verify(path, result, outcomes)
+    except Exception as ex:
+        outcomes[path] = '%s: %s' % (type(ex).__name__, ex)
+
+def check_all_async(paths, pool, timeout, outcomes):
+    " run the apps at `paths` at once as coroutines, in `pool` (KernelPools) if given "
+    import asyncio
+    from ipyapp import aio
+
+    async def check(path):
+        try:
+            (result, err) = await aio.startapp(app(path, timeout), pool)
+            verify(path, result, outcomes)
+        except Exception as ex:
+            outcomes[path] = '%s: %s' % (type(ex).__name__, ex)
+
+    async def check_all():
+        await asyncio.gather(*[check(path) for path in paths])
+
+    asyncio.get_event_loop().run_until_complete(check_all())
+
+def main():
+    p = argparse.ArgumentParser(description="check that concurrent apps each run in their own directory")
+    p.add_argument("--apps", type=int, default=8,        help="apps run at once (default: 8)")
+    p.add_argument("--pool", action="store_true", default=False, help="run in pooled kernels")
+    p.add_argument("--aio",  action="store_true", default=False, help="run as coroutines of the asyncio engine")
+    p.add_argument("--timeout", type=int, default=120, help="seconds an app may take (default: 120)")
+    args = p.parse_args()
+
+    root  = tempfile.mkdtemp(prefix='conda-launch-cwd-')
+    pool  = None
+    if args.pool:
+        from ipyapp.pool import KernelPools
+        pool = KernelPools(size=args.apps)
+    cwd = os.getcwd()
+    try:
+        paths    = make_apps(root, args.apps)
+        outcomes = {} # app path -> None if it ran in its own directory, else what went wrong
+        started  = time.time()
+        if args.aio:
+            check_all_async(paths, pool, args.timeout, outcomes)
+        else:
+            threads = [threading.Thread(target=check, args=(path, pool, args.timeout, outcomes)) for path in paths]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        seconds = time.time() - started
+    finally:
+        if pool is not None:
+            pool.close()
+        shutil.rmtree(root, ignore_errors=True)
+
+    failures = [(path, outcomes.get(path, 'did not report')) for path in paths if outcomes.get(path, True)]
+    if os.getcwd() != cwd:
+        failures.append(('(this process)', 'working directory changed from %s to %s' % (cwd, os.getcwd())))
+    for path, problem in failures:
+        print("FAIL %s: %s" % (path, problem), file=sys.stderr)
+    print("%d apps at once in %.1f sec: %d failed" % (args.apps, seconds, len(failures)))
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,370 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" An asyncio execution engine for the app server, and its ASGI entry point (Python 3.7+):
+
+        uvicorn ipyapp.aio:application --port 5007
+
+    A request spends most of its time waiting on the `conda launch --stream` child that runs the
+    app.  Here that wait is a coroutine awaiting the child's pipes, not a thread blocked in
+    `communicate()`.  The kernels' ZMQ channels stay in the children (runipy drives them there); the
+    parent only awaits the children's exit, and speaks the same protocol as the blocking engine (see
+    ipyapp.transport).  App runs take their execution slots from the server's scheduler and their
+    pooled kernels from the server's kernel pools, which the Flask app and its job API use too, so
+    MAX_RUNNING and POOL_SIZE hold for the whole process.  Runs in pooled kernels are waited for in
+    a thread.
+
+    App runs (`runapp` requests for an app's values or its rendered page) are served by the engine.
+    Everything else, and the app requests `runapp` answers without running the app (views, input
+    forms, streams, binary results, revalidations and bad requests), is handed to the Flask app in a
+    thread, and runs on Python 3 as it does under the werkzeug server: streamed apps hold a thread
+    for as long as they stream, jobs run in the job API's own worker threads.  Parsing, env setup
+    and rendering stay blocking and run in a thread pool too, as short steps around the awaited
+    execution.
+"""
+
+import asyncio
+import io
+import logging
+import os
+import signal
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib         import asynccontextmanager
+from functools          import partial
+from os.path            import basename
+
+from flask               import request, make_response, g
+from werkzeug.exceptions import HTTPException
+
+from ipyapp           import server, metrics
+from ipyapp.execute   import NotebookApp, NotebookAppExecutionError, NotebookAppTimeout, KERNEL_TIMEOUT, launcher
+from ipyapp.results   import is_binary
+from ipyapp.timing    import Timeline
+from ipyapp.transport import write_notebook, read_reply, temp_path, remove
+from ipyapp.config    import ASYNC_THREADS, LOG_LEVEL
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+# threads for the blocking steps of a request, and for the requests handed to the Flask app
+executor = ThreadPoolExecutor(ASYNC_THREADS)
+
+def blocking(func, *args, **kwargs):
+    " await `func(*args, **kwargs)`, run in the executor "
+    return asyncio.get_event_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+
+async def spawn(args, env_dict=None, cwd=None, stdin=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE):
+    """ start `conda launch` with `args` in a child process leading a process group of its own (see
+        `ipyapp.execute.spawn_launcher`)
+    """
+    (cmd, env) = launcher(args, env_dict)
+    return await asyncio.create_subprocess_exec(*cmd, env=env, cwd=cwd, stdin=stdin, stdout=asyncio.subprocess.PIPE,
+                                                stderr=stderr, start_new_session=hasattr(os, 'setsid'))
+
+async def stop(proc):
+    " kill child process `proc` (and its process group) if it is still running, and wait for it "
+    if proc.returncode is None:
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except ProcessLookupError:
+            pass # exited meanwhile
+    await proc.wait()
+
+async def startapp(nba, pools=None):
+    """ `NotebookApp.startapp` as a coroutine: run `nba` in a `conda launch --stream` child, or in a
+        kernel checked out of `pools` (an `ipyapp.pool.KernelPools`) if given; returns (result, stderr text)
+    """
+    with nba.timeline.phase('env'):
+        env_dict = await blocking(nba.resolve_env)
+
+    nba.set_meta()
+
+    if pools is not None:
+        (reply, err) = await pooled(pools, nba, env_dict)
+    else:
+        (reply, err) = await launch(nba, env_dict)
+    return await blocking(nba.finish, reply, err)
+
+async def pooled(pools, nba, env_dict):
+    """ run `nba` in a kernel checked out of `pools` (an `ipyapp.pool.KernelPools`), in a thread; a
+        cancelled request still waits for the run to end, so its execution slot is not handed on early
+    """
+    running = blocking(pools.execute, nba, env_dict)
+    try:
+        return await asyncio.shield(running)
+    except asyncio.CancelledError:
+        await asyncio.wait([running]) # bounded by the app's timeout, see `PooledKernel.execute`
+        raise
+
+async def launch(nba, env_dict):
+    " `NotebookApp.launch` as a coroutine: the child's reply and STDERR text "
+    args = await blocking(nba.launch_args, env_dict) # may start the env's zygote
+
+    payload, reply_path = await blocking(lambda: write_notebook(nba.payload())), temp_path('.json')
+    try:
+        args.extend(["--input", payload, "--reply", reply_path])
+        spawned = time.time()
+        nbproc = await spawn(args, env_dict, cwd=nba.nbdir, stdin=asyncio.subprocess.DEVNULL)
+        try:
+            (out, err) = await asyncio.wait_for(nbproc.communicate(), nba.timeout)
+        except asyncio.TimeoutError:
+            raise NotebookAppTimeout('Notebook App timed out after %s seconds' % nba.timeout)
+        finally: # also when the request is cancelled: the child must not outlive it, nor use its files after
+            await stop(nbproc)
+        err = err.decode('utf-8', 'replace')
+        if not os.path.getsize(reply_path):
+            raise NotebookAppExecutionError('Notebook App exited without a result:\n%s' % err)
+        reply = await blocking(read_reply, reply_path)
+        nba.launched(spawned, reply)
+        return (reply, err)
+    finally:
+        remove(payload, reply_path)
+
+class AsyncSlots(object):
+    """ the server's `ipyapp.scheduler.Scheduler` for coroutines, so app runs of both engines draw from
+        the same execution slots: a slot is waited for in a thread of its own (at most a lane's worth
+        of requests can be waiting at once)
+    """
+
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.waiters   = ThreadPoolExecutor(scheduler.queue_size['interactive'] + 1)
+
+    def _late(self, app, acquiring):
+        " release the slot a cancelled request got after all "
+        if not acquiring.cancelled() and acquiring.exception() is None:
+            self.scheduler.release(app)
+
+    @asynccontextmanager
+    async def slot(self, app, cap=None):
+        " hold an execution slot for `app` (at most `cap` at a time, if given) for the `async with` block "
+        acquiring = asyncio.get_event_loop().run_in_executor(self.waiters, self.scheduler.acquire, app, cap)
+        try:
+            await asyncio.shield(acquiring)
+        except asyncio.CancelledError:
+            acquiring.add_done_callback(partial(self._late, app))
+            raise
+        try:
+            yield
+        finally:
+            self.scheduler.release(app)
+
+class Engine(object):
+    """ runs NotebookApps as coroutines, from the server's result cache, execution slots and kernel
+        pools: the ones the Flask app (and its job API) use too
+    """
+
+    def __init__(self):
+        self.slots = AsyncSlots(server.scheduler)
+        self.pools = server.pools
+
+    async def execute(self, nba):
+        """ `ipyapp.server.execute` as a coroutine: returns the (result, err) of running `nba` and how the
+            result cache was used ('hit', 'miss' or None); raises SchedulerBusy if the server is too busy
+        """
+        cacheable = server.results is not None and nba.cacheable
+        if cacheable:
+            result = server.results.get(nba)
+            if result is not None:
+                log.info("notebook app [%s] served from result cache" % nba.name)
+                metrics.cache_hits.inc(app=nba.name)
+                return (result, 'hit')
+
+        waiting = time.time()
+        async with self.slots.slot(nba.name, nba.concurrency):
+            nba.timeline.add('queue', waiting, time.time() - waiting)
+            metrics.executions.inc(app=nba.name)
+            result = await startapp(nba, self.pools)
+        if KERNEL_TIMEOUT in result[1]:
+            metrics.timeouts.inc(app=nba.name)
+
+        if cacheable and not nba.failed:
+            await blocking(server.results.put, nba, result)
+            return (result, 'miss')
+        return (result, None)
+
+engine = None # created in the server's event loop, by the first request
+
+def environ(scope, body):
+    " the WSGI environ of the ASGI HTTP request `scope` with request body `body` "
+    (host, port) = scope.get('server') or ('localhost', 80)
+    env = {
+        'REQUEST_METHOD':    scope['method'],
+        'SCRIPT_NAME':       scope.get('root_path', ''),
+        'PATH_INFO':         scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING':      scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME':       str(host),
+        'SERVER_PORT':       str(port),
+        'SERVER_PROTOCOL':   'HTTP/%s' % scope.get('http_version', '1.1'),
+        'REMOTE_ADDR':       scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH':    str(len(body)),
+        'wsgi.version':      (1, 0),
+        'wsgi.url_scheme':   scope.get('scheme', 'http'),
+        'wsgi.input':        io.BytesIO(body),
+        'wsgi.errors':       sys.stderr,
+        'wsgi.multithread':  True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once':     False,
+    }
+    for name, value in scope.get('headers', ()):
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            env[name] = value
+        elif name != 'CONTENT_LENGTH':
+            key = 'HTTP_' + name
+            env[key] = env[key] + ',' + value if key in env else value
+    return env
+
+def route(scope):
+    " the Flask endpoint and view arguments for the request `scope`, or (None, {}) "
+    urls = server.app.url_map.bind('localhost', script_name=scope.get('root_path') or None)
+    try:
+        return urls.match(scope['path'], scope['method'])
+    except HTTPException:
+        return (None, {})
+
+def prepare(env, nbname, timeline):
+    """ the part of `server.runapp` before the app runs, for WSGI `env`: returns (nba, options, etag),
+        or None for the requests `runapp` answers without running the app (and for bad requests,
+        which it answers with the right error)
+    """
+    with server.app.request_context(env):
+        try:
+            with timeline.phase('fetch'):
+                nbpath = server.fetch_nb(nbname)
+            (options, nbargs_dict) = server.request_options()
+            if options['view'] or options['stream'] or 'text/event-stream' in request.headers.get('Accept', ''):
+                return None
+            with timeline.phase('parse'):
+                nba = NotebookApp(nbpath, template=server.SERVER_TEMPLATE, timeline=timeline, **options)
+            if (len(nba.inputs) > 0 and len(nba.inputs) > len(nbargs_dict) and request.method == "GET"
+                and not options['output']): # the input form
+                return None
+            nba.set_nbargs(**nbargs_dict)
+            if nba.output and is_binary(nba.format): # sent as a file
+                return None
+            etag = server.run_etag(nba, options)
+            if etag and request.if_none_match.contains_weak(etag): # 304
+                return None
+            return (nba, options, etag)
+        except Exception:
+            return None
+
+def answer(env, started, nba, options, etag, outcome):
+    """ the rest of `server.runapp`, for WSGI `env`: render `outcome`, the ((result, err), cache use)
+        of running `nba` or the exception it raised; returns (status, headers, body)
+    """
+    with server.app.request_context(env):
+        g.started  = started
+        g.app      = basename(nba.nbpath).replace('.ipynb', '')
+        g.timeline = nba.timeline
+        err = ""
+        try:
+            if isinstance(outcome, Exception):
+                raise outcome
+            ((result, err), g.cache) = outcome
+            with nba.timeline.phase('render'):
+                if nba.output:
+                    response = server.output_result(result, nba.format)
+                else:
+                    response = make_response(server.render_result(result, options['format'], nba.name,
+                                                                  options['inline']))
+            response = server.validated(response, etag)
+        except Exception as ex:
+            response = make_response(server.run_failure(ex, nba.nbpath, nba, err))
+        response = server.app.process_response(response) # compression, metrics, access log
+        return (response.status_code, response.headers.to_wsgi_list(), response.get_data())
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def respond(send, status, headers, body, more=False):
+    await send(dict(type='http.response.start', status=status,
+                    headers=[(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]))
+    await send(dict(type='http.response.body', body=body, more_body=more))
+
+async def delegate(env, send):
+    """ answer the request with the Flask app, in the executor: chunk by chunk, so streamed responses
+        stream (each holds an executor thread while it does)
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started.update(status=int(status.split(' ', 1)[0]), headers=headers)
+
+    body = await blocking(server.app, env, start_response)
+    try:
+        chunks = iter(body)
+        first  = await blocking(next, chunks, None)
+        await respond(send, started['status'], started['headers'], first or b'', more=first is not None)
+        while first is not None:
+            chunk = await blocking(next, chunks, None)
+            await send(dict(type='http.response.body', body=chunk or b'', more_body=chunk is not None))
+            first = chunk
+    finally:
+        if hasattr(body, 'close'):
+            await blocking(body.close)
+
+async def http(scope, receive, send):
+    global engine
+    body = await read_body(receive)
+    (endpoint, args) = route(scope)
+    if endpoint == 'runapp':
+        started  = time.time()
+        prepared = await blocking(prepare, environ(scope, body), args['nbname'], Timeline())
+        if prepared is not None:
+            (nba, options, etag) = prepared
+            if engine is None:
+                engine = Engine()
+            try:
+                outcome = await engine.execute(nba)
+            except Exception as ex:
+                outcome = ex
+            (status, headers, content) = await blocking(answer, environ(scope, body), started, nba, options,
+                                                        etag, outcome)
+            return await respond(send, status, headers, content)
+    await delegate(environ(scope, body), send)
+
+def startup():
+    " what `AppServerDaemon.run` does before serving "
+    server.apps.watch()
+    server.warm()
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await blocking(startup)
+            except Exception as ex:
+                await send(dict(type='lifespan.startup.failed', message=str(ex)))
+                return
+            await send(dict(type='lifespan.startup.complete'))
+        elif message['type'] == 'lifespan.shutdown':
+            if server.pools is not None:
+                await blocking(server.pools.close)
+            await send(dict(type='lifespan.shutdown.complete'))
+            return
+
+async def application(scope, receive, send):
+    " the app server as an ASGI 3 application "
+    if scope['type'] == 'http':
+        await http(scope, receive, send)
+    elif scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    else:
+        raise ValueError('unsupported ASGI scope type: %s' % scope['type'])
@@ -0,0 +1,205 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+import contextlib
+import errno
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+try:
+    import fcntl
+except ImportError: # Windows: file locks only hold within a process
+    fcntl = None
+
+from ipyapp.config import CACHE_SIZE, CACHE_BYTES, CACHE_TTL, NOTEBOOK_CACHE, LOG_LEVEL
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+def file_stamp(path):
+    " cheap change detection for a file: (mtime, size), or None if it is gone "
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+@contextlib.contextmanager
+def file_lock(path):
+    " hold an exclusive lock on the file `path`, created if need be, across processes "
+    if fcntl is None:
+        yield
+        return
+    try:
+        os.makedirs(os.path.dirname(path))
+    except OSError:
+        pass # exists already
+    with open(path, 'a') as fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+
+def save_json(path, value):
+    " write `value` as JSON to `path` atomically, so other processes never read a partial file "
+    tmp = "%s.%s.%s" % (path, os.getpid(), threading.current_thread().ident)
+    with open(tmp, 'w') as fh:
+        json.dump(value, fh, separators=(',', ':'))
+    os.rename(tmp, path)
+
+def alive(pid):
+    " is process `pid` still running? "
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno == errno.EPERM
+    return True
+
+def json_size(value):
+    " rough size in bytes of parsed JSON `value`: the length of its strings, a few bytes per other item "
+    if isinstance(value, dict):
+        return sum(len(key) + json_size(item) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return sum(json_size(item) for item in value)
+    if isinstance(value, string_types):
+        return len(value)
+    return 8
+
+def nb_view(nbjson):
+    """ cheap copy-on-write view of parsed notebook JSON: the containers a NotebookApp modifies (the
+        notebook dict, its metadata, the worksheets and their cell lists) are copied, the cells themselves
+        are shared and must be replaced rather than changed in place
+    """
+    view = dict(nbjson)
+    view['metadata']   = dict(nbjson.get('metadata', {}))
+    view['worksheets'] = [dict(ws, cells=list(ws.get('cells', []))) for ws in nbjson.get('worksheets', [])]
+    return view
+
+class CachedNotebook(object):
+    " a parsed notebook file and its extracted `conda.app` metadata "
+
+    def __init__(self, nbjson, meta, nbhash, stamp):
+        self.json    = nbjson
+        self.meta    = meta
+        self.nbhash  = nbhash
+        self.stamp   = stamp
+        self.payload = None # its `ipyapp.transport.Payload`, built on first launch
+
+class NotebookCache(object):
+    """ Parsed notebooks and their app metadata, shared by all NotebookApp instances in the process and
+        re-validated against the file's mtime and size on every lookup, so the JSON parser only runs when
+        a notebook is first seen or has changed.
+    """
+
+    def __init__(self, find_meta, size=NOTEBOOK_CACHE):
+        self.find_meta = find_meta     # extracts the app metadata dict from notebook JSON
+        self.size      = size
+        self.entries   = OrderedDict() # nbpath -> CachedNotebook, least recently used first
+        self.lock      = threading.Lock()
+
+    def load(self, nbpath):
+        " return the CachedNotebook for `nbpath`, parsing the file only if it is new or changed "
+        nbpath = os.path.abspath(nbpath)
+        stamp  = file_stamp(nbpath)
+        with self.lock:
+            entry = self.entries.pop(nbpath, None)
+            if entry is not None and entry.stamp == stamp:
+                self.entries[nbpath] = entry
+                return entry
+
+        log.debug('parsing notebook [%s]' % nbpath)
+        nbtxt  = open(nbpath, 'rb').read()
+        nbjson = json.loads(nbtxt)
+        entry  = CachedNotebook(nbjson, self.find_meta(nbjson), hashlib.sha1(nbtxt).hexdigest(), stamp)
+        with self.lock:
+            self.entries[nbpath] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return entry
+
+class ResultCache(object):
+    """ LRU cache of executed notebook app results, i.e. the (notebook, err) pair returned by
+        `NotebookApp.startapp`.  Results are keyed on the notebook content, its normalized arguments,
+        the env it runs in and the requested output, bounded by entry count, total size and age, and
+        dropped as soon as the notebook file changes on disk.
+    """
+
+    def __init__(self, size=CACHE_SIZE, max_bytes=CACHE_BYTES, ttl=CACHE_TTL):
+        self.size      = size
+        self.max_bytes = max_bytes
+        self.ttl       = ttl
+        self.entries   = OrderedDict() # key -> (nbpath, expires, nbytes, result), oldest first
+        self.stamps    = {}            # nbpath -> file_stamp when its results were cached
+        self.nbytes    = 0
+        self.hits      = 0
+        self.misses    = 0
+        self.lock      = threading.Lock()
+
+    @staticmethod
+    def key(nba):
+        args = json.dumps([sorted(nba.nbargs.items()), nba.env, nba.output, nba.profile_cells])
+        return hashlib.sha1((nba.nbhash + args).encode('utf-8')).hexdigest()
+
+    def _drop(self, key):
+        nbpath, expires, nbytes, result = self.entries.pop(key)
+        self.nbytes -= nbytes
+
+    def _check_file(self, nbpath):
+        stamp = file_stamp(nbpath)
+        if self.stamps.get(nbpath, stamp) != stamp:
+            log.info('notebook [%s] changed on disk, invalidating cached results' % nbpath)
+            self.invalidate(nbpath)
+        self.stamps[nbpath] = stamp
+
+    def invalidate(self, nbpath=None):
+        " drop all cached results for `nbpath`, or everything "
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if nbpath is None or entry[0] == nbpath:
+                    self._drop(key)
+
+    def get(self, nba):
+        " return the cached (notebook, err) for NotebookApp `nba`, or None "
+        key = self.key(nba)
+        self._check_file(nba.nbpath)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+            self.entries[key] = self.entries.pop(key) # most recently used goes to the end
+            self.hits += 1
+            return entry[3]
+
+    def put(self, nba, result):
+        nbytes = json_size(result)
+        if nbytes > self.max_bytes:
+            return
+        key = self.key(nba)
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (nba.nbpath, time.time() + self.ttl, nbytes, result)
+            self.nbytes += nbytes
+            while len(self.entries) > self.size or self.nbytes > self.max_bytes:
+                self._drop(next(iter(self.entries)))
+
+    def __len__(self):
+        return len(self.entries)
@@ -11,12 +11,16 @@ from __future__ import print_function
 import argparse
 import json
 import logging
+import os
 import re
+import shutil
 import sys
+import time
 import webbrowser
 
+STARTED = time.time() # before the heavy imports below, for --profile
+
 from argparse   import RawDescriptionHelpFormatter
-from functools  import partial
 from os.path    import abspath
 
 # TODO: use six instead? added dependency...
@@ -27,16 +31,17 @@ except ImportError:
     from urllib.parse   import urlencode
     from urllib.request import pathname2url
 
-from jinja2     import Environment, PackageLoader
-
-from IPython.nbformat.current             import reads_json as nb_read_json
-from IPython.nbconvert.exporters.html     import HTMLExporter
-from IPython.nbconvert.exporters.markdown import MarkdownExporter
-from IPython.nbconvert.exporters.python   import PythonExporter
+from IPython.nbformat.current             import to_notebook_json
 
 
 from ipyapp.config  import MODE, FORMAT, TIMEOUT, TEMPLATE, LOG_LEVEL
 from ipyapp.execute import NotebookApp, NotebookAppExecutionError, run
+from ipyapp.exporters import get_exporter, export_stream
+from ipyapp.results import is_binary, remove_files
+from ipyapp.transport import read_notebook, write_reply
+from ipyapp.timing import Timeline, print_table, write_trace
+
+IMPORTED = time.time()
 
 logging.basicConfig(level=LOG_LEVEL)
 log = logging.getLogger(__name__)
@@ -68,6 +73,65 @@ def launch_parser():
         default=False,
         help="run notebook app from JSON on STDIN, return results on STDOUT",
     )
+    p.add_argument(
+        "--input",
+        metavar="FILE",
+        help="with --stream, read the notebook JSON from FILE instead of STDIN",
+    )
+    p.add_argument(
+        "--reply",
+        metavar="FILE",
+        help="with --stream, write only the executed cells to FILE instead of the notebook to STDOUT",
+    )
+    p.add_argument(
+        "--cwd",
+        metavar="DIR",
+        help="with --stream, run the notebook's kernel in DIR (default: the current directory)",
+    )
+    p.add_argument(
+        "--cells",
+        action="store_true",
+        default=False,
+        help="with --stream, write each cell as a line of JSON as soon as it has run",
+    )
+    p.add_argument(
+        "--worker",
+        action="store_true",
+        default=False,
+        help="run as a pooled kernel for the app server: a JSON request line with the paths of the notebook and "
+             "reply temp files on STDIN, a JSON header line with the run's STDERR on STDOUT",
+    )
+    p.add_argument(
+        "--zygote",
+        metavar="SOCKET",
+        help="run as a kernel zygote on the Unix socket SOCKET: import the --preload modules, fork kernels on request",
+    )
+    p.add_argument(
+        "--fork-from",
+        metavar="SOCKET",
+        help="with --stream or --worker, fork the kernel from the zygote on SOCKET instead of starting one",
+    )
+    p.add_argument(
+        "--preload",
+        default="",
+        help="comma separated modules for the kernel zygote to import",
+    )
+    p.add_argument(
+        "--sweep",
+        metavar="FILE",
+        help="run the app once per argument set in FILE (.csv, .jsonl, or .json grid spec), in parallel",
+    )
+    p.add_argument(
+        "--grid",
+        action="store_true",
+        default=False,
+        help="run the app for every combination of comma separated argument values, in parallel",
+    )
+    p.add_argument(
+        "-j", "--jobs",
+        type=int,
+        help="number of kernels for --sweep and --grid (default: one per core)",
+    )
     p.add_argument(
         "-e", "--env",
         help="conda environment to use (by name or path)",
@@ -80,7 +144,7 @@ def launch_parser():
     p.add_argument(
         "-f", "--format",
         default=FORMAT,
-        help="result format: [html|md|py|pdf] (default: %(default)s) [TODO]",
+        help="result format: [html|md|py|pdf], or with --output: [npy|arrow|parquet] (default: %(default)s)",
     )
     p.add_argument(
         "-c", "--channel",
@@ -89,7 +153,7 @@ def launch_parser():
     )
     p.add_argument(
         "-o", "--output",
-        help="specify a single variable to return from processed notebook [TODO]",
+        help="return only these comma separated variables and #tagged cell outputs, as JSON",
     )
     p.add_argument(
         "--override",
@@ -107,6 +171,23 @@ def launch_parser():
         default=TEMPLATE,
         help="specify an alternative output template file",
     )
+    p.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="print where the time went, phase by phase and cell by cell, to STDERR",
+    )
+    p.add_argument(
+        "--profile-cells",
+        action="store_true",
+        default=False,
+        help="profile each code cell in the kernel: time, CPU, peak memory and top functions, shown under the cell",
+    )
+    p.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="write where the time went to FILE as Chrome trace events (chrome://tracing, Perfetto)",
+    )
     p.add_argument(
         "notebook",
         nargs='?',
@@ -126,6 +207,9 @@ def launch_parser():
 def launchcmd():
 
     err = "" # initialize error string returned by invoking notebook app (used in exception messages)
+    args = None
+    timeline = Timeline()
+    timeline.add('import', STARTED, IMPORTED - STARTED)
 
     try:
         args = launch_parser().parse_args()
@@ -140,58 +224,106 @@ def launchcmd():
         elif args.stream: # just execute the STDIN stream as JSON in the current python environment, return result on STDOUT
 
             log.debug('notebook app stream processing')
-            nbtxt = sys.stdin.read()
-            nbjson = run(nbtxt, args.output, args.view)
-            print(json.dumps(nbjson))
+            if args.input: # the parent passes the notebook in a file, and wants a reply file back
+                nb = read_notebook(args.input)
+            else:
+                nb = sys.stdin.read()
+            runner   = None
+            timeline = Timeline()
+            if args.fork_from:
+                from ipyapp.zygote import zygote_runner
+                with timeline.phase('boot'):
+                    runner = zygote_runner(args.fork_from, modules(args.preload), working_dir=args.cwd)
+            if args.cells:
+                run(nb, args.output, args.view, runner=runner, on_cell=print_cell, cwd=args.cwd)
+            else:
+                nbjson = run(nb, args.output, args.view, runner=runner, format=args.format, timeline=timeline,
+                             cwd=args.cwd)
+                if args.reply:
+                    write_reply(args.reply, nbjson, nb, timeline)
+                else:
+                    print(json.dumps(nbjson, separators=(',', ':')))
             return 0
 
+        elif args.worker: # serve notebooks from STDIN in a warm kernel until STDIN is closed
+
+            log.debug('notebook app pooled kernel worker')
+            from ipyapp.pool import serve_worker
+            return serve_worker(zygote=args.fork_from, preload=modules(args.preload))
+
+        elif args.zygote: # preload modules, then fork kernels on request
+
+            log.debug('notebook app kernel zygote')
+            from ipyapp.zygote import serve_zygote
+            return serve_zygote(args.zygote, modules(args.preload))
+
+        elif args.sweep or args.grid: # run the app over many argument sets on a pool of warm kernels
+
+            log.debug('notebook app parameter sweep')
+            from ipyapp.sweep import Sweep, read_argsets, grid_args
+            nba = NotebookApp(args.notebook, timeout=args.timeout, env=args.env, override=args.override)
+            argsets = read_argsets(args.sweep) if args.sweep else []
+            if args.grid:
+                argsets = [dict(argset, **nbargs) for argset in (argsets or [{}]) for nbargs in grid_args(args.nbargs)]
+            sweep = Sweep(nba, argsets, workers=args.jobs, format=args.format, template=args.template)
+            index = sweep.run()
+            failed = [entry for entry in index['runs'] if entry['status'] != 'done']
+            print("{runs} runs, {failed} failed, {seconds:.1f} sec: {index}".format(
+                runs=len(index['runs']), failed=len(failed), seconds=index['seconds'],
+                index=os.path.join(sweep.outdir, 'index.json')))
+            return 3 if failed else 0
+
         elif args.view: # get a view of the current content, don't re-invoke
 
             log.debug('notebook app view only')
             nba = NotebookApp(args.notebook)
-            nbtxt = run(json.dumps(nba.json), view=args.view)
+            nb = to_notebook_json(nba.json)
 
         else: # regular notebook app processing
 
             log.debug('notebook app regular execution')
             nbargs_dict = dict(pair.split('=',1) for pair in args.nbargs) # convert args from list to dict
-            nba = NotebookApp(args.notebook, timeout=args.timeout,
-                              mode=args.mode, format=args.format, output=args.output, env=args.env,
-                              override=args.override)
-            nba.set_nbargs(**nbargs_dict)
-            (nbtxt, err) = nba.startapp()
+            with timeline.phase('parse'):
+                nba = NotebookApp(args.notebook, timeout=args.timeout,
+                                  mode=args.mode, format=args.format, output=args.output, env=args.env,
+                                  override=args.override, timeline=timeline, profile_cells=args.profile_cells)
+            with timeline.phase('nbargs'):
+                nba.set_nbargs(**nbargs_dict)
+
+            if nba.mode == "stream" and not nba.output: # print each cell as soon as it has run
+                for chunk in export_stream(nba.iterapp(), args.format, args.template, nba.name):
+                    sys.stdout.write(chunk)
+                    sys.stdout.flush()
+                return 0
+
+            (nb, err) = nba.startapp()
 
             log.debug('finished regular execution')
 
+            if nba.output: # just the requested values as JSON, no export (a failed run raised)
+                with timeline.phase('render'):
+                    if is_binary(nba.format):
+                        save_files(nba, nb)
+                    else:
+                        print(json.dumps(nb, separators=(',', ':')))
+                return 0
+
 
-        jinja_env = Environment(loader=PackageLoader('ipyapp', 'templates'))
-        template = jinja_env.get_template('status.html')
-
-        format = args.format.lower()
-        if format=='html':
-            Exporter = partial(HTMLExporter,
-                               extra_loaders=[jinja_env.loader],
-                               template_file="output.html")
-        elif format=='md' or format=='markdown':
-            Exporter = MarkdownExporter
-        elif format=='py' or format=='python':
-            Exporter = PythonExporter
-        exporter = Exporter()
-
-        log.debug('create notebook object (JSON) from JSON text string')
-        nb_obj = nb_read_json(nbtxt)
-        log.debug('convert notebook to HTML via exporter')
-        result, resources = exporter.from_notebook_node(nb_obj, resources=dict(nbapp=nba.name))
-
-        if nba.mode == "open":
-            output_fn = "{name}-output.html".format(name=nba.name)
-            open(output_fn, 'w').write(result)
-            webbrowser.open('file://' + pathname2url(abspath(output_fn)))
-        elif nba.mode == "stream":
-            print(result)
-        elif nba.mode == "quiet":
-            # do nothing
-            pass
+        with timeline.phase('render'):
+            exporter = get_exporter(args.format, args.template)
+
+            log.debug('convert notebook to HTML via exporter')
+            result, resources = exporter.from_notebook_node(nb, resources=dict(nbapp=nba.name))
+
+            if nba.mode == "open":
+                output_fn = "{name}-output.html".format(name=nba.name)
+                open(output_fn, 'w').write(result)
+                webbrowser.open('file://' + pathname2url(abspath(output_fn)))
+            elif nba.mode == "stream":
+                print(result)
+            elif nba.mode == "quiet":
+                # do nothing
+                pass
 
     except IOError as ex:
         sys.stderr.write('ERROR: Notebook App [%s] could not be opened\n' % args.notebook)
@@ -213,6 +345,46 @@ def launchcmd():
         sys.stderr.write(format_exception(ex) + "\n")
 
         return 4
+    finally:
+        if args is not None and (args.profile or args.trace):
+            profile(timeline, time.time() - STARTED, args.trace)
+
+def profile(timeline, total, trace=None):
+    " report where the `total` seconds of this run went: a table on STDERR, and the `trace` file if given "
+    print_table(timeline, total)
+    if trace:
+        write_trace(timeline, trace)
+        sys.stderr.write("trace written to %s\n" % trace)
+
+def save_files(nba, files):
+    """ a binary result: in "stream" mode, write the single variable to STDOUT, otherwise move each
+        variable's file to <app>-<variable>.<ext> and print where they went, as JSON
+    """
+    try:
+        if nba.mode == "stream":
+            if len(files) != 1:
+                raise TypeError('Binary output to STDOUT holds one variable, not %s' % len(files))
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+            with open(list(files.values())[0]['path'], 'rb') as f:
+                shutil.copyfileobj(f, out)
+            out.flush()
+        else:
+            saved = {}
+            for var, info in files.items():
+                saved[var] = "{name}-{var}{ext}".format(name=nba.name, var=var, ext=os.path.splitext(info['path'])[1])
+                shutil.move(info['path'], saved[var])
+            print(json.dumps(saved))
+    finally:
+        remove_files(files)
+
+def modules(preload):
+    " module names from a --preload argument "
+    return [name.strip() for name in preload.split(',') if name.strip()]
+
+def print_cell(cell):
+    " write a cell to STDOUT as one line of JSON, straight away "
+    sys.stdout.write(json.dumps(cell) + "\n")
+    sys.stdout.flush()
 
 def help(nba):
     print("usage: conda launch {file} ".format(file=nba.nbfile), end='')
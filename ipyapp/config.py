@@ -20,13 +20,81 @@ TEMPLATE    = "output.html"
 # server
 HOST    = "127.0.0.1"
 PREFIX  = ""            # URL path prefix
-SEARCH  = ""            # Location of apps
+SEARCH  = ["."]         # directories searched for apps (and one directory down)
+SCAN_INTERVAL = 5       # seconds between app directory rescans when inotify is not available
 PORT    = 5007
 
+# kernel pool (server)
+POOL_SIZE    = 2      # pre-started kernels per conda env (0 disables the pool)
+POOL_RECYCLE = 50     # executions before a pooled kernel is replaced with a fresh one
+POOL_WAIT    = 60     # seconds to wait for a pooled kernel to boot or become free
+
+# zygote kernels
+ZYGOTE      = True    # app server: start per-env processes that have imported the app's libraries, to fork kernels from
+ZYGOTE_CLI  = False   # `conda launch` too, though a zygote it starts outlives it (by ZYGOTE_IDLE seconds)
+ZYGOTE_IDLE = 10 * 60 # seconds an unused zygote waits for requests before exiting
+
+# parsed notebook cache
+NOTEBOOK_CACHE = 512              # parsed notebooks (and their app metadata) kept in memory
+
+# result cache (server)
+CACHE_SIZE   = 256                # executed notebooks kept (0 disables the cache)
+CACHE_BYTES  = 256 * 1024 * 1024  # total size of cached notebook JSON
+CACHE_TTL    = 15 * 60            # seconds a cached result stays valid
+
+# admission control (server)
+MAX_RUNNING       = 8    # notebook app executions at once, over all apps
+QUEUE_INTERACTIVE = 32   # browser requests allowed to wait for an execution slot
+QUEUE_BATCH       = 128  # background jobs allowed to wait for an execution slot
+QUEUE_WAIT        = 30   # seconds a browser request waits for a slot before giving up
+RETRY_AFTER       = 5    # seconds, suggested to clients turned away with 503
+
+# jobs (server)
+JOB_WORKERS   = 4        # notebook apps run concurrently by the job API
+JOB_QUEUE     = 100      # jobs allowed to wait for a worker
+JOB_RETENTION = 60 * 60  # seconds a finished job's result is kept
+JOB_MAX       = 1000     # finished jobs kept, at most
+
+# content store (server)
+STORE         = True               # serve images and large HTML outputs by URL instead of inline
+STORE_MIN     = 2 * 1024           # bytes: rich outputs smaller than this stay inline
+STORE_MAX_AGE = 365 * 24 * 60 * 60 # seconds browsers may keep a stored output (they never change)
+STORE_TTL     = 30 * 24 * 60 * 60  # seconds a stored output is kept after it was last rendered
+
+# HTTP (server)
+COMPRESS_MIN   = 1024               # bytes: smaller responses are sent uncompressed
+COMPRESS_LEVEL = 6                  # gzip level (brotli quality)
+STATIC_MAX_AGE = 365 * 24 * 60 * 60 # seconds browsers may keep fingerprinted static files
+
+# metrics (server)
+METRICS         = True # serve /metrics
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120] # seconds
+
+# pre-fork workers (server)
+WORKERS          = 0                  # worker processes (0: a single process, the werkzeug server)
+WORKER_THREADS   = 8                  # requests served at once by each worker
+WORKER_REQUESTS  = 1000               # requests after which a worker is replaced (0: never)
+WORKER_MEMORY    = 1024 * 1024 * 1024 # bytes of memory after which a worker is replaced (0: never)
+GRACEFUL_TIMEOUT = 30                 # seconds a stopping worker gets to finish its requests
+
+# asyncio engine (server, see ipyapp.aio)
+# (app runs take their slots from the admission control above, MAX_RUNNING at once)
+ASYNC_THREADS = 32   # threads for the blocking parts of a request: parsing, env setup, rendering, delegated requests
+
 # process
 PIDFILE = os.path.expanduser("~/.appserver_pid")
 LOGFILE = os.path.expanduser("~/.appserver_log")
 ERRFILE = os.path.expanduser("~/.appserver_err")
+ACCESS_LOG = None # a file to log each app request to, with its arguments (`conda appserver --log`); None: off
+ACCESS_LOG_SIZE = 64 * 1024 * 1024 # beyond this many bytes the access log moves to <file>.1, 0: never
+
+# caches
+CACHE_DIR      = os.path.expanduser("~/.conda-launch")
+TEMPLATE_CACHE = os.path.join(CACHE_DIR, "templates")   # compiled Jinja templates (bytecode)
+ENV_STATE      = os.path.join(CACHE_DIR, "envs.json")   # package specs each app env was built from
+ZYGOTE_DIR     = os.path.join(CACHE_DIR, "zygotes")     # sockets of the kernel zygotes
+STORE_DIR      = os.path.join(CACHE_DIR, "store")       # externalized outputs, named by their content hash
+SHARED_DIR     = os.path.join(CACHE_DIR, "workers")     # jobs and metrics of pre-forked workers, by server port
 
 def key_generator(size=20, chars=string.ascii_letters + string.digits):
     return ''.join(random.choice(chars) for _ in range(size))
@@ -0,0 +1,154 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Conda environment state for notebook apps.
+
+    Each env conda-launch creates is recorded with a hash of the package specs it was built from.  A
+    launch whose env is recorded with the same hash, and still exists on disk, costs a dictionary
+    lookup and one stat instead of a `conda create` invocation.  Envs are rebuilt when the app's
+    `pkgs` (or conda-launch's own FIXED_DEPS) change.  The app's `channels` are recorded but not
+    hashed: `conda_api.create` does not take them, so an env never depends on them.
+
+    An env that exists but was not built by conda-launch (e.g. named by the app's `env` meta data) is
+    never rebuilt.  It is used if the packages linked into it satisfy the app's specs; if not, a
+    warning names the missing ones, and it is checked again on the next launch.
+
+    An env is (re)built under a lock file next to the state file, so processes sharing the state
+    (`conda launch` runs, app server workers) never build the same env at once.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from ipyapp.cache  import file_stamp, file_lock
+from ipyapp.config import FIXED_DEPS, ENV_STATE, LOG_LEVEL
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+def spec_hash(pkgs):
+    " identifies the package specs an env is built from, independent of their order "
+    return hashlib.sha1(json.dumps(sorted(pkgs)).encode('utf-8')).hexdigest()
+
+def satisfies(versions, version):
+    " does one of the `versions` of a package match the `version` of a spec (`1.9`, `1.9*`, `1.9.1`)? "
+    if not version or any(op in version for op in '<>!,|'): # ranges: the package being there will do
+        return bool(versions)
+    version = version.rstrip('*').rstrip('.')
+    return any(v == version or v.startswith(version + '.') for v in versions)
+
+def missing(prefix, specs):
+    " the package `specs` (`name`, `name=version`, `name 1.9*`, `name>=1.8`) not met by the env at `prefix` "
+    import conda_api
+
+    linked = {}
+    for dist in conda_api.linked(prefix):
+        (name, version, build) = conda_api.split_canonical_name(dist)
+        linked.setdefault(name.lower(), []).append(version)
+    unmet = []
+    for spec in specs:
+        (name, version) = re.match(r'\s*([^\s=<>!]+)[\s=]*(\S*)', spec).groups()
+        if not satisfies(linked.get(name.lower(), ()), version):
+            unmet.append(spec)
+    return unmet
+
+class EnvState(object):
+    " app env records, kept in a JSON file shared by `conda launch` and the app server "
+
+    def __init__(self, path=ENV_STATE):
+        self.path   = path
+        self.envs   = {}    # env name -> dict(hash (None: not known to match), prefix, pkgs, channels, owned, created)
+        self.stamp  = None  # file_stamp of `path` when `envs` was read
+        self.lock   = threading.Lock()
+        self.locks  = {}    # env name -> lock held while that env is being (re)built
+        self._default_prefix = None
+
+    def _reload(self):
+        " re-read the state file if another process changed it "
+        stamp = file_stamp(self.path)
+        if stamp != self.stamp:
+            try:
+                self.envs = json.load(open(self.path))
+            except (IOError, ValueError):
+                self.envs = {}
+            self.stamp = stamp
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            tmp = "%s.%s" % (self.path, os.getpid())
+            with open(tmp, 'w') as fh:
+                json.dump(self.envs, fh, indent=1)
+            os.rename(tmp, self.path) # atomic, so other processes never read a partial file
+            self.stamp = file_stamp(self.path)
+        except (IOError, OSError) as ex:
+            log.warn('could not record conda env state in %s: %s' % (self.path, ex))
+
+    def valid(self, name, digest):
+        " True if env `name` was built from specs with hash `digest` and still exists "
+        with self.lock:
+            self._reload()
+            record = self.envs.get(name)
+        return (record is not None and record['hash'] == digest and
+                os.path.isdir(os.path.join(record['prefix'], 'conda-meta')))
+
+    def ensure(self, name, pkgs=(), channels=()):
+        " make sure env `name` exists and matches the app's package specs, (re)building it only if not "
+        import conda_api # only used when conda_api is available, see ipyapp.execute
+
+        specs  = FIXED_DEPS + list(pkgs)
+        digest = spec_hash(specs)
+        if self.valid(name, digest):
+            return
+
+        with self.lock:
+            env_lock = self.locks.setdefault(name, threading.Lock())
+
+        with env_lock, file_lock("%s.%s.lock" % (self.path, name)):
+            if self.valid(name, digest): # built by another thread or process while we waited
+                return
+
+            record = self.envs.get(name)
+            if record and record.get('owned'): # we built it from different specs: rebuild
+                log.info('Conda environment [%s] is out of date, rebuilding' % name)
+                conda_api.remove_environment(name=name)
+
+            owned = True
+            try:
+                conda_api.create(name=name, pkgs=specs)
+            except (conda_api.CondaEnvExistsError) as ex:
+                owned = False # not one of ours (e.g. named by the app's `env` meta data): never rebuild it
+
+            prefix = (conda_api.get_prefix_envname(name) or
+                      os.path.join(conda_api.ROOT_PREFIX, 'envs', name))
+            unmet = [] if owned else missing(prefix, specs)
+            if unmet:
+                log.warn('Conda environment [%s] exists but lacks %s: running the app in it anyway, '
+                         'install them there or remove the env to have it rebuilt' % (name, ", ".join(unmet)))
+            elif not owned:
+                log.info('Conda environment [%s] exists and has the packages of the app, not recreating' % name)
+            with self.lock:
+                self._reload()
+                self.envs[name] = dict(hash=None if unmet else digest, prefix=prefix, pkgs=specs,
+                                       channels=list(channels), owned=owned, created=time.time())
+                self._save()
+
+    def default_prefix(self):
+        " prefix of the current conda env, looked up once per process "
+        import conda_api
+
+        if self._default_prefix is None:
+            self._default_prefix = conda_api.info()['default_prefix']
+        return self._default_prefix
+
+envs = EnvState()
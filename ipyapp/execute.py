@@ -6,21 +6,36 @@
 # conda is distributed under the terms of the BSD 3-clause license.
 # Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
 
-import contextlib
+import copy
 import json
 import logging
 import os
 import re
+import signal
 import sys
+import threading
+import time
 
 from subprocess import PIPE, Popen
-from Queue      import Empty
+from tempfile   import TemporaryFile
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
 
 from IPython.nbformat.current             import reads_json as nb_read_json, new_text_cell, new_notebook, new_worksheet
+from IPython.nbformat.current             import to_notebook_json, new_code_cell, NotebookNode
 from runipy.notebook_runner               import NotebookRunner, NotebookError
 
 from ipyapp.slugify import slugify
-from ipyapp.config import MODE, FORMAT, TIMEOUT, FIXED_DEPS, LOG_LEVEL
+from ipyapp.cache   import NotebookCache, nb_view
+from ipyapp.envs    import envs
+from ipyapp.results import parse_output, compact, is_binary
+from ipyapp.profiling import profiles
+from ipyapp.transport import ANSI_ESCAPE, Payload, strip_outputs, write_notebook, read_reply, apply_reply, failed, temp_path, remove
+from ipyapp.timing import Timeline
+from ipyapp.config import MODE, FORMAT, TIMEOUT, LOG_LEVEL
 
 logging.basicConfig(level=LOG_LEVEL)
 log = logging.getLogger(__name__)
@@ -41,6 +56,10 @@ class NotebookAppExecutionError(NotebookAppError):
     " Notebook App error during execution "
     pass
 
+class NotebookAppTimeout(NotebookAppExecutionError):
+    " Notebook App took longer than its timeout "
+    pass
+
 class NotebookAppFormatError(NotebookAppError):
     " Notebook Apps need to be JSON and contain app meta-data"
     pass
@@ -52,7 +71,7 @@ class NotebookApp(object):
         contain a reference to an IPython Notebook object.
     """
     def __init__(self, nbpath, nbargs_txt=None, timeout=None, mode=None, format=None, output=None, env=None,
-                 template=None, override=False, **kwargs):
+                 template=None, override=False, timeline=None, profile_cells=False, **kwargs):
         """ Representation of a particular instance of a Notebook App.  Can override the App-specific env (if any)
 
             :param nbpath:      path to notebook app file
@@ -63,19 +82,27 @@ class NotebookApp(object):
             :param output:      specify a particular artifact to return from executed app #TODO
             :param env:         environment to use for notebook app invocation
             :param override:    use these params (or defaults) in preference to app params, where possible
+            :param timeline:    record where the time goes in this `ipyapp.timing.Timeline`
+            :param profile_cells: profile each code cell in the kernel (see `ipyapp.profiling`)
         """
         # NOTE: override is fragile. It relies on the defaults here matching the defaults from cli and server.
 
-        self.nbdir      = os.path.dirname(nbpath)
+        self.nbpath     = os.path.abspath(nbpath)
+        self.nbdir      = os.path.dirname(self.nbpath)
         self.nbfile     = os.path.basename(nbpath)
         self.name       = self.nbfile.replace(".ipynb",'')
+        self.timeline   = timeline or Timeline()
 
-        self.json       = json.load(open(nbpath))
-        self.fetch_meta() # converts meta data in NB JSON into metadata dictionary on object
+        cached          = notebooks.load(nbpath) # parsed once per version of the notebook file
+        self.cached     = cached
+        self.nbhash     = cached.nbhash          # identifies this version of the notebook
+        self.json       = nb_view(cached.json)
+        self.meta       = copy.deepcopy(cached.meta)
         self.desc       = self.meta.get('desc', self.name)
         self.inputs     = self.meta.get('inputs', {})
         self.pkgs       = self.meta.get('pkgs', [])
         self.template   = template
+        self.profile_cells = bool(profile_cells)
 
         # EXECUTION params
         # TODO: remove the set_nbargs from init: leads to too many problems elsewhere. Do this in a subsequent step
@@ -127,6 +154,10 @@ class NotebookApp(object):
 
         self.pkgs       = self.meta.get('pkgs', [])
         self.channels   = self.meta.get('channels', [])
+        self.cacheable  = self.meta.get('cache', True) # apps with side effects or random output opt out
+        self.concurrency = self.meta.get('concurrency') # most executions of this app to run at once (server)
+        self.preload    = self.meta.get('preload')       # modules for the kernel zygote to import (default: pkgs)
+        self.failed     = False # the last run replied with an error report (see `finish`)
 
 
     def set_nbargs(self, **nbargs_txt):
@@ -144,9 +175,11 @@ class NotebookApp(object):
              "prompt_number":   3
         }
 
+        self.nbargs = {}
         for var, type in self.inputs.items(): # iterate over all specified inputs
             try:
                 value = nbargs_txt[var]
+                self.nbargs[var] = value
                 if type == 'para':
                     type = 'str'
 
@@ -156,30 +189,29 @@ class NotebookApp(object):
 
         log.debug('notebook app arguments cell:\n%s' % "".join(input_cell['input']))
 
+        self.json['worksheets'][0]['cells'][self.input_index] = input_cell
+
+    @property
+    def input_index(self):
+        " index of the cell that takes the app arguments: the first code cell "
         for input_cell_idx, cell in enumerate(self.json['worksheets'][0]['cells']):
             if cell['cell_type'] == 'code':
-                # replace the first code cell with the input_cell
-                break
-        else:
-            input_cell_idx = 0
+                return input_cell_idx
+        return 0
 
-        self.json['worksheets'][0]['cells'][input_cell_idx] = input_cell
+    def payload(self):
+        """ the notebook JSON to run, as bytes: without the outputs saved in the file, which are replaced
+            when the cells run anyway, and with the current meta data and input cell spliced in
+        """
+        if self.cached.payload is None: # once per version of the notebook file
+            self.cached.payload = Payload(self.cached.json, self.input_index)
+        cells = self.json['worksheets'][0]['cells'] if self.json['worksheets'] else []
+        return self.cached.payload.fill(metadata=self.json['metadata'],
+                                        input=strip_outputs(cells[self.input_index]) if cells else None)
 
     def fetch_meta(self):
         " find app meta data from notebook JSON "
-        self.meta = {'inputs': {}}
-        if 'conda.app' in self.json['metadata']:
-            self.meta = self.json['metadata']['conda.app']
-        else:
-            # otherwise, look from the last cell backwards for the first "raw" cell,
-            # and try to use its source as JSON meta
-            for cell in reversed(self.json['worksheets'][0]['cells']):
-                if cell['cell_type'] == 'raw':
-                    try:
-                        self.meta = json.loads("".join(cell['source']))
-                    except ValueError:
-                        pass # just use the default
-                    break
+        self.meta = find_meta(self.json)
 
     def set_meta(self):
         " set conda.app JSON metadata from current NotebookApp object "
@@ -194,82 +226,277 @@ class NotebookApp(object):
                     env=self.env,
                     channels=self.channels,
                     pkgs=self.pkgs,
+                    profile_cells=self.profile_cells,
                     )
         self.json['metadata']['conda.app'] = meta
 
-    def startapp(self):
-        "invoke the notebook app in a separate process with the appropriate environment"
-        with cd(self.nbdir): # all execution now happens in the same directory as the notebook
-
-            cmd  = "conda"
-            args = "launch --stream --mode {mode}".format(mode=self.mode).split()
-
-            if self.output:
-                args.extend("--output {output}".format(output=self.output).split())
-
-            if CONDA_API_AVAILABLE: # create a conda env if appropriate and invoke the app in a conda env
-                if self.env: # if there is a named env, try to create it and use it
-                    try:
-                        conda_api.create(name=self.env, pkgs=FIXED_DEPS+self.pkgs)
-                    except (conda_api.CondaEnvExistsError) as ex:
-                        log.info('Conda environment [{env}] exists, not recreating for app [{app}]'
-                                 .format(app=self.name, env=self.env))
-                    env_dict=dict(name=self.env)
-                else: # use the path to the current env
-                    env_dict=dict(path=conda_api.info()['default_prefix'])
+    def resolve_env(self):
+        """ create the conda env for this app if appropriate and return the `conda_api.process` keyword
+            arguments that select it, or None if conda_api is not available
+        """
+        if not CONDA_API_AVAILABLE:
+            return None
+
+        if self.env: # if there is a named env, make sure it is built from the app's pkgs and use it
+            envs.ensure(self.env, self.pkgs, self.channels)
+            return dict(name=self.env)
+        else: # use the path to the current env
+            return dict(path=envs.default_prefix())
+
+    def fork_args(self, env_dict):
+        """ `conda launch` arguments that have the app's kernel forked from the zygote for its env, which
+            is started if need be and allowed (see ipyapp.zygote); none if no zygote is available
+        """
+        from ipyapp.zygote import zygotes, preload_modules
+
+        preload = self.preload if self.preload is not None else preload_modules(self.pkgs)
+        zygote  = zygotes.get(env_dict, preload)
+        if not zygote:
+            return []
+        return ['--fork-from', zygote, '--preload', ",".join(preload)]
+
+    def startapp(self, pool=None):
+        """ invoke the notebook app in a separate process with the appropriate environment, or in a
+            pre-started kernel checked out of `pool` (a `ipyapp.pool.KernelPools`) if one is given;
+            returns (executed notebook, stderr text), or (values, stderr text) if the app has an `output`
+        """
+        # the app runs in the notebook's directory: the kernel is told so (`--cwd`), this process's working
+        # directory is never changed, so apps from different directories can run at once in threads
 
-                nbproc = conda_api.process(cmd=cmd, args=args, timeout=self.timeout,
-                                           stdin=PIPE, stdout=PIPE, stderr=PIPE,
-                                           **env_dict)
-            else: # just use Popen to run the process
-                nbproc = Popen(cmd=cmd, args=args, timeout=self.timeout,
-                                stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        with self.timeline.phase('env'):
+            env_dict = self.resolve_env()
 
-            self.set_meta() # write the current Notebook App meta-data to the JSON so it is available to the
-                            # independent process that will run the notebook app
-            (nbstream, err) = nbproc.communicate(input=json.dumps(self.json))
+        self.set_meta() # write the current Notebook App meta-data to the JSON so it is available to the
+                        # independent process that will run the notebook app
 
-            # remove ANSI codes from output stream
-            ansi_escape = re.compile(r'\x1b[^m]*m')
-            nbstream    = ansi_escape.sub('', nbstream)
-            err         = ansi_escape.sub('', err)
+        if pool is not None:
+            (reply, err) = pool.execute(self, env_dict)
+        else:
+            (reply, err) = self.launch(env_dict)
+        return self.finish(reply, err)
 
-            err2exception(err)
+    def finish(self, reply, err):
+        """ the result of a run, from the child's reply (see `ipyapp.transport`) and STDERR text `err`,
+            which may hold warnings of a run that went fine: the reply tells whether it failed
+        """
+        self.timeline.extend(reply.get('timeline'), process='kernel') # boot and execution, timed by the child
+
+        # remove ANSI codes from the error stream (the child cleans up the outputs)
+        err = ANSI_ESCAPE.sub('', err)
+
+        err2exception(err)
+
+        log.debug('notebook app execution error stream:  %s' % err)
+
+        self.failed = failed(reply)
+        if self.failed and self.output: # there are no values, just the error report
+            raise NotebookAppExecutionError(err or 'no output from notebook app')
+        with self.timeline.phase('read'):
+            return (apply_reply(self.json, reply), err)
+
+    def launch_args(self, env_dict):
+        " `conda launch` arguments of the child that runs the app (but for its --input and --reply files) "
+        args = "launch --stream --mode {mode}".format(mode=self.mode).split() + ["--cwd", self.nbdir]
+
+        if self.output:
+            args.extend(["--output", self.output, "--format", self.format])
+        args.extend(self.fork_args(env_dict))
+        return args
+
+    def launched(self, spawned, reply):
+        " record the time from starting the child (at `spawned`) to it starting the kernel, from its reply "
+        started = [phase[1] for phase in reply.get('timeline', ()) if phase[0] in ('boot', 'execute')]
+        if started:
+            self.timeline.add('spawn', spawned, min(started) - spawned)
+
+    def launch(self, env_dict):
+        " run the app in a `conda launch --stream` child, return its reply (see `ipyapp.transport`) and STDERR "
+        args = self.launch_args(env_dict)
+
+        payload, reply_path = write_notebook(self.payload()), temp_path('.json')
+        try:
+            args.extend(["--input", payload, "--reply", reply_path])
+            spawned = time.time()
+            nbproc = spawn_launcher(args, env_dict, stdin=None, cwd=self.nbdir)
+            deadline = Deadline(nbproc, self.timeout)
+            try:
+                (out, err) = nbproc.communicate()
+            finally:
+                deadline.cancel()
+            err = text(err)
+            if deadline.expired:
+                raise NotebookAppTimeout('Notebook App timed out after %s seconds' % self.timeout)
+            if not os.path.getsize(reply_path):
+                raise NotebookAppExecutionError('Notebook App exited without a result:\n%s' % ANSI_ESCAPE.sub('', err))
+            reply = read_reply(reply_path)
+            self.launched(spawned, reply)
+            return (reply, err)
+        finally:
+            remove(payload, reply_path)
+
+    def iterapp(self):
+        """ like `startapp`, but yield each cell of the executed notebook as soon as it has run, wrapped in
+            a single-cell notebook (ready for an exporter)
+        """
+        env_dict = self.resolve_env()
+        self.set_meta()
+
+        args = "launch --stream --cells --mode {mode}".format(mode=self.mode).split() + ["--cwd", self.nbdir]
+        args.extend(self.fork_args(env_dict))
+        errfile  = TemporaryFile() # not a pipe: a chatty child must not block while we read its cells
+        nbproc   = spawn_launcher(args, env_dict, stderr=errfile, cwd=self.nbdir)
+        deadline = Deadline(nbproc, self.timeout)
+        try:
+            nbproc.stdin.write(self.payload())
+            nbproc.stdin.close()
+
+            metadata = self.json['metadata']
+            for line in iter(nbproc.stdout.readline, b''):
+                cell = json.loads(text(line))
+                yield to_notebook_json(dict(metadata=metadata, nbformat=3, nbformat_minor=0,
+                                            worksheets=[dict(cells=[cell], metadata={})]))
+            nbproc.wait()
+        finally: # also when the client goes away mid-stream and the generator is closed
+            deadline.cancel()
+            stop(nbproc)
+        if deadline.expired:
+            raise NotebookAppTimeout('Notebook App timed out after %s seconds' % self.timeout)
+
+        errfile.seek(0)
+        err = ANSI_ESCAPE.sub('', text(errfile.read()))
+        log.debug('notebook app execution error stream:  %s' % err)
+        err2exception(err)
+
+def find_meta(nbjson):
+    " find app meta data from notebook JSON "
+    meta = {'inputs': {}}
+    if 'conda.app' in nbjson['metadata']:
+        meta = nbjson['metadata']['conda.app']
+    else:
+        # otherwise, look from the last cell backwards for the first "raw" cell,
+        # and try to use its source as JSON meta
+        for cell in reversed(nbjson['worksheets'][0]['cells']):
+            if cell['cell_type'] == 'raw':
+                try:
+                    meta = json.loads("".join(cell['source']))
+                except ValueError:
+                    pass # just use the default
+                break
+    return meta
 
-            # TODO: should probably reorganize so invocation updates this NotebookApp object with the executed notebook
+# parsed notebooks and their app meta data, shared by all NotebookApp instances
+notebooks = NotebookCache(find_meta)
 
-            log.debug('notebook app execution output stream: %s' % nbstream)
-            log.debug('notebook app execution error stream:  %s' % err)
+def launcher(args, env_dict=None):
+    """ the command line and environment that start `conda launch` with `args` inside the conda env
+        selected by `env_dict` (see `NotebookApp.resolve_env`), as `conda_api.process` does
+    """
+    cmd = ["conda"] + list(args)
+    if env_dict is None:
+        return (cmd, None)
+
+    prefix = env_dict.get('path') or env_dict.get('prefix')
+    if not prefix:
+        prefix = (conda_api.get_prefix_envname(env_dict['name']) or
+                  os.path.join(conda_api.ROOT_PREFIX, 'envs', env_dict['name']))
+    env = dict(os.environ)
+    bindir = os.path.join(prefix, 'Scripts' if sys.platform == 'win32' else 'bin')
+    env['PATH'] = os.pathsep.join([prefix, bindir, env.get('PATH', '')])
+    return (cmd, env)
+
+def spawn_launcher(args, env_dict=None, stdin=PIPE, stdout=PIPE, stderr=PIPE, cwd=None):
+    """ start `conda launch` with `args` in a child process, inside the conda env selected by `env_dict`
+        (see `NotebookApp.resolve_env`), in directory `cwd` if given.  On POSIX the child leads a process
+        group of its own, which `kill` ends as a whole: `conda` runs `conda-launch` in another process
+    """
+    (cmd, env) = launcher(args, env_dict)
+    return Popen(cmd, env=env, cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr,
+                 preexec_fn=getattr(os, 'setsid', None))
 
-            return (nbstream, err)
+def text(data):
+    " `data` read from a child's pipe or file as text (it is bytes on Python 3) "
+    return data.decode('utf-8', 'replace') if not isinstance(data, str) else data
 
-def run(nbtxt, output=None, view=False):
+def kill(proc):
+    " kill child process `proc` of `spawn_launcher`, and the processes it started "
+    try:
+        if hasattr(os, 'killpg'):
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except OSError:
+        pass # exited meanwhile
+
+def stop(proc):
+    " kill child process `proc` (and its process group) if it is still running, and wait for it "
+    if proc.poll() is None:
+        kill(proc)
+    proc.wait()
+
+class Deadline(object):
+    " kills child process `proc` if it still runs `timeout` seconds from now (None: no limit) "
+
+    def __init__(self, proc, timeout):
+        self.proc    = proc
+        self.expired = False
+        self.timer   = threading.Timer(timeout, self._expire) if timeout else None
+        if self.timer is not None:
+            self.timer.daemon = True
+            self.timer.start()
+
+    def _expire(self):
+        if self.proc.poll() is None:
+            self.expired = True
+            kill(self.proc) # the thread waiting on it reaps it
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.cancel()
+
+def run(nbtxt, output=None, view=False, runner=None, on_cell=None, format=None, timeline=None, cwd=None):
     """ Run a notebook app 100% from JSON (text stream), return the JSON (text stream)
 
-        :param nbtxt: JSON representation of notebook app, ready to run
-        :param view:   don't invoke notebook, just view in current form
+        :param nbtxt:   JSON representation of notebook app, ready to run (or the parsed NotebookNode)
+        :param output:  return only these variables and tagged cell outputs (see `ipyapp.results`)
+        :param view:    don't invoke notebook, just view in current form
+        :param runner:  re-use this `NotebookRunner` (and its kernel) instead of starting a new one
+        :param on_cell: called with every cell, in order, as soon as it has been run
+        :param format:  with `output`, a binary format to write the variables in (see `ipyapp.results`)
+        :param timeline: record kernel boot and execution times in this `ipyapp.timing.Timeline`
+        :param cwd:     working directory of the kernel started for the notebook (not with `runner`)
+
+        Code cells are profiled if the app meta data asks for it (see `ipyapp.profiling`).
 
         NOTE: `view` probably isn't useful, since the input will just be output again
     """
 
-    # TODO: support output parameter to specify only returning certain attributes from notebook
     # create a notebook object from the JSON
-    nb_obj    = nb_read_json(nbtxt)
-    nb_runner = NotebookRunner(nb_obj)
+    nb_obj    = nbtxt if isinstance(nbtxt, NotebookNode) else nb_read_json(nbtxt)
+    timeline  = timeline or Timeline()
+    if runner is None:
+        with timeline.phase('boot'):
+            nb_runner = NotebookRunner(nb_obj, working_dir=cwd)
+    else:
+        nb_runner    = runner
+        nb_runner.nb = nb_obj
     try: # get the app name from metadata
         name  = nb_obj['metadata']['conda.app']['name']
     except KeyError as ex:
         name  = "nbapp"
+    profile   = nb_obj['metadata'].get('conda.app', {}).get('profile_cells', False)
 
     try:
         if view:
             pass # then don't run it
         else:
-            nb_runner.run_notebook(skip_exceptions=False)
+            with timeline.phase('execute'):
+                run_cells(nb_runner, on_cell or (lambda cell: None), timeline, profile) # as `run_notebook`, timed per cell
+                if output:
+                    return collect_output(nb_runner, output, format, profile)
         return nb_runner.nb
 
     except Empty as ex:
-        sys.stderr.write("IPython Kernel timeout")
+        sys.stderr.write(KERNEL_TIMEOUT)
         err = mini_markdown_nb("""
 Notebook Error
 ==============
@@ -278,7 +505,7 @@ ERROR: IPython Kernel timeout
 {error}
 ```
 """.format(error=str(ex).split(':')[-1]))
-        return err
+        return emit_cells(err, on_cell)
     except (NotImplementedError, NotebookError, ValueError) as ex:
         msg = str(ex).splitlines()[-1]
         sys.stderr.write(msg)
@@ -290,12 +517,98 @@ Notebook contains unsupported feature or bad argument:
 {error}
 ```
 """.format(error=msg))
-        return err
+        return emit_cells(err, on_cell)
     except ImportError:
         msg = "nodejs or pandoc must be installed"
         sys.stderr.write(msg)
         err = mini_markdown_nb(msg)
-        return err
+        return emit_cells(err, on_cell)
+
+# run in the kernel after the notebook, print the requested variables as JSON, or where they were written
+OUTPUT_CELL = """from ipyapp.results import dumps as __dumps
+print(__dumps({names!r}, globals()))
+del __dumps
+"""
+OUTPUT_FILES_CELL = """from ipyapp.results import dump_files as __dump_files
+print(__dump_files({names!r}, globals(), {format!r}))
+del __dump_files
+"""
+# run in the kernel around each code cell of a profiled app
+PROFILE_START_CELL = """from ipyapp import profiling as __profiling
+__profiling.start()
+del __profiling
+"""
+PROFILE_STOP_CELL = """from ipyapp import profiling as __profiling
+print(__profiling.stop())
+del __profiling
+"""
+
+def kernel_json(nb_runner, code):
+    " run `code` in the runner's kernel, return what it printed to STDOUT, parsed as JSON "
+    cell = new_code_cell(input=code)
+    nb_runner.run_cell(cell)
+    return json.loads("".join(out.get('text', '') for out in cell.outputs
+                              if out.output_type == 'stream' and out.get('stream') == 'stdout'))
+
+def collect_output(nb_runner, output, format=None, profile=False):
+    """ the variables and tagged cell outputs named by the `output` spec from the runner's executed
+        notebook and kernel, as a dict; variables are written to files if `format` is a binary one.
+        With `profile`, the cell profiles are returned as "@profile" (JSON only).
+    """
+    names, tags = parse_output(output)
+    result = {}
+    if is_binary(format):
+        if tags:
+            raise ValueError('Tagged cell outputs can not be returned in binary format %s' % format)
+        code = OUTPUT_FILES_CELL.format(names=names, format=format.lower())
+    else:
+        code = OUTPUT_CELL.format(names=names)
+    if names:
+        result.update(kernel_json(nb_runner, code))
+        missing = [name for name in names if name not in result]
+        if missing:
+            raise NotebookError('Output variables not defined by the notebook app: %s' % ", ".join(missing))
+
+    for tag in tags:
+        result['#' + tag] = [compact(out) for ws in nb_runner.nb.worksheets for cell in ws.cells
+                             if cell.cell_type == 'code' and tag in cell.metadata.get('tags', [])
+                             for out in cell.outputs]
+    if profile and not is_binary(format):
+        result['@profile'] = profiles(nb_runner.nb)
+    return result
+
+def run_cells(nb_runner, on_cell, timeline=None, profile=False):
+    """ run the code cells of the runner's notebook like `NotebookRunner.run_notebook`, passing every cell
+        (code or not) to `on_cell` in notebook order as soon as it is done, and recording how long each
+        one took in `timeline` if given.  With `profile`, each code cell is profiled in the kernel and
+        gets the profile as its `profile` metadata.
+    """
+    for ws in nb_runner.nb.worksheets:
+        for index, cell in enumerate(ws.cells):
+            if cell.cell_type == 'code':
+                if profile:
+                    nb_runner.run_cell(new_code_cell(input=PROFILE_START_CELL))
+                start = time.time()
+                try:
+                    nb_runner.run_cell(cell)
+                finally: # a failed cell goes out with its traceback before the error is handled
+                    if profile:
+                        cell.metadata['profile'] = kernel_json(nb_runner, PROFILE_STOP_CELL)
+                    if timeline is not None:
+                        timeline.add('cell', start, time.time() - start, index=index)
+                    on_cell(cell)
+            else:
+                on_cell(cell)
+
+def emit_cells(nb, on_cell=None):
+    " pass all cells of `nb` to `on_cell` (if any), return `nb` "
+    if on_cell:
+        for ws in nb.worksheets:
+            for cell in ws.cells:
+                on_cell(cell)
+    return nb
+
+KERNEL_TIMEOUT = "IPython Kernel timeout" # on STDERR, when a cell runs longer than the kernel waits
 
 def err2exception(err):
     if 'ValueError' in err:
@@ -322,15 +635,3 @@ def mini_markdown_nb(markdown):
     nb['worksheets'].append(wks)
     nb['worksheets'][0]['cells'].append(cell)
     return nb
-
-@contextlib.contextmanager
-def cd(path):
-    """A context manager which changes the working directory to the given
-    path, and then changes it back to its previous value on exit.
-    """
-    prev_cwd = os.getcwd()
-    if path:
-        os.chdir(path)
-    yield
-    os.chdir(prev_cwd)
-
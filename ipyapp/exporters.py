@@ -0,0 +1,123 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Process-wide registry of nbconvert exporters and ipyapp Jinja templates.
+
+    Exporters are built once per (format, template) and shared, instead of reloading and recompiling
+    the nbconvert and ipyapp templates on every request.  Compiled templates are also kept in an
+    on-disk Jinja bytecode cache so a cold `conda launch` skips template compilation as well.
+"""
+
+import logging
+import os
+import threading
+
+from jinja2 import Environment, PackageLoader, FileSystemBytecodeCache
+
+from IPython.nbformat.current             import new_notebook, new_worksheet
+from IPython.nbconvert.exporters.html     import HTMLExporter
+from IPython.nbconvert.exporters.markdown import MarkdownExporter
+from IPython.nbconvert.exporters.python   import PythonExporter
+
+from ipyapp.config import TEMPLATE, TEMPLATE_CACHE, LOG_LEVEL
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+def _bytecode_cache(directory):
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return FileSystemBytecodeCache(directory)
+    except OSError as ex:
+        log.warn('template bytecode cache disabled, cannot use %s: %s' % (directory, ex))
+        return None
+
+bytecode_cache = _bytecode_cache(TEMPLATE_CACHE)
+loader         = PackageLoader('ipyapp', 'templates')
+jinja_env      = Environment(loader=loader, bytecode_cache=bytecode_cache)
+
+def _cached(Exporter):
+    " an Exporter subclass whose template environment shares the bytecode cache "
+    class CachedExporter(Exporter):
+        def _init_environment(self, extra_loaders=None):
+            super(CachedExporter, self)._init_environment(extra_loaders=extra_loaders)
+            self.environment.bytecode_cache = bytecode_cache
+
+    CachedExporter.__name__ = Exporter.__name__
+    return CachedExporter
+
+FORMATS = {
+    'html':     _cached(HTMLExporter),
+    'md':       _cached(MarkdownExporter),
+    'markdown': _cached(MarkdownExporter),
+    'py':       _cached(PythonExporter),
+    'python':   _cached(PythonExporter),
+}
+
+_exporters = {}
+_lock      = threading.Lock()
+
+def get_exporter(format='html', template=TEMPLATE):
+    " shared exporter for `format`; HTML is rendered through the ipyapp `template` "
+    format = format.lower()
+    if format not in FORMATS:
+        raise TypeError('Unsupported result format "%s", use one of: %s' % (format, ", ".join(sorted(FORMATS))))
+
+    key = (format, template if format == 'html' else None)
+    with _lock:
+        if key not in _exporters:
+            log.debug('creating %s exporter (template: %s)' % key)
+            if format == 'html':
+                _exporters[key] = FORMATS[format](extra_loaders=[loader], template_file=template)
+            else:
+                _exporters[key] = FORMATS[format]()
+        return _exporters[key]
+
+CELL_TEMPLATE = "cell.html"       # a single cell's outputs, no page around them
+STREAM_MARKER = "<!-- cells -->"  # where the cells go in a page template
+
+def export_stream(cell_nbs, format='html', template=TEMPLATE, name='nbapp', on_error=None, resources=None):
+    """ export single-cell notebooks as they arrive (see `NotebookApp.iterapp`), yielding text chunks;
+        HTML comes wrapped in the page from `template`, split where its cells would go.  If `on_error`
+        is given, an exception while running the cells is rendered by it instead of raised.  Extra
+        `resources` are passed on to the templates.
+    """
+    resources = dict(resources or {}, nbapp=name)
+    if format.lower() != 'html':
+        exporter = get_exporter(format)
+        for cell_nb in cell_nbs:
+            yield exporter.from_notebook_node(cell_nb, resources=dict(resources))[0]
+        return
+
+    nb = new_notebook()
+    nb['worksheets'].append(new_worksheet())
+    page, _  = get_exporter('html', template).from_notebook_node(nb, resources=dict(resources))
+    head, tail = page.split(STREAM_MARKER, 1)
+
+    yield head
+    exporter = get_exporter('html', CELL_TEMPLATE)
+    try:
+        for cell_nb in cell_nbs:
+            yield exporter.from_notebook_node(cell_nb, resources=dict(resources))[0]
+    except Exception as ex:
+        if on_error is None:
+            raise
+        yield on_error(ex)
+    yield tail
+
+def get_template(name):
+    " ipyapp Jinja template by name "
+    return jinja_env.get_template(name)
+
+def warm(templates=(TEMPLATE, CELL_TEMPLATE), formats=('md', 'py')):
+    " build exporters and compile their templates up front, by rendering an empty notebook "
+    nb = new_notebook()
+    nb['worksheets'].append(new_worksheet())
+    exporters = [get_exporter('html', template) for template in templates]
+    exporters.extend(get_exporter(format) for format in formats)
+    for exporter in exporters:
+        exporter.from_notebook_node(nb, resources=dict(nbapp='warm'))
@@ -0,0 +1,78 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" HTTP helpers for the app server: content encoding negotiation and file fingerprints.
+
+    Rendered notebooks compress very well, so responses are sent with brotli (if the `brotli` package
+    is installed and the client accepts it) or gzip.  Static files get URLs carrying a fingerprint of
+    their content, so they can be cached for good and still change when the file does.
+"""
+
+import gzip
+import hashlib
+import io
+import os
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from ipyapp.config import COMPRESS_LEVEL
+
+COMPRESSIBLE = ('text/', 'application/json', 'application/javascript', 'image/svg+xml')
+
+def compressible(mimetype):
+    return bool(mimetype) and mimetype.startswith(COMPRESSIBLE)
+
+def accepted(header, coding):
+    " does Accept-Encoding `header` allow `coding` (a `q=0` refuses it)? "
+    for item in (header or '').split(','):
+        parts = [part.strip() for part in item.split(';')]
+        if parts[0] in (coding, '*'):
+            for param in parts[1:]:
+                name, _, value = param.partition('=')
+                if name.strip() == 'q':
+                    try:
+                        return float(value) > 0
+                    except ValueError:
+                        return False
+            return True
+    return False
+
+def negotiate(header):
+    " the content encoding to use for a client sending Accept-Encoding `header`, or None "
+    if brotli is not None and accepted(header, 'br'):
+        return 'br'
+    if accepted(header, 'gzip'):
+        return 'gzip'
+    return None
+
+def encode(data, coding, level=COMPRESS_LEVEL):
+    " bytes `data` compressed with content encoding `coding` ('br' or 'gzip') "
+    if coding == 'br':
+        return brotli.compress(data, quality=min(level, 11))
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level, mtime=0) as f:
+        f.write(data)
+    return buf.getvalue()
+
+_fingerprints = {} # path -> (mtime, fingerprint)
+_lock         = threading.Lock()
+
+def fingerprint(path):
+    " short hash of the content of the file at `path`, re-computed only when the file changes "
+    mtime = os.path.getmtime(path)
+    with _lock:
+        cached = _fingerprints.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:12]
+    with _lock:
+        _fingerprints[path] = (mtime, digest)
+    return digest
@@ -0,0 +1,231 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Background execution of notebook apps for the app server's job API.
+
+    A submitted NotebookApp waits in a bounded queue until one of a fixed number of worker threads
+    runs it.  Finished jobs keep their result until they are older than the retention period, or until
+    too many newer jobs have finished.
+
+    With pre-forked workers (see ipyapp.prefork), a job runs in the worker process that took it, and
+    is also kept as a JSON file in a directory the workers share, written whenever its status changes:
+    any worker answers for any job.  A job left unfinished by a worker that has exited has failed.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from collections import OrderedDict, namedtuple
+
+try:
+    from Queue import Queue, Full
+except ImportError:
+    from queue import Queue, Full
+
+from ipyapp.cache  import save_json, alive
+from ipyapp.config import JOB_WORKERS, JOB_QUEUE, JOB_RETENTION, JOB_MAX, LOG_LEVEL
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+class JobQueueFull(Exception):
+    " Too many jobs are waiting to run "
+    pass
+
+class Job(object):
+    " one submitted notebook app execution "
+
+    def __init__(self, nba):
+        self.id        = uuid.uuid4().hex
+        self.nba       = nba
+        self.status    = 'queued' # queued -> running -> done | failed
+        self.submitted = time.time()
+        self.started   = None
+        self.finished  = None
+        self.result    = None     # (notebook, err) as returned by NotebookApp.startapp
+        self.error     = None
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed')
+
+    def run(self, execute, lock, changed=None):
+        " run the job with `execute`, changing its status under `lock` (its queue's), then calling `changed` "
+        changed = changed or (lambda job: None)
+        with lock:
+            self.status  = 'running'
+            self.started = time.time()
+        changed(self)
+        try:
+            result = execute(self.nba)
+        except Exception as ex:
+            log.info('job %s for notebook app [%s] failed: %s' % (self.id, self.nba.name, ex))
+            with lock: # finished as soon as it is done, for `JobQueue._prune`
+                self.error    = dict(type=type(ex).__name__, message=str(ex))
+                self.finished = time.time()
+                self.status   = 'failed'
+        else:
+            with lock:
+                self.result   = result
+                self.finished = time.time()
+                self.status   = 'done'
+        changed(self)
+
+    def to_dict(self):
+        return dict(id=self.id, app=self.nba.name, status=self.status, submitted=self.submitted,
+                    started=self.started, finished=self.finished, error=self.error)
+
+    def record(self):
+        " the job as stored in a shared job directory: its status, what its result is, and the result "
+        (value, err) = self.result or (None, None)
+        return dict(self.to_dict(), pid=os.getpid(), output=self.nba.output, format=self.nba.format,
+                    result=[value, err])
+
+# what the server needs to know of the NotebookApp behind a stored job
+StoredApp = namedtuple('StoredApp', 'name output format')
+
+class StoredJob(Job):
+    " a job as last stored in the shared job directory, by the worker process running it "
+
+    def __init__(self, record):
+        self.id        = record['id']
+        self.nba       = StoredApp(record['app'], record['output'], record['format'])
+        self.status    = record['status']
+        self.submitted = record['submitted']
+        self.started   = record['started']
+        self.finished  = record['finished']
+        self.error     = record['error']
+        self.result    = None
+        if self.status == 'done':
+            (value, err) = record['result']
+            if not self.nba.output: # the executed notebook, not values
+                from IPython.nbformat.current import to_notebook_json
+                value = to_notebook_json(value)
+            self.result = (value, err)
+        elif not self.done and not alive(record['pid']):
+            self.status   = 'failed'
+            self.finished = time.time()
+            self.error    = dict(type='WorkerExited', message='the worker process running the job has exited')
+
+class JobQueue(object):
+    " bounded queue of jobs executed by a pool of worker threads "
+
+    def __init__(self, execute, workers=JOB_WORKERS, size=JOB_QUEUE, retention=JOB_RETENTION, keep=JOB_MAX,
+                 discard=None):
+        self.execute   = execute # callable(NotebookApp) -> (notebook, err)
+        self.discard   = discard # callable(Job or StoredJob), for jobs that are forgotten
+        self.directory = None    # shared with the other worker processes, see `share`
+        self.swept     = 0       # when the shared directory was last pruned
+        self.workers   = workers
+        self.retention = retention
+        self.keep      = keep
+        self.pending   = Queue(maxsize=size)
+        self.jobs      = OrderedDict() # id -> Job, oldest first
+        self.threads   = []
+        self.lock      = threading.Lock()
+
+    def _start(self):
+        " start the worker threads on first use, so importing the server doesn't spawn threads "
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._work, name='job-worker-%s' % len(self.threads))
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            job = self.pending.get()
+            job.run(self.execute, self.lock, self._store)
+            self.pending.task_done()
+
+    def share(self, directory):
+        " keep the jobs in `directory` too, for the other worker processes serving the job API "
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, os.path.basename(job_id) + '.json')
+
+    def _store(self, job):
+        if self.directory is not None:
+            save_json(self._path(job.id), job.record())
+
+    def _load(self, job_id):
+        " the job `job_id` from the shared directory, or None "
+        try:
+            with open(self._path(job_id)) as fh:
+                return StoredJob(json.load(fh))
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def _forget(self, job):
+        if self.directory is not None:
+            try:
+                os.remove(self._path(job.id))
+            except OSError:
+                pass # pruned by another worker
+        if self.discard:
+            self.discard(job)
+
+    def _sweep(self, expired):
+        " forget the stored jobs of any worker that finished before `expired`, at most once a minute "
+        if self.directory is None or time.time() - self.swept < 60:
+            return
+        self.swept = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if not name.endswith('.json') or os.path.getmtime(path) >= expired:
+                    continue # (a job's file is written last when it finishes)
+            except OSError:
+                continue
+            job = self._load(name[:-len('.json')])
+            if job is not None and job.done and job.id not in self.jobs:
+                self._forget(job)
+
+    def _prune(self):
+        " forget finished jobs past their retention period, and the oldest ones beyond `keep` "
+        expired = time.time() - self.retention
+        with self.lock:
+            finished = [job for job in self.jobs.values() if job.done]
+            for n, job in enumerate(finished):
+                if job.finished < expired or len(finished) - n > self.keep:
+                    del self.jobs[job.id]
+                    self._forget(job)
+        self._sweep(expired)
+
+    def submit(self, nba):
+        " queue NotebookApp `nba` for execution and return its Job "
+        self._start()
+        self._prune()
+        job = Job(nba)
+        with self.lock: # known before a worker can pick it up
+            self.jobs[job.id] = job
+        self._store(job)
+        try:
+            self.pending.put(job, block=False)
+        except Full:
+            with self.lock:
+                del self.jobs[job.id]
+            self._forget(job)
+            raise JobQueueFull('%s jobs are already waiting to run' % self.pending.qsize())
+        return job
+
+    def get(self, job_id):
+        " the Job with id `job_id` (a StoredJob if another worker took it), or None if it is unknown or expired "
+        self._prune()
+        job = self.jobs.get(job_id)
+        if job is None and self.directory is not None:
+            job = self._load(job_id)
+            if job is not None and job.done and job.finished < time.time() - self.retention:
+                return None
+        return job
@@ -0,0 +1,48 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Keeps apart the apps run one after another in a pooled kernel (see ipyapp.pool).
+
+    `snapshot()` runs in the kernel when it joins the pool, `restore()` before every app run in a
+    fresh namespace.  It puts `sys.path` back and drops the modules imported since from outside the
+    env's installation: the modules an app imported from its own directory (a `utils.py`, say), which
+    the next app, run from another directory, would otherwise get in place of its own, along with
+    their state.  Library modules stay imported, which is what keeps the kernel warm (and extension
+    modules can't be imported twice anyway).
+"""
+
+import importlib
+import os
+import sys
+
+PREFIXES = [os.path.join(os.path.realpath(prefix), '')
+            for prefix in set([sys.prefix, sys.exec_prefix, getattr(sys, 'base_prefix', sys.prefix)])]
+
+_pooled = {} # sys.modules names and sys.path when the kernel joined the pool
+
+def snapshot():
+    " remember this kernel's modules and module search path, as they are before any app runs "
+    _pooled.update(modules=set(sys.modules), path=list(sys.path))
+
+def installed(module):
+    " was `module` built in or loaded from the env's installation? "
+    path = getattr(module, '__file__', None)
+    if not path:
+        return True
+    path = os.path.realpath(path)
+    return any(path.startswith(prefix) for prefix in PREFIXES)
+
+def restore():
+    " back to the snapshot: the module search path, and no app modules from outside the env "
+    if not _pooled:
+        return
+    sys.path[:] = _pooled['path']
+    for name in [name for name in sys.modules if name not in _pooled['modules']]:
+        module = sys.modules.get(name)
+        if module is not None and not installed(module):
+            del sys.modules[name]
+    if hasattr(importlib, 'invalidate_caches'): # Python 3: the next app's directory may hold new files
+        importlib.invalidate_caches()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" A local load driver for the app server: keeps a number of GET requests in flight and reports
+    throughput and latency percentiles.
+
+        python -m ipyapp.loadgen "http://127.0.0.1:5007/adder?a=1&b=2&c=3" -n 200 -c 8
+
+    Several URLs are requested in turn, e.g. with different app arguments to get past the result
+    cache.  Used by bench/bench_suite.py.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import socket
+import threading
+import time
+
+try:
+    from urllib2        import urlopen, HTTPError, URLError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error   import HTTPError, URLError
+
+def percentile(values, pct):
+    " the `pct` percentile (nearest rank) of sorted `values`, or None if there are none "
+    if not values:
+        return None
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+def fetch(url, timeout=60):
+    " GET `url`, return the response status and its size in bytes "
+    try:
+        response = urlopen(url, timeout=timeout)
+        return (response.getcode(), len(response.read()))
+    except HTTPError as ex:
+        return (ex.code, len(ex.read()))
+
+def load(urls, requests=100, concurrency=4, timeout=60):
+    """ GET `requests` of `urls` (in turn), `concurrency` at a time; returns the throughput (requests per
+        second), latency percentiles (seconds) and the count of responses per status
+    """
+    urls      = list(urls)
+    latencies = []
+    statuses  = {}
+    nbytes    = [0]
+    issued    = [0]
+    lock      = threading.Lock()
+
+    def worker():
+        while True:
+            with lock:
+                if issued[0] >= requests:
+                    return
+                url = urls[issued[0] % len(urls)]
+                issued[0] += 1
+            start = time.time()
+            try:
+                (status, size) = fetch(url, timeout)
+            except (URLError, socket.error, socket.timeout) as ex:
+                (status, size) = (type(ex).__name__, 0)
+            elapsed = time.time() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(status)] = statuses.get(str(status), 0) + 1
+                nbytes[0] += size
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - started
+
+    latencies.sort()
+    return dict(requests=requests, concurrency=concurrency, seconds=seconds,
+                throughput=requests / seconds if seconds else None,
+                errors=sum(count for status, count in statuses.items() if not status.startswith('2')),
+                statuses=statuses, bytes=nbytes[0],
+                p50=percentile(latencies, 50), p90=percentile(latencies, 90),
+                p99=percentile(latencies, 99), max=latencies[-1] if latencies else None)
+
+def main():
+    p = argparse.ArgumentParser(description="load an app server with GET requests, report throughput and latency")
+    p.add_argument("urls", nargs='+', help="URLs to request, in turn")
+    p.add_argument("-n", "--requests",    type=int, default=100, help="requests in all (default: %(default)s)")
+    p.add_argument("-c", "--concurrency", type=int, default=4,   help="requests in flight (default: %(default)s)")
+    p.add_argument("-t", "--timeout",     type=int, default=60,  help="seconds per request (default: %(default)s)")
+    p.add_argument("--json", action="store_true", default=False, help="print the results as JSON")
+    args = p.parse_args()
+
+    stats = load(args.urls, args.requests, args.concurrency, args.timeout)
+    if args.json:
+        print(json.dumps(stats))
+    else:
+        print("{requests} requests, {concurrency} at a time, {errors} errors: {throughput:.1f}/sec, "
+              "p50 {p50:.3f}s, p90 {p90:.3f}s, p99 {p99:.3f}s, max {max:.3f}s".format(**stats))
+
+if __name__ == "__main__":
+    main()
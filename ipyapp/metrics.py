@@ -0,0 +1,280 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" App server metrics, served at /metrics in the Prometheus text format (version 0.0.4).
+
+    ipyapp_phase_seconds{app,phase}      histogram of the time spent in each phase of a request
+                                         (see ipyapp.timing): fetch, parse, queue, env, spawn,
+                                         checkout, boot, execute, cell (each), read, render
+    ipyapp_executions_total{app}         notebook app runs (cache hits are not runs)
+    ipyapp_cache_hits_total{app}         results served from the result cache
+    ipyapp_timeouts_total{app}           runs that timed out
+    ipyapp_errors_total{app,error}       failed requests, by exception class (NotebookAppError...)
+    ipyapp_executions_in_flight          runs holding an execution slot
+    ipyapp_kernels_live                  pooled kernels, busy or idle
+
+    With pre-forked workers (see ipyapp.prefork), each worker writes its values to a file of its own
+    in a directory they share (see `share`), at most once a second and when it exits, and /metrics
+    adds up the files of all workers: counters and histograms over every worker there has been,
+    gauges over the live ones.
+"""
+
+import copy
+import json
+import os
+import threading
+import time
+
+from ipyapp.cache   import save_json, file_lock, alive
+from ipyapp.config  import METRICS_BUCKETS
+from ipyapp.execute import NotebookAppTimeout
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('%s="%s"' % (name, _escape(value)) for name, value in pairs) + "}"
+
+def _number(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(object):
+    " a metric family: one value per combination of label values "
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name   = name
+        self.help   = help
+        self.labels = tuple(labels)
+        self.values = {} # label values -> value
+        self.lock   = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        " (suffix, label values, extra labels, value) for every sample "
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield ("", key, (), value)
+
+    def snapshot(self):
+        " the values, as JSON: [[label values, value], ...] "
+        with self.lock:
+            return [[list(key), copy.copy(value)] for key, value in self.values.items()]
+
+    def merge(self, values):
+        " add `values`, a `snapshot` of the same metric in another process "
+        with self.lock:
+            for key, value in values:
+                key = tuple(key)
+                self.values[key] = self._add(self.values[key], value) if key in self.values else value
+
+    def _add(self, value, other):
+        return value + other
+
+    def empty(self):
+        " a copy of this metric without values, to merge snapshots into "
+        metric = copy.copy(self)
+        metric.values = {}
+        metric.lock   = threading.Lock()
+        return metric
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for suffix, key, extra, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix, _labels(self.labels, key, extra), _number(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    " a value that is read when the metrics are rendered, from `func` "
+    type = 'gauge'
+
+    def __init__(self, name, help, func=None):
+        super(Gauge, self).__init__(name, help)
+        self.func = func
+
+    def samples(self):
+        if self.func is None: # merged from snapshots
+            for sample in super(Gauge, self).samples():
+                yield sample
+        else:
+            yield ("", (), (), self.func())
+
+    def snapshot(self):
+        return [[[], self.func()]] if self.func is not None else super(Gauge, self).snapshot()
+
+    def empty(self):
+        metric = super(Gauge, self).empty()
+        metric.func = None
+        return metric
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=METRICS_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = sorted(buckets) + [float('inf')]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * len(self.buckets) + [0.0] # per bucket, then the sum
+            for idx, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+            counts[-1] += value
+
+    def _add(self, counts, other):
+        return [count + more for count, more in zip(counts, other)]
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, list(counts)) for key, counts in self.values.items())
+        for key, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield ("_bucket", key, [('le', _number(bound))], total)
+            yield ("_sum", key, (), counts[-1])
+            yield ("_count", key, (), total)
+
+class Registry(object):
+    " the metrics to render, in the order they were added "
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+    def snapshot(self, gauges=True):
+        " the values of all metrics (but gauges, unless `gauges`) by name, as JSON "
+        return dict((metric.name, metric.snapshot()) for metric in self.metrics
+                    if gauges or not isinstance(metric, Gauge))
+
+    def merged(self, snapshots):
+        " a registry of the same metrics, holding the sum of `snapshots` "
+        merged = Registry()
+        for metric in self.metrics:
+            metric = merged.add(metric.empty())
+            for snapshot in snapshots:
+                metric.merge(snapshot.get(metric.name, ()))
+        return merged
+
+class SharedMetrics(object):
+    """ the registries of several worker processes, each kept in `directory` as <pid>.json; those of
+        workers that have exited are added up in retired.json, without their gauges
+    """
+
+    def __init__(self, registry, directory, interval=1):
+        self.registry  = registry
+        self.directory = directory
+        self.interval  = interval # seconds between writes of this process's values
+        self.flushed   = 0
+        self.lock      = os.path.join(directory, 'lock')
+
+    def _read(self, name):
+        try:
+            with open(os.path.join(self.directory, name)) as fh:
+                return json.load(fh)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _workers(self):
+        " {pid: file name} of the workers with values in the directory "
+        names = [name.split('.') for name in os.listdir(self.directory)]
+        return dict((int(name[0]), '.'.join(name)) for name in names
+                    if len(name) == 2 and name[0].isdigit() and name[1] == 'json')
+
+    def flush(self, force=False):
+        " write this process's values, unless they were written less than `interval` seconds ago "
+        if force or time.time() - self.flushed >= self.interval:
+            self.flushed = time.time()
+            save_json(os.path.join(self.directory, "%s.json" % os.getpid()), self.registry.snapshot())
+
+    def render(self):
+        " the metrics of all workers, once the values of those that have exited are moved to retired.json "
+        self.flush(force=True)
+        with file_lock(self.lock):
+            workers = self._workers()
+            dead    = [name for pid, name in workers.items() if not alive(pid)]
+            if dead:
+                retired = [self._read(name) for name in ['retired.json'] + dead]
+                save_json(os.path.join(self.directory, 'retired.json'),
+                          self.registry.merged(retired).snapshot(gauges=False))
+                for name in dead:
+                    os.remove(os.path.join(self.directory, name))
+            snapshots = [self._read(name) for name in ['retired.json'] + sorted(set(workers.values()) - set(dead))]
+        return self.registry.merged(snapshots).render()
+
+registry   = Registry()
+phases     = registry.add(Histogram('ipyapp_phase_seconds', 'Time spent per request phase', ('app', 'phase')))
+executions = registry.add(Counter('ipyapp_executions_total', 'Notebook app runs', ('app',)))
+cache_hits = registry.add(Counter('ipyapp_cache_hits_total', 'Results served from the result cache', ('app',)))
+timeouts   = registry.add(Counter('ipyapp_timeouts_total', 'Notebook app runs that timed out', ('app',)))
+errors     = registry.add(Counter('ipyapp_errors_total', 'Failed requests by exception class', ('app', 'error')))
+
+def observe(app, timeline):
+    " add the phases of `timeline` (a `ipyapp.timing.Timeline`) to the phase histograms of `app` "
+    for phase, start, seconds, args in timeline.export():
+        phases.observe(seconds, app=app, phase=phase)
+
+def error(app, exception):
+    " count a failure, and a timeout if it was one "
+    errors.inc(app=app, error=type(exception).__name__)
+    if isinstance(exception, NotebookAppTimeout):
+        timeouts.inc(app=app)
+
+def gauge(name, help, func):
+    " add a gauge whose value is `func()` when the metrics are rendered "
+    return registry.add(Gauge(name, help, func))
+
+shared = None # a SharedMetrics, with pre-forked workers
+
+def share(directory):
+    """ add up the metrics of the worker processes about to be forked in `directory` (emptied: the
+        values of a previous server are gone with it)
+    """
+    global shared
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name in os.listdir(directory):
+        if name.endswith('.json'):
+            os.remove(os.path.join(directory, name))
+    shared = SharedMetrics(registry, directory)
+
+def flush(force=False):
+    " write this worker's values for the others, if shared (at most once a second, unless `force`) "
+    if shared is not None:
+        shared.flush(force)
+
+def render():
+    " the server's metrics in the Prometheus text format, over all worker processes if shared "
+    if shared is not None:
+        return shared.render()
+    return registry.render()
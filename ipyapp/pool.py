@@ -0,0 +1,274 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Pools of pre-started IPython kernels, one pool per conda environment.
+
+    Each pooled kernel lives in a long running `conda launch --worker` child process started inside
+    the app's conda env.  The worker boots a single kernel via runipy's `NotebookRunner` and then runs
+    one notebook after another in it, so an app server request only pays for executing the cells.
+
+    Parent and worker talk over the worker's STDIN/STDOUT, one line per message.  The notebook itself
+    travels through temporary files, as for a launch (see ipyapp.transport):
+
+        request:  {"cwd": <notebook dir>, "input": <notebook file>, "reply": <reply file>}  newline
+        reply:    {"err": <stderr text>}  newline
+
+    The worker announces `{"ready": true}` once its kernel is up.  Each run gets a fresh namespace,
+    without the modules the previous app imported from its own directory.  A request may also carry
+    `"reset": false` to keep the previous run's namespace and modules, `"before"` / `"after"` code to
+    run in the kernel around the notebook (see ipyapp.sweep), and an `"output"` spec (and `"format"`)
+    to reply with just those values instead of the notebook (see ipyapp.results).
+"""
+
+import contextlib
+import json
+import logging
+import os
+import select
+import sys
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from ipyapp.config    import POOL_SIZE, POOL_RECYCLE, POOL_WAIT, LOG_LEVEL
+from ipyapp.execute   import run, spawn_launcher, stop, mini_markdown_nb, NotebookAppExecutionError, NotebookAppTimeout
+from ipyapp.transport import write_notebook, read_notebook, write_reply, read_reply, temp_path, remove
+from ipyapp.timing    import Timeline
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+# executed in the kernel once, when it joins the pool, and before every run: clear the previous app's
+# namespace and the modules it imported from its directory (library modules stay loaded, which is most
+# of the point, see ipyapp.kernelstate), then move to the directory of the notebook about to run
+SNAPSHOT_CELL = """from ipyapp import kernelstate as __kernelstate
+__kernelstate.snapshot()
+del __kernelstate
+"""
+RESET_CELL = """get_ipython().magic('reset -f')
+from ipyapp import kernelstate as __kernelstate
+__kernelstate.restore()
+del __kernelstate
+"""
+CHDIR_CELL = """import os as __os
+__os.chdir({cwd!r})
+del __os
+"""
+
+class PooledKernel(object):
+    " A `conda launch --worker` child process holding one warm kernel "
+
+    def __init__(self, env_dict, args=()):
+        self.proc   = spawn_launcher(['launch', '--worker'] + list(args), env_dict, stderr=None)
+        self.runs   = 0
+        self.ready  = False
+        self.buffer = b"" # read from the worker, not yet a whole line
+
+    @property
+    def alive(self):
+        return self.proc.poll() is None
+
+    def _readline(self, timeout):
+        """ the worker's next line, within `timeout` seconds: read from the pipe's descriptor, as the
+            file object's own buffer could hold lines `select` doesn't know about
+        """
+        deadline = time.time() + timeout
+        fd = self.proc.stdout.fileno()
+        while b"\n" not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                raise NotebookAppTimeout('Notebook App timed out after %s seconds' % timeout)
+            data = os.read(fd, 64 * 1024)
+            if not data:
+                raise NotebookAppExecutionError('Pooled kernel exited unexpectedly (status %s)' % self.proc.poll())
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b"\n", 1)
+        return line.decode('utf-8')
+
+    def execute(self, nbjson, cwd, timeout, reset=True, before=None, after=None, output=None, format=None):
+        """ run the notebook JSON `nbjson` (or its serialized payload) in this kernel with `cwd` as working directory, in a fresh
+            namespace unless `reset` is False, with code `before` and `after` it if given; returns
+            (reply, err), the reply as in `ipyapp.transport`: with just the `output` values if given,
+            in `format` if that is a binary one (see `ipyapp.results`)
+        """
+        if not self.ready:
+            json.loads(self._readline(POOL_WAIT))
+            self.ready = True
+
+        self.runs += 1
+        payload = write_notebook(nbjson)
+        reply   = temp_path('.json')
+        try:
+            request = dict(cwd=cwd, input=payload, reply=reply, reset=reset, before=before, after=after,
+                           output=output, format=format)
+            self.proc.stdin.write((json.dumps(request) + "\n").encode('utf-8'))
+            self.proc.stdin.flush()
+
+            header = json.loads(self._readline(timeout))
+            return (read_reply(reply), header['err'])
+        finally:
+            remove(payload, reply)
+
+    def close(self):
+        if self.alive:
+            stop(self.proc)
+
+class KernelPool(object):
+    " Pre-started kernels for a single conda environment "
+
+    def __init__(self, env_dict, size=POOL_SIZE, recycle=POOL_RECYCLE, args=()):
+        self.env_dict = env_dict
+        self.args     = args # extra `conda launch --worker` arguments (see `NotebookApp.fork_args`)
+        self.size     = size
+        self.recycle  = recycle
+        self.idle     = Queue()
+        self.live     = 0
+        self.lock     = threading.Lock()
+
+        for _ in range(size): # workers boot their kernels in parallel, in the background
+            self.idle.put(self._spawn())
+
+    def _spawn(self):
+        with self.lock:
+            self.live += 1
+        return PooledKernel(self.env_dict, self.args)
+
+    def _retire(self, kernel):
+        kernel.close()
+        with self.lock:
+            self.live -= 1
+
+    @contextlib.contextmanager
+    def checkout(self, wait=POOL_WAIT):
+        " borrow an idle kernel, starting a new one if the pool is not yet full "
+        try:
+            kernel = self.idle.get(block=False)
+        except Empty:
+            with self.lock:
+                grow = self.live < self.size
+            if grow:
+                kernel = self._spawn()
+            else:
+                try:
+                    kernel = self.idle.get(timeout=wait)
+                except Empty:
+                    raise NotebookAppExecutionError('No pooled kernel available after %s seconds' % wait)
+
+        try:
+            yield kernel
+        except Exception:
+            # a failed or timed out kernel is in an unknown state: replace it
+            self._retire(kernel)
+            self.idle.put(self._spawn())
+            raise
+
+        if kernel.runs >= self.recycle or not kernel.alive:
+            log.info('recycling pooled kernel after %s executions' % kernel.runs)
+            self._retire(kernel)
+            kernel = self._spawn()
+        self.idle.put(kernel)
+
+    def close(self):
+        while True:
+            try:
+                self._retire(self.idle.get(block=False))
+            except Empty:
+                break
+
+class KernelPools(object):
+    " Kernel pools keyed by conda environment name, each created on first use of its environment "
+
+    def __init__(self, size=POOL_SIZE, recycle=POOL_RECYCLE):
+        self.size    = size
+        self.recycle = recycle
+        self.pools   = {}
+        self.lock    = threading.Lock()
+
+    def get(self, env, env_dict, args=()):
+        with self.lock:
+            if env not in self.pools:
+                log.info('starting kernel pool for conda env [%s]' % env)
+                self.pools[env] = KernelPool(env_dict, self.size, self.recycle, args)
+            return self.pools[env]
+
+    def execute(self, nba, env_dict):
+        " run NotebookApp `nba` in a pooled kernel for its env, return (reply, err) "
+        pool = self.pools.get(nba.env)
+        if pool is None: # the first app to run in an env sets its pool up
+            pool = self.get(nba.env, env_dict, nba.fork_args(env_dict))
+        waiting = time.time()
+        with pool.checkout() as kernel:
+            nba.timeline.add('checkout', waiting, time.time() - waiting)
+            return kernel.execute(nba.payload(), nba.nbdir, nba.timeout,
+                                  output=nba.output, format=nba.format)
+
+    @property
+    def live(self):
+        return sum(pool.live for pool in self.pools.values())
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+def serve_worker(stdin=None, zygote=None, preload=()):
+    """ worker side of a pooled kernel: `conda launch --worker`, with the kernel forked from the zygote
+        listening on `zygote` if given
+    """
+    from runipy.notebook_runner import NotebookRunner, NotebookError
+    from IPython.nbformat.current import new_code_cell
+
+    stdin   = stdin or sys.stdin
+    channel = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    sys.stdout = sys.stderr # anything else printed must not end up on the reply channel
+
+    if zygote:
+        from ipyapp.zygote import zygote_runner
+        runner = zygote_runner(zygote, preload)
+    else:
+        runner = NotebookRunner(None)
+    runner.run_cell(new_code_cell(input=SNAPSHOT_CELL))
+    channel.write(json.dumps(dict(ready=True)) + "\n")
+    channel.flush()
+
+    for line in iter(stdin.readline, ''):
+        request  = json.loads(line)
+        nb       = read_notebook(request['input'])
+        timeline = Timeline()
+        broken   = False
+
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            prelude = RESET_CELL if request.get('reset', True) else ""
+            prelude += (request.get('before') or "") + "\n" + CHDIR_CELL.format(cwd=request['cwd'])
+            runner.run_cell(new_code_cell(input=prelude))
+            result = run(nb, output=request.get('output'), runner=runner, format=request.get('format'),
+                         timeline=timeline)
+            if request.get('after'):
+                runner.run_cell(new_code_cell(input=request['after']))
+        except NotebookError as ex: # the kernel couldn't be prepared, so it is unusable: report and quit
+            sys.stderr.write(str(ex))
+            result = mini_markdown_nb("Notebook Error\n==============\nERROR: pooled kernel could not be prepared")
+            broken = True
+        finally:
+            err, sys.stderr = sys.stderr.getvalue(), stderr
+
+        write_reply(request['reply'], result, nb, timeline)
+        channel.write(json.dumps(dict(err=err)) + "\n")
+        channel.flush()
+
+        if broken:
+            return 1
+
+    return 0
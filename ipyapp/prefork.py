@@ -0,0 +1,222 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Pre-fork multi-worker serving for the app server (`conda appserver start --workers N`).
+
+    The master process binds the listening socket, then forks the worker processes, which all
+    accept connections on it and serve them from a pool of threads.  A worker is replaced by a
+    fresh one after it has served a number of requests or grown past a memory threshold, once its
+    requests in flight are done.  SIGHUP to the master (`conda appserver reload`) replaces all
+    workers the same way, SIGTERM or SIGINT stops them and the master.
+
+    Each worker has its own result cache, kernel pools and execution slots.  With more than one
+    worker, jobs and metrics are also kept in a directory the workers share (see ipyapp.server).
+    Conda envs are built under a file lock, so workers never build the same env at once.
+"""
+
+import errno
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from werkzeug.serving import BaseWSGIServer
+
+from ipyapp.config import WORKER_THREADS, WORKER_REQUESTS, WORKER_MEMORY, GRACEFUL_TIMEOUT, LOG_LEVEL
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+def rss():
+    " resident memory of this process in bytes (the peak, without psutil) "
+    try:
+        import psutil
+        return psutil.Process(os.getpid()).memory_info().rss
+    except (ImportError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024 # bytes on OS X, KB elsewhere
+
+class WorkerServer(BaseWSGIServer):
+    """ a WSGI server that hands the connections it accepts to `threads` threads, and stops accepting
+        once it has served `max_requests` or uses more than `max_memory` bytes (0: no limit)
+    """
+    request_queue_size = 128  # listen backlog, shared by all workers
+    multithread        = True # (for the WSGI environ)
+    multiprocess       = True
+
+    def __init__(self, host, port, app, threads=WORKER_THREADS, max_requests=WORKER_REQUESTS,
+                 max_memory=WORKER_MEMORY):
+        BaseWSGIServer.__init__(self, host, port, app)
+        self.socket.setblocking(False) # workers that lose the race for a connection go back to waiting
+        self.threads      = threads
+        self.max_requests = max_requests
+        self.max_memory   = max_memory
+        self.served       = 0
+        self.stopping     = False
+        self.lock         = threading.Lock()
+        self.pending      = None
+
+    def serve(self):
+        " serve until `stop`, then finish the requests in flight "
+        self.pending = Queue(maxsize=self.threads) # accepting waits while all threads are busy
+        pool = [threading.Thread(target=self._work, name='worker-thread-%s' % n) for n in range(self.threads)]
+        for thread in pool:
+            thread.daemon = True
+            thread.start()
+        self.serve_forever()
+
+        for thread in pool:
+            self.pending.put(None)
+        deadline = time.time() + GRACEFUL_TIMEOUT
+        for thread in pool:
+            thread.join(max(deadline - time.time(), 0))
+
+    def process_request(self, request, client_address):
+        self.pending.put((request, client_address))
+
+    def _work(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            (request, client_address) = item
+            try:
+                request.setblocking(True)
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+            self._count()
+
+    def _count(self):
+        with self.lock:
+            self.served += 1
+            served = self.served
+        if self.max_requests and served >= self.max_requests:
+            self.stop('served %s requests' % served)
+        elif self.max_memory and rss() > self.max_memory:
+            self.stop('using more than %s MB' % (self.max_memory // (1024 * 1024)))
+
+    def stop(self, reason):
+        " stop accepting connections (from any thread, or a signal handler) "
+        with self.lock:
+            if self.stopping:
+                return
+            self.stopping = True
+        log.info('worker %s stopping: %s' % (os.getpid(), reason))
+        threading.Thread(target=self.shutdown).start() # `shutdown` waits for `serve_forever` to return
+
+class Master(object):
+    " forks and watches the worker processes serving `server` (a WorkerServer) "
+
+    def __init__(self, server, workers, setup=None, teardown=None):
+        self.server   = server
+        self.size     = workers
+        self.setup    = setup    # run in each worker before it serves
+        self.teardown = teardown # run in each worker after it has served
+        self.workers  = set()    # pids of the current workers
+        self.retiring = set()    # pids of workers finishing their requests before they exit
+        self.reload   = False
+        self.stopping = False
+
+    def run(self):
+        signal.signal(signal.SIGHUP,  lambda signum, frame: setattr(self, 'reload', True))
+        signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'stopping', True))
+        signal.signal(signal.SIGINT,  lambda signum, frame: setattr(self, 'stopping', True))
+        log.info('app server master %s, %s workers' % (os.getpid(), self.size))
+
+        while len(self.workers) < self.size:
+            self.spawn()
+        while not self.stopping:
+            if self.reload:
+                self.reload = False
+                log.info('replacing all workers')
+                self.retire(list(self.workers))
+            self.reap()
+            while len(self.workers) < self.size and not self.stopping:
+                self.spawn()
+            time.sleep(0.2)
+
+        self.retire(list(self.workers))
+        deadline = time.time() + GRACEFUL_TIMEOUT
+        while self.retiring and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        for pid in self.retiring: # still busy: no more grace
+            self.kill(pid, signal.SIGKILL)
+        self.server.server_close()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers.add(pid)
+            return pid
+        code = 0
+        try:
+            self.work()
+        except Exception:
+            log.exception('worker %s failed' % os.getpid())
+            code = 1
+        finally:
+            os._exit(code) # never back into the master's loop
+
+    def work(self):
+        " the worker process: serve until recycled or told to stop "
+        signal.signal(signal.SIGHUP,  signal.SIG_IGN)
+        signal.signal(signal.SIGINT,  signal.SIG_IGN) # CTRL-C goes to the master, which stops us
+        signal.signal(signal.SIGTERM, lambda signum, frame: self.server.stop('told to stop'))
+        if self.setup is not None:
+            self.setup()
+        try:
+            self.server.serve()
+        finally:
+            if self.teardown is not None:
+                self.teardown()
+
+    def retire(self, pids):
+        " let workers `pids` finish their requests and exit "
+        for pid in pids:
+            self.workers.discard(pid)
+            self.retiring.add(pid)
+            self.kill(pid, signal.SIGTERM)
+
+    def reap(self):
+        " forget the workers that have exited; the main loop replaces them "
+        while True:
+            try:
+                (pid, status) = os.waitpid(-1, os.WNOHANG)
+            except OSError as ex:
+                if ex.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if pid in self.workers:
+                log.info('worker %s exited (status %s), replacing it' % (pid, status))
+            self.workers.discard(pid)
+            self.retiring.discard(pid)
+
+    @staticmethod
+    def kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass # already gone
+
+def serve_prefork(app, host, port, workers, threads=WORKER_THREADS, max_requests=WORKER_REQUESTS,
+                  max_memory=WORKER_MEMORY, setup=None, teardown=None):
+    " serve WSGI `app` on `host`:`port` from `workers` processes of `threads` threads each, until stopped "
+    server = WorkerServer(host, int(port), app, threads, max_requests, max_memory)
+    Master(server, workers, setup, teardown).run()
@@ -0,0 +1,67 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Per-cell CPU and memory profiles, taken inside the kernel.
+
+    With the `profile_cells` option (`conda launch --profile-cells`, `?profile_cells=1` on the app
+    server) the runner executes `start()` in the kernel before each code cell and prints `stop()`
+    after it (see `ipyapp.execute.run_cells`).  A profile holds the cell's wall and CPU seconds, the peak memory
+    its Python allocations took (tracemalloc, Python 3 only) and the functions it spent the most
+    time in (cProfile).  It is kept as the cell's `profile` metadata, shown in a panel under the
+    cell in HTML results, and returned as "@profile" with `output` results.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import time
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+TOP = 10 # functions listed per cell
+
+_running = {} # the profile being taken: profiler, start times, whether we started tracemalloc
+
+def _cpu():
+    times = os.times()
+    return times[0] + times[1] # user + system
+
+def start():
+    " start profiling the code run in this kernel "
+    traced = tracemalloc is not None and not tracemalloc.is_tracing()
+    if traced: # (if the app traces allocations itself, leave that alone)
+        tracemalloc.start()
+    profiler = cProfile.Profile()
+    _running.update(profiler=profiler, traced=traced, wall=time.time(), cpu=_cpu())
+    profiler.enable()
+
+def stop(top=TOP):
+    " stop profiling, return the profile as JSON "
+    profiler = _running['profiler']
+    profiler.disable()
+    profile = dict(seconds=time.time() - _running['wall'], cpu_seconds=_cpu() - _running['cpu'], peak_bytes=None)
+    if _running['traced']:
+        profile['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    _running.clear()
+
+    functions = [dict(function=func, file=filename, line=line, calls=calls, seconds=own, cumulative=cumulative)
+                 for (filename, line, func), (primitive, calls, own, cumulative, callers)
+                 in pstats.Stats(profiler).stats.items()
+                 if filename != __file__.replace('.pyc', '.py')] # not our own start and stop
+    functions.sort(key=lambda function: function['seconds'], reverse=True)
+    profile['functions'] = functions[:top]
+    return json.dumps(profile)
+
+def profiles(nb):
+    " the profiles of the profiled cells of executed notebook `nb`, each with the index of its cell "
+    return [dict(cell['metadata']['profile'], cell=idx)
+            for ws in nb['worksheets'] for idx, cell in enumerate(ws['cells'])
+            if 'profile' in cell.get('metadata', {})]
@@ -0,0 +1,150 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Index of the notebook apps available to the app server.
+
+    Apps are the `.ipynb` files in each search root and one directory down.  The index is built once
+    and kept fresh in the background (with inotify when `pyinotify` is installed, otherwise by periodic
+    rescans), so listing apps and resolving an app name never touch the filesystem per request.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from glob import glob
+
+from ipyapp.config  import SEARCH, SCAN_INTERVAL, LOG_LEVEL
+from ipyapp.execute import notebooks
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+class AppEntry(object):
+    " a notebook app found in one of the search roots "
+
+    def __init__(self, name, path, desc, inputs):
+        self.name   = name   # path relative to its search root, without ".ipynb"
+        self.path   = path
+        self.desc   = desc
+        self.inputs = inputs
+
+class AppRegistry(object):
+    " name -> notebook app index over a list of search roots; earlier roots win on name clashes "
+
+    def __init__(self, roots=SEARCH, interval=SCAN_INTERVAL):
+        self.roots    = [os.path.abspath(root) for root in roots]
+        self.interval = interval
+        self.apps     = []  # AppEntry list, in app list order
+        self.index    = {}  # app name or alias -> AppEntry
+        self.scanned  = 0   # time of the last scan
+        self.watcher  = None
+        self.lock     = threading.Lock()
+        self.scanning = threading.RLock() # one scan at a time
+
+    def _entry(self, name, path):
+        try:
+            meta = notebooks.load(path).meta
+        except (IOError, ValueError, KeyError, TypeError) as ex:
+            # keep listing it: running it will report the invalid file
+            log.warn('notebook app [%s] is not valid: %s' % (path, ex))
+            meta = {}
+        return AppEntry(name, path, meta.get('desc', os.path.basename(name)), meta.get('inputs', {}))
+
+    def scan(self):
+        " rebuild the index from the search roots "
+        with self.scanning:
+            self._scan()
+
+    def refresh(self, since):
+        " rescan, unless a scan has finished after time `since` (e.g. while waiting for the one in progress) "
+        with self.scanning:
+            if self.scanned <= since:
+                self._scan()
+
+    def _scan(self):
+        apps, index = [], {}
+        for root in self.roots:
+            for pattern in ('*.ipynb', '*/*.ipynb'):
+                for path in sorted(glob(os.path.join(root, pattern))):
+                    name = os.path.relpath(path, root).replace(os.sep, '/')[:-len('.ipynb')]
+                    if name in index:
+                        continue
+                    entry = self._entry(name, path)
+                    apps.append(entry)
+                    # the same spellings fetch_nb used to accept: "name", "name.ipynb" and "dir" for "dir/dir.ipynb"
+                    index[name] = index[name + '.ipynb'] = entry
+                    head, tail = os.path.split(name)
+                    if head and head == tail:
+                        index.setdefault(head, entry)
+
+        with self.lock:
+            self.apps, self.index, self.scanned = apps, index, time.time()
+        log.debug('app registry: %s apps in %s' % (len(apps), ", ".join(self.roots)))
+
+    def lookup(self, name):
+        " path of the app called `name` "
+        if not self.scanned:
+            self.refresh(0)
+        entry = self.index.get(name)
+        scanned = self.scanned
+        if entry is None and time.time() - scanned > 1: # it may be newer than the last scan
+            self.refresh(scanned) # a burst of misses rescans once
+            entry = self.index.get(name)
+        if entry is None:
+            raise LookupError('Notebook [%s] not found' % name)
+        return entry.path
+
+    def entries(self):
+        if not self.scanned:
+            self.refresh(0)
+        return list(self.apps)
+
+    def names(self):
+        return [entry.name for entry in self.entries()]
+
+    def watch(self):
+        " keep the index fresh in a background thread "
+        if self.watcher is not None:
+            return
+        self.scan()
+
+        if pyinotify is not None:
+            registry = self
+
+            class Rescan(pyinotify.ProcessEvent):
+                def process_default(self, event):
+                    if event.dir or event.pathname.endswith('.ipynb'):
+                        registry.scan()
+
+            mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_CLOSE_WRITE |
+                    pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM)
+            wm = pyinotify.WatchManager()
+            for root in self.roots:
+                wm.add_watch(root, mask, rec=True, auto_add=True)
+            self.watcher = pyinotify.ThreadedNotifier(wm, Rescan())
+            self.watcher.daemon = True
+            self.watcher.start()
+            log.info('watching app directories with inotify')
+        else:
+            self.watcher = threading.Thread(target=self._poll, name='app-registry')
+            self.watcher.daemon = True
+            self.watcher.start()
+            log.info('rescanning app directories every %s seconds' % self.interval)
+
+    def _poll(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.scan()
+            except Exception as ex:
+                log.warn('app registry scan failed: %s' % ex)
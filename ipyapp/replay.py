@@ -0,0 +1,213 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" The app server's access log, and replaying it against an app server.
+
+    With `conda appserver --log FILE` (or ACCESS_LOG), `runapp` writes one JSON line per request to
+    the access log, arguments included, so it is off unless asked for:
+
+        {"time": 1415022000.5, "method": "GET", "path": "/adder", "app": "adder",
+         "args": {"a": "1", "b": "2", "c": "3"}, "status": 200, "seconds": 0.412, "cache": "miss"}
+
+    where "cache" is "hit" (served from the result cache), "miss" (run, and its result cached),
+    "etag" (the client had it: 304) or null (not cacheable).  Past ACCESS_LOG_SIZE bytes the log
+    moves to FILE.1, replacing the one before.
+
+    `conda appserver replay --log FILE` sends the logged requests to an app server again, with
+    their original spacing, `--speed` times as fast, or as fast as possible (`--speed 0`), at most
+    `--concurrency` at a time, and reports latency percentiles, error rates and result cache hit
+    rates (from the X-Cache response header) per app, to see how a server copes with real
+    traffic before it gets it.
+"""
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    from Queue          import Queue
+    from urllib         import urlencode
+    from urllib2        import urlopen, HTTPError, URLError
+except ImportError:
+    from queue          import Queue
+    from urllib.parse   import urlencode
+    from urllib.request import urlopen
+    from urllib.error   import HTTPError, URLError
+
+from ipyapp.cache   import file_lock
+from ipyapp.loadgen import percentile
+from ipyapp.config  import ACCESS_LOG_SIZE, LOG_LEVEL
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+class AccessLog(object):
+    """ appends requests to a JSON lines file, from any thread of any worker process; past `size` bytes
+        the file moves to `path`.1 and a new one is started
+    """
+
+    def __init__(self, path, size=ACCESS_LOG_SIZE):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        self.fh   = None
+        self.pid  = None # of the process that opened `fh`
+
+    def _moved(self):
+        " has `fh` been moved aside (by this or another worker process)? "
+        try:
+            return os.stat(self.path).st_ino != os.fstat(self.fh.fileno()).st_ino
+        except OSError:
+            return True
+
+    def _open(self):
+        " the log file, opened once per process, and again once it was moved aside "
+        if self.fh is not None:
+            if self.pid == os.getpid() and not self._moved():
+                return self.fh
+            self.fh.close()
+        self.fh  = open(self.path, 'a')
+        self.pid = os.getpid()
+        return self.fh
+
+    def _rotate(self):
+        " move the full log aside, unless another worker process just did "
+        with file_lock(self.path + '.lock'):
+            if not self._moved():
+                os.rename(self.path, self.path + '.1')
+        self.fh.close()
+        self.fh = None
+
+    def write(self, **entry):
+        line = json.dumps(entry, separators=(',', ':')) + "\n"
+        try:
+            with self.lock:
+                fh = self._open()
+                fh.write(line)
+                fh.flush()
+                if self.size and fh.tell() > self.size:
+                    self._rotate()
+        except (IOError, OSError) as ex:
+            log.warn('request not logged, cannot write to %s: %s' % (self.path, ex))
+
+def read_log(path):
+    " the requests of the access log at `path`, in the order they came in (bad lines are skipped) "
+    entries = []
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if 'path' in entry and 'time' in entry:
+                entries.append(entry)
+    entries.sort(key=lambda entry: entry['time'])
+    return entries
+
+def send(url, entry, timeout=60):
+    " make the logged request `entry` to the app server at `url`, return (status, X-Cache header) "
+    args = urlencode(sorted(entry.get('args', {}).items()))
+    try:
+        if entry.get('method', 'GET') == 'POST':
+            response = urlopen(url + entry['path'], data=args.encode('utf-8'), timeout=timeout)
+        else:
+            response = urlopen(url + entry['path'] + ('?' + args if args else ''), timeout=timeout)
+        response.read()
+        return (response.getcode(), response.info().get('X-Cache'))
+    except HTTPError as ex:
+        ex.read()
+        return (ex.code, ex.info().get('X-Cache'))
+
+def replay(entries, url, speed=1.0, concurrency=8, timeout=60):
+    """ send the logged requests `entries` to the app server at `url`, `speed` times as fast as they
+        came in (0: as fast as possible), at most `concurrency` at a time; returns a
+        (app, status, seconds, X-Cache header) tuple per request, and the seconds it all took
+    """
+    pending = Queue(maxsize=concurrency) # the dispatcher waits when all workers are busy
+    results = []
+    lock    = threading.Lock()
+
+    def worker():
+        while True:
+            entry = pending.get()
+            if entry is None:
+                return
+            start = time.time()
+            try:
+                (status, cache) = send(url, entry, timeout)
+            except (URLError, IOError) as ex:
+                (status, cache) = (type(ex).__name__, None)
+            with lock:
+                results.append((entry.get('app') or entry['path'], status, time.time() - start, cache))
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    started = time.time()
+    first   = entries[0]['time'] if entries else 0
+    for entry in entries:
+        if speed:
+            delay = (entry['time'] - first) / speed - (time.time() - started)
+            if delay > 0:
+                time.sleep(delay)
+        pending.put(entry)
+    for thread in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+    return (results, time.time() - started)
+
+def summary(results):
+    " per app: requests, error rate, result cache hit rate and latency percentiles "
+    apps = {}
+    for app, status, seconds, cache in results:
+        apps.setdefault(app, []).append((status, seconds, cache))
+    report = {}
+    for app, requests in apps.items():
+        latencies = sorted(seconds for status, seconds, cache in requests)
+        errors    = [status for status, seconds, cache in requests if not (isinstance(status, int) and status < 400)]
+        cached    = [cache for status, seconds, cache in requests if cache in ('HIT', 'MISS')]
+        report[app] = dict(requests=len(requests), error_rate=float(len(errors)) / len(requests),
+                           hit_rate=float(cached.count('HIT')) / len(cached) if cached else None,
+                           p50=percentile(latencies, 50), p90=percentile(latencies, 90),
+                           p99=percentile(latencies, 99), max=latencies[-1])
+    return report
+
+def print_summary(report, seconds):
+    print("%-30s %8s %7s %7s %9s %9s %9s" % ("app", "requests", "errors", "hits", "p50", "p90", "p99"))
+    for app, stats in sorted(report.items()):
+        hits = "%6.1f%%" % (100 * stats['hit_rate']) if stats['hit_rate'] is not None else "    n/a"
+        print("%-30s %8d %6.1f%% %7s %8.3fs %8.3fs %8.3fs" % (app, stats['requests'], 100 * stats['error_rate'],
+                                                            hits, stats['p50'], stats['p90'], stats['p99']))
+    total = sum(stats['requests'] for stats in report.values())
+    print("%d requests in %.1f sec: %.1f/sec" % (total, seconds, total / seconds if seconds else 0))
+
+def replay_log(path, url, speed=1.0, concurrency=8, as_json=False):
+    " `conda appserver replay`: replay the access log at `path` against `url`, print the summary "
+    progress = sys.stderr if as_json else sys.stdout # with JSON, only the summary goes to STDOUT
+    if not path:
+        print("no access log to replay: give one with --log", file=progress)
+        return 1
+    entries = read_log(path)
+    if not entries:
+        print("no requests in %s" % path, file=progress)
+        return 1
+    print("replaying %d requests from %s against %s (%s, %d at a time)" % (
+        len(entries), path, url, "speed x%g" % speed if speed else "as fast as possible", concurrency), file=progress)
+    (results, seconds) = replay(entries, url, speed, concurrency)
+    report = summary(results)
+    if as_json:
+        print(json.dumps(dict(seconds=seconds, apps=report)))
+    else:
+        print_summary(report, seconds)
+    return 0
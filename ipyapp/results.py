@@ -0,0 +1,139 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Compact JSON results of a notebook app, for `--output` and the app server's `?output=`.
+
+    An output spec is a comma separated list of variable names and cell tags, e.g. "total,#plot".
+    Variables are read from the kernel namespace once the notebook has run, tagged outputs are the
+    outputs of the code cells with that tag in their `tags` metadata:
+
+        {"total": 42, "#plot": [{"png": "iVBORw0..."}]}
+
+    Large arrays and DataFrames can be returned in a binary format instead (see BINARY_FORMATS).
+    The kernel then writes each variable to a file of its own and only the file locations come back,
+    as JSON, so the data never passes through the notebook JSON:
+
+        {"df": {"path": "/tmp/ipyapp-Xy12/df.arrows", "format": "arrow", "bytes": 80123}}
+
+    `dumps` and `dump_files` run inside the kernel, so this module only uses the standard library
+    (numpy, pandas and pyarrow are imported when a binary format needs them).
+"""
+
+import json
+import os
+import shutil
+import tempfile
+
+MIME_KEYS = ('text', 'html', 'png', 'jpeg', 'svg', 'latex', 'json', 'javascript') # runipy's output keys
+
+BINARY_FORMATS = { # format -> (mimetype, file extension)
+    'npy':     ('application/x-npy',                   '.npy'),
+    'arrow':   ('application/vnd.apache.arrow.stream', '.arrows'),
+    'parquet': ('application/vnd.apache.parquet',      '.parquet'),
+}
+
+def parse_output(spec):
+    " (variable names, cell tags) from an output spec "
+    items = [item.strip() for item in spec.split(',') if item.strip()]
+    return ([item for item in items if not item.startswith('#')],
+            [item[1:] for item in items if item.startswith('#')])
+
+def to_json(value):
+    " JSON-able form of values the json module can't handle: numpy, pandas, dates, sets "
+    if hasattr(value, 'columns') and hasattr(value, 'to_dict'): # pandas DataFrame
+        return value.to_dict(orient='split')
+    if hasattr(value, 'index') and hasattr(value, 'to_dict'):   # pandas Series
+        return dict(name=value.name, index=list(value.index), data=list(value))
+    if hasattr(value, 'tolist'):                                 # numpy arrays and scalars
+        return value.tolist()
+    if hasattr(value, 'isoformat'):                              # dates and times
+        return value.isoformat()
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    if isinstance(value, complex):
+        return [value.real, value.imag]
+    return repr(value)
+
+def dumps(names, namespace):
+    " JSON text of the variables `names` that are defined in `namespace` "
+    return json.dumps(dict((name, namespace[name]) for name in names if name in namespace),
+                      default=to_json, separators=(',', ':'))
+
+def compact(output):
+    " a cell output without the notebook bookkeeping "
+    kind = output['output_type']
+    if kind == 'stream':
+        return dict(stream=output.get('stream'), text=output.get('text', ''))
+    if kind == 'pyerr':
+        return dict(error=output.get('ename'), message=output.get('evalue'))
+    return dict((key, value) for key, value in output.items() if key in MIME_KEYS)
+
+def is_binary(format):
+    return bool(format) and format.lower() in BINARY_FORMATS
+
+def format_for(mimetype):
+    " the binary format with `mimetype`, or None "
+    for format, (mime, ext) in BINARY_FORMATS.items():
+        if mime == mimetype:
+            return format
+    return None
+
+def _frame(value, name):
+    " a pandas DataFrame holding `value` "
+    import pandas
+    if isinstance(value, pandas.DataFrame):
+        return value
+    if isinstance(value, pandas.Series):
+        return value.to_frame(name=value.name if value.name is not None else name)
+    import numpy
+    value = numpy.asarray(value)
+    return pandas.DataFrame(value if value.ndim > 1 else {name: value})
+
+def _table(value, name):
+    " a pyarrow Table holding `value` "
+    import pyarrow
+    if isinstance(value, pyarrow.Table):
+        return value
+    return pyarrow.Table.from_pandas(_frame(value, name))
+
+def dump_file(value, path, format, name):
+    " write `value` to `path` in binary `format` "
+    if format == 'npy':
+        import numpy
+        if hasattr(value, 'to_records'): # pandas: keep the column names in a record array
+            value = value.to_records(index=False)
+        numpy.save(path, numpy.asarray(value), allow_pickle=False)
+    elif format == 'arrow':
+        import pyarrow
+        table = _table(value, name)
+        with pyarrow.OSFile(path, 'wb') as sink:
+            writer = pyarrow.RecordBatchStreamWriter(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+    elif format == 'parquet':
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(_table(value, name), path)
+    else:
+        raise ValueError('Unsupported binary format "%s"' % format)
+
+def dump_files(names, namespace, format):
+    """ JSON text locating the variables `names` that are defined in `namespace`, each written to a
+        file in binary `format`, in a new temporary directory
+    """
+    directory = tempfile.mkdtemp(prefix='ipyapp-')
+    ext   = BINARY_FORMATS[format][1]
+    files = {}
+    for name in names:
+        if name in namespace:
+            path = os.path.join(directory, name + ext)
+            dump_file(namespace[name], path, format, name)
+            files[name] = dict(path=path, format=format, bytes=os.path.getsize(path))
+    return json.dumps(files, separators=(',', ':'))
+
+def remove_files(files):
+    " remove the temporary files of a binary result (the dict from `dump_files`) "
+    for info in files.values():
+        shutil.rmtree(os.path.dirname(info['path']), ignore_errors=True)
@@ -0,0 +1,113 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Admission control for notebook app executions in the app server.
+
+    Every execution needs a slot.  Slots are limited globally and, for apps that set `concurrency`
+    in their meta data, per app.  Requests that can't run yet wait in one of two bounded lanes,
+    "interactive" (browser requests) ahead of "batch" (background jobs), first come first served
+    within a lane.  When a lane is full, or a request waits too long, it is turned away at once with
+    SchedulerBusy so the server can answer 503 instead of piling up processes.
+"""
+
+import contextlib
+import threading
+import time
+
+from collections import deque
+
+from ipyapp.config import MAX_RUNNING, QUEUE_INTERACTIVE, QUEUE_BATCH, QUEUE_WAIT, RETRY_AFTER
+
+LANES = ('interactive', 'batch') # in priority order
+
+class SchedulerBusy(Exception):
+    " No execution slot is available: the wait queue is full or the wait timed out "
+
+    def __init__(self, message, retry_after=RETRY_AFTER):
+        super(SchedulerBusy, self).__init__(message)
+        self.retry_after = retry_after
+
+class Waiter(object):
+    def __init__(self, app, cap):
+        self.app = app
+        self.cap = cap
+
+class Scheduler(object):
+    " execution slots, with a global limit, optional per-app limits and prioritized wait lanes "
+
+    def __init__(self, limit=MAX_RUNNING, interactive=QUEUE_INTERACTIVE, batch=QUEUE_BATCH,
+                 wait=QUEUE_WAIT, retry_after=RETRY_AFTER):
+        self.limit       = limit
+        self.queue_size  = dict(interactive=interactive, batch=batch)
+        self.wait        = wait
+        self.retry_after = retry_after
+        self.running     = 0
+        self.per_app     = {}  # app name -> running executions
+        self.waiting     = dict((lane, deque()) for lane in LANES)
+        self.cond        = threading.Condition()
+
+    def _fits(self, waiter):
+        return (self.running < self.limit and
+                (not waiter.cap or self.per_app.get(waiter.app, 0) < waiter.cap))
+
+    def _next(self):
+        " the waiter that gets the next free slot: the first one that fits, by lane priority then age "
+        for lane in LANES:
+            for waiter in self.waiting[lane]:
+                if self._fits(waiter):
+                    return waiter
+        return None
+
+    def acquire(self, app, cap=None, lane='interactive', wait=-1):
+        """ take an execution slot for `app` (at most `cap` at a time, if given), waiting up to `wait`
+            seconds for one (default: the scheduler's, None: forever); pair with `release(app)`
+        """
+        wait   = self.wait if wait == -1 else wait
+        waiter = Waiter(app, cap)
+        with self.cond:
+            queue = self.waiting[lane]
+            if len(queue) >= self.queue_size[lane]:
+                raise SchedulerBusy('Server busy: %s %s requests already waiting' % (len(queue), lane),
+                                    self.retry_after)
+            queue.append(waiter)
+            deadline = None if wait is None else time.time() + wait
+            try:
+                while self._next() is not waiter:
+                    remaining = None if deadline is None else deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        raise SchedulerBusy('Server busy: no execution slot for [%s] after %s seconds' % (app, wait),
+                                            self.retry_after)
+                    self.cond.wait(remaining)
+            except Exception:
+                queue.remove(waiter)
+                self.cond.notify_all() # we may have been holding up the waiters behind us
+                raise
+            queue.remove(waiter)
+
+            self.running += 1
+            self.per_app[app] = self.per_app.get(app, 0) + 1
+            self.cond.notify_all() # there may be room for the next waiter too
+
+    def release(self, app):
+        with self.cond:
+            self.running -= 1
+            self.per_app[app] -= 1
+            if not self.per_app[app]:
+                del self.per_app[app]
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, app, cap=None, lane='interactive', wait=-1):
+        " hold an execution slot for `app` for the duration of the `with` block, see `acquire` "
+        self.acquire(app, cap, lane, wait)
+        try:
+            yield
+        finally:
+            self.release(app)
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self.waiting.values())
@@ -6,14 +6,16 @@
 # conda is distributed under the terms of the BSD 3-clause license.
 # Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
 
+import atexit
+import hashlib
 import json
 import os
+import signal
 import sys
+import time
 import multiprocessing as mp
 
 from os.path    import basename
-from functools  import partial
-from glob       import glob
 from logging    import info, debug
 from argparse   import RawDescriptionHelpFormatter
 
@@ -23,20 +25,36 @@ try:
 except ImportError:
     from io import StringIO
 
-from jinja2     import Environment, PackageLoader
-from flask      import Flask, request, redirect, render_template, abort, current_app
+from flask      import Flask, Response, request, redirect, render_template, abort, current_app, jsonify, url_for
+from flask      import escape, send_file, make_response, g, has_request_context
 from werkzeug.exceptions import BadRequestKeyError
+from werkzeug.wsgi       import ClosingIterator
 
 from IPython.nbformat.current             import reads_json as nb_read_json
-from IPython.nbconvert.exporters.html     import HTMLExporter
-from IPython.nbconvert.exporters.markdown import MarkdownExporter
-from IPython.nbconvert.exporters.python   import PythonExporter
 
 from ipyapp.execute import run, NotebookApp, NotebookAppFormatError, NotebookAppExecutionError, NotebookAppError
+from ipyapp.execute import KERNEL_TIMEOUT
+from ipyapp         import metrics
+from ipyapp.timing  import Timeline
+from ipyapp         import exporters
+from ipyapp.pool    import KernelPools
+from ipyapp.zygote  import zygotes
+from ipyapp.cache   import ResultCache
+from ipyapp.registry import AppRegistry
+from ipyapp.jobs    import JobQueue, JobQueueFull
+from ipyapp.scheduler import Scheduler, SchedulerBusy
+from ipyapp.results import BINARY_FORMATS, is_binary, format_for, parse_output, remove_files
+from ipyapp.store   import store
+from ipyapp.httputil import compressible, negotiate, encode, fingerprint
+from ipyapp.replay  import AccessLog
 from ipyapp.daemon  import Daemon
 from ipyapp.config  import DEBUG, PORT, HOST, PREFIX, PIDFILE, LOGFILE, ERRFILE, TIMEOUT, FORMAT, LOG_LEVEL, SECRET_KEY
+from ipyapp.config  import POOL_SIZE, POOL_RECYCLE, CACHE_SIZE, SEARCH, RETRY_AFTER, STORE, STORE_MAX_AGE
+from ipyapp.config  import COMPRESS_MIN, STATIC_MAX_AGE, METRICS, ACCESS_LOG, ZYGOTE
+from ipyapp.config  import WORKERS, WORKER_THREADS, WORKER_REQUESTS, WORKER_MEMORY, SHARED_DIR
 
 app = Flask(__name__, template_folder='templates')
+app.jinja_options = dict(app.jinja_options, bytecode_cache=exporters.bytecode_cache)
 app.debug = DEBUG # NOTE: app.debug = True will stop daemonizer from working!
 
 try:
@@ -47,6 +65,86 @@ except Exception:
     # I guess flask-debugtoolbar isn't installed, so just ignore this
     pass
 
+# execution slots shared by browser requests and background jobs
+scheduler = Scheduler()
+
+# background executions for the job API (job workers wait for a slot as long as it takes)
+jobs = JobQueue(lambda nba: run_job(nba), discard=lambda job: discard_result(job))
+
+# the notebook apps being served, indexed once and then kept up to date in the background
+apps = AppRegistry(SEARCH)
+
+# warm kernels per conda env, checked out by `runapp` (pools are started lazily, per env, on first use)
+pools = KernelPools(size=POOL_SIZE, recycle=POOL_RECYCLE) if POOL_SIZE else None
+if pools:
+    atexit.register(pools.close)
+
+# app runs fork their kernels from per-env zygotes, started on first use (see ipyapp.zygote)
+zygotes.start = ZYGOTE
+
+# executed notebooks, re-used for repeated requests with the same arguments
+results = ResultCache() if CACHE_SIZE else None
+
+# app requests, for `conda appserver replay` (see ipyapp.replay)
+access_log = AccessLog(ACCESS_LOG) if ACCESS_LOG else None
+
+metrics.gauge('ipyapp_executions_in_flight', 'Notebook app runs holding an execution slot', lambda: scheduler.running)
+metrics.gauge('ipyapp_kernels_live', 'Pooled kernels, busy or idle', lambda: pools.live if pools else 0)
+
+SERVER_TEMPLATE = "server_output.html"
+
+def share(directory):
+    " keep jobs and metrics in `directory` too, so each of several pre-forked workers serves them all "
+    jobs.share(os.path.join(directory, 'jobs'))
+    metrics.share(os.path.join(directory, 'metrics'))
+
+def worker_exit():
+    " what a pre-forked worker does once it has served its requests "
+    metrics.flush(force=True)
+    if pools:
+        pools.close()
+
+def warm():
+    " build the exporters and compile all templates before serving, so the first requests don't pay for it "
+    exporters.warm(templates=[SERVER_TEMPLATE, exporters.CELL_TEMPLATE])
+    for name in ("applist.html", "form.html", "server_status.html"):
+        app.jinja_env.get_template(name)
+    if STORE:
+        store.prune()
+
+@app.template_global()
+def static_url(filename):
+    " URL of a static file, fingerprinted by its content so browsers can keep it for good "
+    return url_for('static', filename=filename, v=fingerprint(os.path.join(app.static_folder, filename)))
+
+def static_urls():
+    " fingerprinted URLs of the static files used by the exporter templates (see `server_output.html`) "
+    return {name: static_url(name) for name in ('style.css', 'favicon.ico')}
+
+@app.after_request
+def http_caching(response):
+    " far-future caching for fingerprinted static files, compression for everything that benefits "
+    if request.endpoint == 'static' and 'v' in request.args:
+        response.cache_control.public  = True
+        response.cache_control.max_age = STATIC_MAX_AGE
+    return compress(response)
+
+def compress(response):
+    " `response` encoded with the best compression the client accepts, if it is worth compressing "
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+        or 'Content-Encoding' in response.headers or not compressible(response.mimetype)):
+        return response # files (already compressed, or sent as they are), streams, errors
+
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN:
+        return response
+    response.vary.add('Accept-Encoding')
+    coding = negotiate(request.headers.get('Accept-Encoding'))
+    if coding is not None:
+        response.set_data(encode(data, coding))
+        response.headers['Content-Encoding'] = coding
+    return response
+
 @app.route("/custom.css")
 @app.route("/ipyapp/custom.css")
 def custom_css():
@@ -55,13 +153,8 @@ def custom_css():
 @app.route("/")
 def applist():
     " generate list of all apps "
-    # TODO: for now this just lists .ipynb files in the current directory and one directory down
-    #       (and eventually "registered app directories")
-    apps = [nb.replace('.ipynb','') for nb in sorted(glob('*.ipynb'))]
-    apps.extend([nb.replace('.ipynb','') for nb in sorted(glob('*/*.ipynb'))])
-
-    basedir = os.path.abspath('.')
-    return render_template("applist.html", apps=apps, basedir=basedir)
+    # lists .ipynb files in each app directory and one directory down
+    return render_template("applist.html", apps=apps.names(), basedir=", ".join(apps.roots))
 
 if HOST == '127.0.0.1': # shutdown web option only available when running exclusively on localhost
     @app.route('/shutdown')
@@ -85,67 +178,89 @@ else:
 def favicon():
     return app.send_static_file('favicon.ico')
 
+if METRICS:
+    @app.route("/metrics")
+    def metrics_text():
+        " the server's metrics, for Prometheus to scrape "
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.after_request
+def record_metrics(response):
+    " add the phases of the app run behind this request to the metrics "
+    if getattr(g, 'timeline', None) is not None:
+        metrics.observe(g.app, g.timeline)
+    metrics.flush() # for the other workers, if there are any
+    return response
+
+@app.after_request
+def log_access(response):
+    " tell the client whether the result came from the result cache, and log the app request "
+    started = getattr(g, 'started', None)
+    if started is None: # not an app request
+        return response
+    cache = getattr(g, 'cache', None)
+    if cache in ('hit', 'miss'):
+        response.headers['X-Cache'] = cache.upper()
+    if access_log is not None:
+        access_log.write(time=started, method=request.method, path=request.path,
+                         app=getattr(g, 'app', None), args=request.values.to_dict(),
+                         status=response.status_code, seconds=round(time.time() - started, 6), cache=cache)
+    return response
+
+@app.route("/_store/<name>")
+def stored(name):
+    " an output from the content store: named by its content, so it never changes and browsers keep it "
+    try:
+        path = store.path(name)
+    except LookupError:
+        abort(404)
+    response = send_file(path, mimetype=store.mimetype(name), conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % STORE_MAX_AGE
+    return response
+
 def fetch_nb(nbname):
-    """Given the notebook name, find it locally and return the full path"""
-    nbpaths = [ nbname,
-                "%s.ipynb" % nbname, # local notebook file
-                "%s/%s.ipynb" % (nbname, nbname), # directory with same-name notebook in it
-                ]
-    for nbpath in nbpaths:
-        if os.path.exists(nbpath):
-            return nbpath
-
-    # if we haven't returned nbpath yet, raise a not found exception
-    raise LookupError('Notebook [%s] not found' % nbpath)
-
-# FIXME: Currently `nbname` could probably have relative or `..` paths that will access unintended files
+    """Given the notebook name, find it in the app registry and return the full path"""
+    return apps.lookup(nbname) # only indexed apps resolve, so `..` paths can't reach other files
+
 @app.route("/<path:nbname>", methods=['GET','POST'])
 def runapp(nbname):
 
     err = "" # initialize error string returned by notebook app invocation -- required for exception messages
+    nba = None
+    g.started = time.time()
+    timeline = Timeline()
     try:
-        nbpath = fetch_nb(nbname)
+        with timeline.phase('fetch'):
+            nbpath = fetch_nb(nbname)
     except LookupError as ex:
         return (render_template("server_status.html", message="Cannot locate notebook app: " + nbname),
                 404)
-
-    jinja_env = Environment(loader=PackageLoader('ipyapp', 'templates'))
-    status    = HTMLExporter(extra_loaders=[current_app.jinja_env.loader], template_file='server_status.html')
+    g.app      = basename(nbpath).replace('.ipynb', '')
+    g.timeline = timeline
 
     try:
 
-        options = dict(env=None, timeout=TIMEOUT, output=None, view=False, format=FORMAT)
-
-        if request.method == 'GET':
-            nbargs_dict = request.args.to_dict()
-        else:  # POST, so get from form
-            nbargs_dict = request.form.to_dict()
-
-        debug('options (before): %s' % options)
-        debug('nbargs_dict (before): %s' % nbargs_dict)
-
-        update_options_nbargs(options,nbargs_dict)
-
-        debug('options (before): %s' % options)
-        debug('nbargs_dict (before): %s' % nbargs_dict)
+        (options, nbargs_dict) = request_options()
 
         info("notebook arguments:" + str(nbargs_dict))
 
         if options['view']: # just view notebook, don't re-execute
             info("app view only")
-            nbtxt      = open(nbpath).read()
+            nb         = nb_read_json(open(nbpath).read())
             name       = basename(nbpath).replace('.ipynb', '')
 
         else:
             info("creating NotebookApp")
-            nba = NotebookApp(nbpath, template="server_output.html", **options)
+            with timeline.phase('parse'):
+                nba = NotebookApp(nbpath, template=SERVER_TEMPLATE, timeline=timeline, **options)
             name = nba.name
             info("nba.inputs: %s" % nba.inputs)
             info("nbargs_dict: %s" % nbargs_dict)
-            if len(nba.inputs) > 0 and len(nba.inputs) > len(nbargs_dict) and request.method == "GET":
+            if (len(nba.inputs) > 0 and len(nba.inputs) > len(nbargs_dict) and request.method == "GET"
+                and not options['output']): # API callers get an error instead
                 info("generate app form, since not enough inputs were provided")
-                singles = {k:v for k,v in nba.inputs.iteritems() if v != "para"}
-                multis = [k for k,v in nba.inputs.iteritems() if v == "para"]
+                singles = {k:v for k,v in nba.inputs.items() if v != "para"}
+                multis = [k for k,v in nba.inputs.items() if v == "para"]
                 return (render_template("form.html", nbapp=nba.name, desc=nba.desc,
                     params=sorted(singles.items()),
                     multiline=sorted(multis),
@@ -153,48 +268,279 @@ def runapp(nbname):
                     200)
             else:
                 nba.set_nbargs(**nbargs_dict)
-                (nbtxt, err)  = nba.startapp()
+                etag = run_etag(nba, options)
+                if etag and request.if_none_match.contains_weak(etag): # the client has this result
+                    g.cache = 'etag'
+                    return validated(Response(status=304), etag)
+                if nba.output: # just the requested values, as JSON or a binary file: no export
+                    check_binary(nba)
+                    (result, err) = execute(nba)
+                    with timeline.phase('render'):
+                        return validated(output_result(result, nba.format), etag)
+                if options['stream'] or 'text/event-stream' in request.headers.get('Accept', ''):
+                    return stream_app(nba, options['format'], options['inline'])
+                (nb, err)  = execute(nba)
+                with timeline.phase('render'):
+                    page = render_result(nb, options['format'], name, options['inline'])
+                return validated(make_response(page), etag)
+
+        return (render_result(nb, options['format'], name, options['inline']), 200)
 
-        if options['format']=='html':
-            Exporter = partial(HTMLExporter,
-                               extra_loaders=[current_app.jinja_env.loader],
-                               template_file="server_output.html")
-        elif options['format']=='md' or options['format']=='markdown':
-            Exporter = MarkdownExporter
-        elif options['format']=='py' or options['format']=='python':
-            Exporter = PythonExporter
-        exporter = Exporter()
+    except Exception as ex:
+        return run_failure(ex, nbpath, nba, err)
 
-        nb_obj = nb_read_json(nbtxt)
-        html, resources = exporter.from_notebook_node(nb_obj, resources=dict(nbapp=name))
+def run_failure(ex, nbpath, nba, err):
+    " error response for exception `ex` from running the app at `nbpath` (NotebookApp `nba`, once created) "
+    if isinstance(ex, (IOError, ValueError, NotebookAppFormatError)):
+        return failure("Notebook App [%s] invalid file" % nbpath, ex, err, 501)
+    if isinstance(ex, (BadRequestKeyError, KeyError, TypeError)):
+        # TODO: tighten this up so invalid inputs are caught in a way that nba.name can be used
+        return failure("Notebook App [%s] invalid inputs" % nbpath, ex, err, 400)
+    if isinstance(ex, SchedulerBusy):
+        return failure('Notebook App [%s] not run: server busy, try again shortly' % nbpath, ex, err, 503,
+                       {'Retry-After': str(ex.retry_after)})
+    if isinstance(ex, NotebookAppExecutionError):
+        return failure('Notebook App [%s] failed to run' % nba.name, ex, err, 400)
+    return failure('Notebook App [%s] unknown error' % nbpath, ex, err, 400)
+
+def failure(message, exception, error, status, headers=None):
+    " error response for `runapp`: JSON for API requests (those asking for `output`), otherwise a page "
+    metrics.error(g.app, exception)
+    if request.values.get('output'):
+        body = jsonify(error=message, exception=str(exception), stderr=error)
+    else:
+        body = render_template("server_status.html", message=message, exception=exception, error=error)
+    return (body, status, headers or {})
+
+def run_etag(nba, options):
+    """ ETag for the response to running `nba` with `options`: the same notebook version, arguments and
+        rendering give the same response.  None where a response can't be re-used: POSTs, streams,
+        binary results and apps that opt out of caching.
+    """
+    if (request.method != 'GET' or not nba.cacheable or options['stream']
+        or 'text/event-stream' in request.headers.get('Accept', '') or (nba.output and is_binary(nba.format))):
+        return None
+    templates = [fingerprint(os.path.join(app.root_path, 'templates', name))
+                 for name in (SERVER_TEMPLATE, exporters.CELL_TEMPLATE)]
+    key = json.dumps([ResultCache.key(nba), options['format'], options['inline'], templates])
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def validated(response, etag):
+    " `response` with `etag` if there is one, for the browser to revalidate on every use "
+    if etag:
+        response.set_etag(etag, weak=True) # weak: the bytes differ with the content encoding
+        response.cache_control.no_cache = True
+    return response
+
+def check_binary(nba):
+    " a binary result is a single variable's file: reject other `output` specs before running the app "
+    if is_binary(nba.format):
+        names, tags = parse_output(nba.output)
+        if len(names) != 1 or tags:
+            raise TypeError('Binary format %s returns exactly one variable, not "%s"' % (nba.format, nba.output))
+
+def output_result(result, format=None, keep=False):
+    """ the result of a NotebookApp run with `output` (a failed one raised instead), as an API response:
+        its values as JSON, or the file holding the variable for a binary `format`, which is removed
+        once sent unless `keep`
+    """
+    if not is_binary(format):
+        return Response(json.dumps(result, separators=(',', ':')), mimetype='application/json')
+
+    files = result
+    if len(files) != 1:
+        raise NotebookAppExecutionError('Notebook App returned %s variables, not one' % len(files))
+    (var, info), = files.items()
+    mimetype, ext = BINARY_FORMATS[info['format']]
+    response = send_file(info['path'], mimetype=mimetype, as_attachment=True, attachment_filename=var + ext)
+    if not keep:
+        response.call_on_close(lambda: remove_files(files))
+    return response
+
+def discard_result(job):
+    " remove the files of a forgotten job's binary result "
+    if job.status == 'done' and job.nba.output and is_binary(job.nba.format):
+        remove_files(job.result[0])
+
+def request_options():
+    " split the request arguments into server options and notebook app arguments "
+    options = dict(env=None, timeout=TIMEOUT, output=None, view=False, format=FORMAT, stream=False, inline=False,
+                   profile_cells=False)
+
+    if request.method == 'GET':
+        nbargs_dict = request.args.to_dict()
+    else:  # POST, so get from form
+        nbargs_dict = request.form.to_dict()
+
+    debug('options (before): %s' % options)
+    debug('nbargs_dict (before): %s' % nbargs_dict)
+
+    update_options_nbargs(options,nbargs_dict)
+
+    if options['output'] and 'format' not in request.values: # pick a binary format by the Accept header
+        best = request.accept_mimetypes.best_match(['application/json'] +
+                                                   [mime for mime, ext in BINARY_FORMATS.values()])
+        options['format'] = format_for(best) or options['format']
+
+    debug('options (after): %s' % options)
+    debug('nbargs_dict (after): %s' % nbargs_dict)
+
+    return (options, nbargs_dict)
+
+def render_result(nb, format, name, inline=False):
+    """ export an executed notebook (a NotebookNode) in the requested format; HTML references its heavy
+        outputs in the content store unless `inline`
+    """
+    exporter = exporters.get_exporter(format, SERVER_TEMPLATE)
+
+    if format.lower() == 'html' and not inline:
+        nb = externalize(nb)
+    result, resources = exporter.from_notebook_node(nb, resources=dict(nbapp=name, static=static_urls()))
+    return result
+
+def externalize(cell_nb, html=True):
+    " `cell_nb` with its heavy outputs moved to the content store (see `ipyapp.store`), if enabled "
+    if not STORE:
+        return cell_nb
+    return store.externalize(cell_nb, lambda name: url_for('stored', name=name), html=html)
+
+def stream_app(nba, format, inline=False):
+    """ run a NotebookApp and send each cell to the client as soon as it has run: as Server-Sent Events
+        if the client accepts `text/event-stream`, otherwise as a chunked page in the requested format
+        (HTML outputs in the content store unless `inline`)
+    """
+    exporters.get_exporter(format) # reject unsupported formats before anything is sent
+    scheduler.acquire(nba.name, nba.concurrency) # a busy server still answers 503
+    metrics.executions.inc(app=nba.name)
+    release = lambda: scheduler.release(nba.name)
+
+    cell_nbs = run = nba.iterapp()
+    if format.lower() == 'html' and not inline:
+        # SSE clients insert the cells themselves, so only images (which need no script) leave the page
+        html = 'text/event-stream' not in request.headers.get('Accept', '')
+        cell_nbs = (externalize(cell_nb, html) for cell_nb in cell_nbs)
+
+    if 'text/event-stream' in request.headers.get('Accept', ''):
+        body     = server_sent_events(cell_nbs, exporters.get_exporter(format, exporters.CELL_TEMPLATE), nba.name)
+        mimetype = 'text/event-stream'
+    else:
+        body     = exporters.export_stream(cell_nbs, format, SERVER_TEMPLATE, nba.name, on_error=stream_error,
+                                           resources=dict(static=static_urls()))
+        mimetype = 'text/html' if format == 'html' else 'text/plain'
+
+    # closing the run stops its child if the client went away mid-stream
+    return Response(ClosingIterator(body, [run.close, release]), mimetype=mimetype,
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+def server_sent_events(cell_nbs, exporter, name):
+    " one `cell` event per executed cell (its index and rendered output), then `done` or `error` "
+    try:
+        for index, cell_nb in enumerate(cell_nbs):
+            output, resources = exporter.from_notebook_node(cell_nb, resources=dict(nbapp=name))
+            yield "event: cell\ndata: %s\n\n" % json.dumps(dict(index=index, output=output))
+    except Exception as ex:
+        yield "event: error\ndata: %s\n\n" % json.dumps(dict(type=type(ex).__name__, message=str(ex)))
+    else:
+        yield "event: done\ndata: {}\n\n"
+
+def stream_error(ex):
+    " rendered in place of the remaining cells when a streamed notebook app fails "
+    return '<div class="stream-error"><h3>Notebook App failed to run</h3><pre>%s</pre></div>' % escape(str(ex))
 
-        return (html, 200)
+@app.route("/jobs/<path:nbname>", methods=['POST'])
+def submit_job(nbname):
+    " run a notebook app in the background: returns the job id and where to poll for it right away "
+    try:
+        nbpath = fetch_nb(nbname)
+    except LookupError as ex:
+        return (jsonify(error="Cannot locate notebook app: " + nbname), 404)
 
+    try:
+        (options, nbargs_dict) = request_options()
+        options['view'] = False
+        nba = NotebookApp(nbpath, template=SERVER_TEMPLATE, **options)
+        nba.set_nbargs(**nbargs_dict)
+        check_binary(nba)
+        job = jobs.submit(nba)
+    except JobQueueFull as ex:
+        return (jsonify(error=str(ex)), 503, {'Retry-After': str(RETRY_AFTER)})
     except (IOError, ValueError, NotebookAppFormatError) as ex:
-        return (render_template("server_status.html",
-                                message="Notebook App [%s] invalid file" % nbpath,
-                                exception=ex,
-                                error=err),
-                501)
-    except (BadRequestKeyError, KeyError, ValueError, TypeError) as ex:
-        # TODO: tighten this up so invalid inputs are caught in a way that nba.name can be used
-        return (render_template("server_status.html",
-                                message="Notebook App [%s] invalid inputs" % nbpath,
-                                exception=ex,
-                                error=err),
-                400)
+        return (jsonify(error="Notebook App [%s] invalid file: %s" % (nbname, ex)), 501)
+    except (BadRequestKeyError, KeyError, TypeError) as ex:
+        return (jsonify(error="Notebook App [%s] invalid inputs: %s" % (nbname, ex)), 400)
+
+    status_url = url_for('job_status', job_id=job.id)
+    result_url = url_for('job_result', job_id=job.id)
+    return (jsonify(status_url=status_url, result_url=result_url, **job.to_dict()),
+            202,
+            {'Location': status_url})
+
+@app.route("/jobs/<job_id>")
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return (jsonify(error="Unknown or expired job: " + job_id), 404)
+    return (jsonify(result_url=url_for('job_result', job_id=job.id), **job.to_dict()), 200)
+
+@app.route("/jobs/<job_id>/result")
+def job_result(job_id):
+    " the executed notebook of a finished job, in any supported format (`?format=html|md|py`) "
+    job = jobs.get(job_id)
+    if job is None:
+        return (jsonify(error="Unknown or expired job: " + job_id), 404)
+    if job.status == 'failed':
+        return (jsonify(**job.to_dict()), 400)
+    if not job.done:
+        return (jsonify(**job.to_dict()), 202)
+
+    try:
+        if job.nba.output:
+            return output_result(job.result[0], job.nba.format, keep=True)
+        return (render_result(job.result[0], request.args.get('format', job.nba.format), job.nba.name,
+                              bool(request.args.get('inline'))), 200)
     except NotebookAppExecutionError as ex:
-        return (render_template("server_status.html",
-                                message='Notebook App [%s] failed to run' % nba.name,
-                                exception=ex,
-                                error=err),
-                400)
+        return (jsonify(error=str(ex)), 400)
+    except TypeError as ex: # unsupported format
+        return (jsonify(error=str(ex)), 400)
+
+def run_job(nba):
+    " run a background job's NotebookApp: job workers wait for a slot as long as it takes "
+    try:
+        return execute(nba, lane='batch', wait=None)
     except Exception as ex:
-        return (render_template("server_status.html",
-                                message='Notebook App [%s] unknown error' % nbpath,
-                                exception=ex,
-                                error=err),
-                400)
+        metrics.error(nba.name, ex)
+        raise
+    finally:
+        metrics.observe(nba.name, nba.timeline)
+        metrics.flush()
+
+def execute(nba, lane='interactive', wait=-1):
+    """ run a NotebookApp once it gets an execution slot, answering from the result cache when the app
+        allows it; raises SchedulerBusy if the server is too busy to run it
+    """
+    cacheable = results is not None and nba.cacheable and not (nba.output and is_binary(nba.format))
+    if cacheable: # (binary results are files, removed once sent)
+        result = results.get(nba)
+        if result is not None:
+            info("notebook app [%s] served from result cache" % nba.name)
+            metrics.cache_hits.inc(app=nba.name)
+            if has_request_context(): # (not for background jobs)
+                g.cache = 'hit'
+            return result
+
+    waiting = time.time()
+    with scheduler.slot(nba.name, nba.concurrency, lane, wait):
+        nba.timeline.add('queue', waiting, time.time() - waiting)
+        metrics.executions.inc(app=nba.name)
+        result = nba.startapp(pool=pools)
+    if KERNEL_TIMEOUT in result[1]: # the kernel gave up on a cell: reported, not raised
+        metrics.timeouts.inc(app=nba.name)
+
+    if cacheable and not nba.failed: # don't keep error reports (warnings on STDERR are fine)
+        results.put(nba, result)
+        if has_request_context():
+            g.cache = 'miss'
+    return result
 
 
 def update_options_nbargs(options, rest_dict):
@@ -204,13 +550,19 @@ def update_options_nbargs(options, rest_dict):
     if 'view' in rest_dict:
         options['view'] = bool(rest_dict['view'])
     if 'format' in rest_dict:
-        options['view'] = rest_dict['format']
+        options['format'] = rest_dict['format']
     if 'output' in rest_dict:
         options['output'] = rest_dict['output']
     if 'env' in rest_dict:
         options['env'] = rest_dict['env']
-
-    for key in "timeout view env output format".split():
+    if 'stream' in rest_dict:
+        options['stream'] = bool(rest_dict['stream'])
+    if 'inline' in rest_dict:
+        options['inline'] = bool(rest_dict['inline'])
+    if 'profile_cells' in rest_dict:
+        options['profile_cells'] = bool(rest_dict['profile_cells'])
+
+    for key in "timeout view env output format stream inline profile_cells".split():
         if key in rest_dict:
             del rest_dict[key]
 
@@ -243,6 +595,16 @@ class AppServerDaemon(Daemon):
             logging.basicConfig(stream=self.stdout,level=self.loglevel)
 
         try:
+            if self.workers: # pre-forked worker processes (see ipyapp.prefork)
+                from ipyapp.prefork import serve_prefork
+                if self.workers > 1: # before forking, so every worker shares them
+                    share(os.path.join(SHARED_DIR, str(self.port)))
+                warm() # before forking: the workers share the compiled templates
+                serve_prefork(app, self.host, self.port, self.workers, self.threads, self.max_requests,
+                              self.max_memory, setup=apps.watch, teardown=worker_exit)
+                return
+            apps.watch()
+            warm()
             # daemonization doesn't work if relodader=True (default if debug=True)
             app.run(debug=debug, use_reloader=False, port=self.port)
         except Exception as ex:
@@ -272,17 +634,83 @@ def server_parser():
         default=HOST,
         help="set the app server ip",
     )
+    p.add_argument(
+        "-s", "--search",
+        action="append",
+        help="directory to serve notebook apps from, may be repeated (default: %s)" % " ".join(SEARCH),
+    )
+    p.add_argument(
+        "-w", "--workers",
+        type=int,
+        default=WORKERS,
+        help="serve from this many pre-forked worker processes, 0 for the single process development server (default: %(default)s)",
+    )
+    p.add_argument(
+        "--threads",
+        type=int,
+        default=WORKER_THREADS,
+        help="with --workers: requests served at once by each worker (default: %(default)s)",
+    )
+    p.add_argument(
+        "--max-requests",
+        type=int,
+        default=WORKER_REQUESTS,
+        help="with --workers: replace a worker after this many requests, 0 for never (default: %(default)s)",
+    )
+    p.add_argument(
+        "--max-memory",
+        type=int,
+        default=WORKER_MEMORY // (1024 * 1024),
+        help="with --workers: replace a worker once it uses this many MB, 0 for never (default: %(default)s)",
+    )
+    p.add_argument(
+        "--log",
+        default=ACCESS_LOG,
+        help="log each app request, with its arguments, to this file (default: %(default)s); with replay: the log to replay",
+    )
+    p.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="with replay: send the requests this many times as fast as they came in, 0 for as fast as possible (default: %(default)s)",
+    )
+    p.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="with replay: requests in flight at most (default: %(default)s)",
+    )
+    p.add_argument(
+        "--url",
+        help="with replay: the app server to send the requests to (default: the one at --host and --port)",
+    )
+    p.add_argument(
+        "--json",
+        action="store_true",
+        default=False,
+        help="with replay: print the summary as JSON",
+    )
     p.add_argument(
         "action",
         default="start",
-        help="specify server action: daemon|start|stop|restart",
+        help="specify server action: daemon|start|stop|restart|reload|status|replay",
     )
     p.set_defaults(func=startserver)
 
     return p
 
-def serve(host=HOST, port=PORT, action='start', open_web=True):
-    " control the server process: start, daemonize, stop, restart, depending on action "
+def serve(host=HOST, port=PORT, action='start', open_web=True, search=None, workers=WORKERS,
+          threads=WORKER_THREADS, max_requests=WORKER_REQUESTS, max_memory=WORKER_MEMORY, log=ACCESS_LOG):
+    """ control the server process: start, daemonize, stop, restart, reload, depending on action; with
+        `workers`, requests are served by that many pre-forked processes of `threads` threads each, and
+        with `log`, app requests are logged to that file (see ipyapp.replay)
+    """
+    global access_log
+
+    if search:
+        apps.roots = [os.path.abspath(root) for root in search]
+    if log:
+        access_log = AccessLog(os.path.abspath(log))
 
     # TODO: stdout/stderr redirection to files is not working properly
     server = AppServerDaemon(pidfile=PIDFILE, stdout=LOGFILE, stderr=ERRFILE)
@@ -290,6 +718,10 @@ def serve(host=HOST, port=PORT, action='start', open_web=True):
     # TODO: this should be part of __init__, but pulled it for debugging
     server.host = host
     server.port = port
+    server.workers      = workers
+    server.threads      = threads
+    server.max_requests = max_requests
+    server.max_memory   = max_memory
 
     server_url = "http://{host}:{port}".format(host=host, port=port)
     print("server: %s" % server_url)
@@ -316,6 +748,12 @@ def serve(host=HOST, port=PORT, action='start', open_web=True):
     elif action == "restart":
         print("restarting background app server")
         server.restart()
+    elif action == "reload": # new workers take over once the old ones have finished their requests
+        if server.running:
+            print("replacing the workers of app server PID [%s]" % server.pid)
+            os.kill(server.pid, signal.SIGHUP)
+        else:
+            print("app server is not running")
     elif action == "status":
         if server.running:
             print("app server is running: PID [%s]" % server.pid)
@@ -324,7 +762,12 @@ def serve(host=HOST, port=PORT, action='start', open_web=True):
 
 def startserver():
     args = server_parser().parse_args()
-    serve(port=args.port, action=args.action)
+    if args.action == "replay":
+        from ipyapp.replay import replay_log
+        url = args.url or "http://{host}:{port}".format(host=args.host, port=args.port)
+        return replay_log(args.log, url.rstrip('/'), args.speed, args.concurrency, args.json)
+    serve(port=args.port, action=args.action, search=args.search, workers=args.workers, threads=args.threads,
+          max_requests=args.max_requests, max_memory=args.max_memory * 1024 * 1024, log=args.log)
 
 if __name__ == "__main__":
     startserver()
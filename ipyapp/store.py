@@ -0,0 +1,123 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Content-addressed store for the heavy outputs of executed notebooks.
+
+    The app server moves images and large HTML outputs out of the pages it renders and into files
+    named by the hash of their content, which it serves with long-lived `immutable` cache headers.
+    A page then only holds URLs: it is smaller (no base64), and an output that comes out the same
+    on every run is downloaded once per browser, however often the app is run or viewed.
+"""
+
+import base64
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+
+from IPython.nbformat.current import NotebookNode
+
+from ipyapp.config import STORE_DIR, STORE_MIN, STORE_TTL, LOG_LEVEL
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+NAME = re.compile(r'^[0-9a-f]{40}\.(png|jpg|svg|html)$')
+
+# output key -> (file extension, base64 encoded)
+STORED = {
+    'png':  ('.png',  True),
+    'jpeg': ('.jpg',  True),
+    'svg':  ('.svg',  False),
+    'html': ('.html', False),
+}
+
+MIMETYPES = {'.png': 'image/png', '.jpg': 'image/jpeg', '.svg': 'image/svg+xml', '.html': 'text/html'}
+
+class ContentStore(object):
+    " Files named by the SHA1 of their content, in `directory` "
+
+    def __init__(self, directory=STORE_DIR):
+        self.directory = directory
+
+    def put(self, data, ext):
+        " store bytes `data`, return its name "
+        name = hashlib.sha1(data).hexdigest() + ext
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            os.utime(path, None) # still in use: keep it from being pruned
+            return name
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(tmp, path) # atomic: a concurrent reader never sees half a file
+        return name
+
+    def path(self, name):
+        " path of the stored file `name`; LookupError if there is no such file "
+        path = os.path.join(self.directory, name)
+        if not NAME.match(name) or not os.path.isfile(path):
+            raise LookupError('No stored output %s' % name)
+        return path
+
+    @staticmethod
+    def mimetype(name):
+        return MIMETYPES[os.path.splitext(name)[1]]
+
+    def prune(self, ttl=STORE_TTL):
+        " remove files that were not stored or rendered in the last `ttl` seconds "
+        if not os.path.isdir(self.directory):
+            return
+        expired = time.time() - ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                pass # removed meanwhile
+
+    def externalize(self, nb, url, min_bytes=STORE_MIN, html=True):
+        """ copy of executed notebook `nb` with its rich outputs of at least `min_bytes` moved into the
+            store, each replaced by its URL, `url(name)`: images as the `<key>_filename` nbconvert uses
+            for extracted outputs, HTML (only if `html`) as `html_url`.  `nb` itself is not changed.
+        """
+        keys = [key for key in STORED if html or key != 'html']
+
+        def output(out):
+            moved = None
+            for key in keys:
+                if len(out.get(key) or '') >= min_bytes:
+                    ext, encoded = STORED[key]
+                    data = base64.b64decode(out[key]) if encoded else out[key].encode('utf-8')
+                    try:
+                        name = self.put(data, ext)
+                    except (IOError, OSError) as ex:
+                        log.warn('output stays inline, cannot write to store %s: %s' % (self.directory, ex))
+                        continue
+                    moved = moved or NotebookNode(out)
+                    moved[key + ('_url' if key == 'html' else '_filename')] = url(name)
+                    moved[key] = '' # the key stays: it selects how the output is rendered
+            return moved or out
+
+        def cell(cell):
+            if not cell.get('outputs'):
+                return cell
+            cell = NotebookNode(cell)
+            cell['outputs'] = [output(out) for out in cell['outputs']]
+            return cell
+
+        nb = NotebookNode(nb)
+        nb['worksheets'] = [NotebookNode(ws, cells=[cell(c) for c in ws['cells']]) for ws in nb['worksheets']]
+        return nb
+
+# the app server's store
+store = ContentStore()
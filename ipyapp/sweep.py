@@ -0,0 +1,207 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Parameter sweeps: run one notebook app over many argument sets, in parallel.
+
+    Argument sets come from a CSV file (one column per input), a JSONL file (one object per line), a
+    JSON file (a list of objects, or a grid spec mapping each input to a list of values, of which every
+    combination is run) or from comma separated values on the command line.  They are spread over a
+    pool of warm kernels (see ipyapp.pool), one per core by default.
+
+    The code cells after the input cell, up to the first one that uses an input, don't depend on the
+    arguments: they run once per kernel, and before each argument set the kernel namespace is rolled
+    back to what it was right after them.  Objects they create are shared by the runs in a kernel, so
+    later cells should rebind them rather than change them in place.
+
+    Each result is written to <app>-sweep/NNNN.<format>, with a summary in <app>-sweep/index.json.
+"""
+
+import copy
+import csv
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+import tokenize
+
+from multiprocessing.pool import ThreadPool
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from ipyapp.cache     import nb_view
+from ipyapp.config    import FORMAT, TEMPLATE, LOG_LEVEL
+from ipyapp.execute   import ANSI_ESCAPE, NotebookAppExecutionError, err2exception
+from ipyapp.exporters import get_exporter
+from ipyapp.pool      import KernelPool
+from ipyapp.transport import apply_reply, failed, strip_outputs
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+EXTENSIONS = dict(html='html', md='md', markdown='md', py='py', python='py')
+
+# run after the setup cells: remember the namespace, and define how to get back to it
+SNAPSHOT_CELL = """def __sweep_restore(saved=dict(globals()), namespace=globals()):
+    for name in [name for name in namespace if name not in saved and name != '__sweep_restore']:
+        del namespace[name]
+    namespace.update(saved)
+"""
+RESTORE_CELL = "__sweep_restore()"
+
+class SweepSetupError(NotebookAppExecutionError):
+    " The setup cells of a swept notebook app failed, so none of its runs can succeed "
+    pass
+
+def read_argsets(path):
+    " argument sets from a .csv, .jsonl or .json file "
+    ext = os.path.splitext(path)[1].lower()
+    with open(path) as f:
+        if ext == '.csv':
+            return [dict(row) for row in csv.DictReader(f)]
+        elif ext == '.jsonl':
+            return [json.loads(line) for line in f if line.strip()]
+        elif ext == '.json':
+            spec = json.load(f)
+            return grid(spec) if isinstance(spec, dict) else spec
+    raise TypeError('Unsupported sweep file "%s", use a .csv, .jsonl or .json file' % path)
+
+def grid(spec):
+    " every combination of the values in `spec`, a dict of input name -> list of values "
+    names  = sorted(spec)
+    values = [spec[name] if isinstance(spec[name], list) else [spec[name]] for name in names]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+def grid_args(nbargs):
+    " argument sets from command line `name=value1,value2,...` arguments, every combination "
+    return grid(dict((name, values.split(',')) for name, values in (pair.split('=', 1) for pair in nbargs)))
+
+def names_used(source):
+    " the names that python `source` refers to, or None if it can't be tokenized "
+    try:
+        return set(tok[1] for tok in tokenize.generate_tokens(StringIO(source).readline)
+                   if tok[0] == tokenize.NAME)
+    except (tokenize.TokenError, SyntaxError):
+        return None
+
+def setup_end(cells, input_index, inputs):
+    """ index of the first cell after the input cell that may depend on `inputs` (names): the cells
+        in between are the setup that runs once per kernel
+    """
+    for idx in range(input_index + 1, len(cells)):
+        cell = cells[idx]
+        if cell['cell_type'] == 'code':
+            names = names_used("".join(cell['input']))
+            if names is None or names & inputs:
+                return idx
+    return len(cells)
+
+class Sweep(object):
+    " runs of NotebookApp `nba` over a list of argument sets, on a pool of warm kernels "
+
+    def __init__(self, nba, argsets, workers=None, outdir=None, format=FORMAT, template=TEMPLATE):
+        self.nba      = nba
+        self.argsets  = argsets
+        self.workers  = workers or multiprocessing.cpu_count()
+        self.outdir   = outdir or "{name}-sweep".format(name=nba.name)
+        self.format   = format.lower()
+        self.template = template
+        self.exporter = get_exporter(self.format, template)
+        self.setups   = {}   # kernel -> its executed setup cells
+        self.broken   = None # the SweepSetupError that stops the sweep
+
+        cells       = nba.json['worksheets'][0]['cells']
+        self.first  = nba.input_index
+        self.split  = setup_end(cells, self.first, set(nba.inputs))
+        log.debug('sweep setup cells: %s to %s' % (self.first + 1, self.split))
+
+    def _notebook(self, nba, cells):
+        " notebook JSON of `nba` with just `cells`, without their saved outputs "
+        nbjson = nb_view(nba.json)
+        nbjson['worksheets'][0]['cells'] = [strip_outputs(cell) for cell in cells]
+        return nbjson
+
+    def _execute(self, kernel, nba, cells, **options):
+        " run `nba` with just `cells` in `kernel`, return (the executed notebook, err, whether it failed) "
+        nbjson = self._notebook(nba, cells)
+        (reply, err) = kernel.execute(nbjson, nba.nbdir, nba.timeout, **options)
+        err = ANSI_ESCAPE.sub('', err)
+        err2exception(err)
+        return apply_reply(nbjson, reply), err, failed(reply)
+
+    def _setup(self, kernel, nba):
+        " run the setup cells in `kernel`, once "
+        if kernel not in self.setups:
+            cells = nba.json['worksheets'][0]['cells'][self.first + 1:self.split]
+            nb, err, broken = self._execute(kernel, nba, cells, after=SNAPSHOT_CELL)
+            if broken:
+                raise SweepSetupError('Notebook App setup cells failed:\n%s' % err)
+            self.setups[kernel] = nb.worksheets[0].cells
+        return self.setups[kernel]
+
+    def _run(self, pool, n, nbargs):
+        " execute and export argument set number `n`, return its summary "
+        if self.broken is not None:
+            raise self.broken
+        nba = copy.copy(self.nba)
+        nba.json = nb_view(self.nba.json)
+        summary = dict(run=n, args=nbargs, output=None, status='done', error=None)
+        started = time.time()
+        try:
+            nba.set_nbargs(**nbargs)
+            nba.set_meta()
+            cells = nba.json['worksheets'][0]['cells']
+            with pool.checkout() as kernel:
+                setup = self._setup(kernel, nba)
+                nb, err, broken = self._execute(kernel, nba, cells[:self.first + 1] + cells[self.split:],
+                                                reset=False, before=RESTORE_CELL)
+            ran = nb.worksheets[0].cells
+            if not broken: # otherwise the result is an error report, not the notebook
+                nb.worksheets[0].cells = ran[:self.first + 1] + setup + ran[self.first + 1:]
+            else:
+                summary.update(status='failed', error=err or 'Notebook App failed to run')
+
+            result, _ = self.exporter.from_notebook_node(nb, resources=dict(nbapp=nba.name))
+            summary['output'] = "%04d.%s" % (n, EXTENSIONS[self.format])
+            with io.open(os.path.join(self.outdir, summary['output']), 'w', encoding='utf-8') as f:
+                f.write(result)
+        except SweepSetupError as ex:
+            self.broken = ex # no point in going on
+            raise
+        except Exception as ex:
+            log.info('sweep run %s of notebook app [%s] failed: %s' % (n, nba.name, ex))
+            summary.update(status='failed', error='%s: %s' % (type(ex).__name__, ex))
+        summary['seconds'] = time.time() - started
+        return summary
+
+    def run(self):
+        " run all argument sets, write the results and index.json, return the index "
+        if not os.path.isdir(self.outdir):
+            os.makedirs(self.outdir)
+
+        started  = time.time()
+        env_dict = self.nba.resolve_env()
+        workers  = min(self.workers, len(self.argsets)) or 1
+        pool     = KernelPool(env_dict, size=workers, recycle=len(self.argsets) + 1, # no recycling mid-sweep
+                              args=self.nba.fork_args(env_dict))
+        threads  = ThreadPool(workers)
+        try:
+            runs = threads.map(lambda args: self._run(pool, *args), enumerate(self.argsets))
+        finally:
+            threads.terminate()
+            pool.close()
+
+        index = dict(app=self.nba.name, notebook=self.nba.nbpath, nbhash=self.nba.nbhash,
+                     format=self.format, workers=workers, setup_cells=self.split - self.first - 1,
+                     started=started, seconds=time.time() - started, runs=runs)
+        with open(os.path.join(self.outdir, 'index.json'), 'w') as f:
+            json.dump(index, f, indent=1)
+        return index
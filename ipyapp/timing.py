@@ -0,0 +1,101 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Where the time of a notebook app run goes, phase by phase.
+
+    A NotebookApp carries a Timeline.  The parent records its phases (finding and parsing the
+    notebook, preparing the env, launching, reading the reply, rendering), the child records kernel
+    boot and cell execution and sends them back with its reply (see ipyapp.transport).  Phases have
+    wall clock start times, so those of parent and child line up, and optional arguments, e.g. the
+    index of a cell.
+
+    `conda launch --profile` prints a Timeline as a table, `--trace FILE` writes it in the Chrome
+    trace event format (load it in chrome://tracing or Perfetto).
+"""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+class Timeline(object):
+    " named phases, each with a start time and a duration in seconds "
+
+    def __init__(self):
+        self.phases = [] # [name, start, seconds, args], in the order they ended
+        self.lock   = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, **args):
+        " record the time spent in the `with` block as phase `name` "
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time() - start, **args)
+
+    def add(self, name, start, seconds, **args):
+        with self.lock:
+            self.phases.append([name, start, seconds, args])
+
+    def extend(self, phases, **args):
+        " add phases exported by another Timeline (e.g. the child's), with extra `args` "
+        for phase in phases or ():
+            name, start, seconds = phase[:3]
+            self.add(name, start, seconds, **dict(phase[3] if len(phase) > 3 else {}, **args))
+
+    def start(self, name):
+        " start time of the first phase `name`, or None "
+        for phase, start, seconds, args in self.phases:
+            if phase == name:
+                return start
+        return None
+
+    def seconds(self):
+        " total seconds per phase name "
+        totals = {}
+        for name, start, seconds, args in self.phases:
+            totals[name] = totals.get(name, 0) + seconds
+        return totals
+
+    def export(self):
+        " the phases as JSON-able lists "
+        with self.lock:
+            return [list(phase) for phase in self.phases]
+
+    def ordered(self):
+        " the phases by start time "
+        with self.lock:
+            return sorted(self.phases, key=lambda phase: phase[1])
+
+def label(name, args):
+    " how phase `name` is shown: cells by their number "
+    return "cell %s" % args['index'] if name == 'cell' and 'index' in args else name
+
+def print_table(timeline, total, out=None):
+    " write the phases of `timeline`, in the order they started, and the `total` seconds as a table "
+    out = out or sys.stderr
+    out.write("%-20s %10s %7s\n" % ("phase", "seconds", "%"))
+    for name, start, seconds, args in timeline.ordered():
+        indent = "  " if name == 'cell' else "" # cells are part of `execute`
+        out.write("%-20s %10.3f %6.1f%%\n" % (indent + label(name, args), seconds, 100.0 * seconds / (total or 1)))
+    out.write("%-20s %10.3f\n" % ("total", total))
+
+def write_trace(timeline, path):
+    """ write the phases of `timeline` to `path` as Chrome trace events: those of the parent process on
+        one track, those reported by the kernel's process (`process` argument) on another
+    """
+    tracks = dict(launcher=1, kernel=2)
+    events = [dict(name='thread_name', ph='M', pid=os.getpid(), tid=tid, args=dict(name=track))
+              for track, tid in tracks.items()]
+    for name, start, seconds, args in timeline.ordered():
+        events.append(dict(name=label(name, args), cat='ipyapp', ph='X', pid=os.getpid(),
+                           tid=tracks.get(args.get('process'), 1),
+                           ts=int(start * 1e6), dur=int(seconds * 1e6), args=args))
+    with open(path, 'w') as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
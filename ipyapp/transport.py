@@ -0,0 +1,148 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" How a notebook app gets to the process that runs it, and how the executed notebook comes back.
+
+    The parent writes the notebook JSON straight into a temporary file and passes its path, so the
+    notebook is never built up as one big string or pushed through a pipe.  The child parses it from
+    the file and writes its reply to a second temporary file.  The reply holds only the code cells,
+    the only ones running changes, with ANSI colour codes already removed from their outputs:
+
+        {"cells": [[<worksheet>, <index>, <cell>], ...]}   the notebook ran
+        {"notebook": <notebook>}                            a different notebook (an error report)
+        {"result": <values>}                                `output` values (see ipyapp.results)
+
+    with the child's timings in a "timeline" list (see ipyapp.timing).
+
+    The parent splices the cells into a copy-on-write view of the notebook it already holds, parsed,
+    so the cells that didn't run are never serialized or parsed again.  STDERR stays a separate
+    channel for errors.
+
+    What is sent is a `Payload`: the notebook without the outputs saved from its author's last run,
+    serialized once per version of the notebook file, with only the app meta data and the input cell
+    spliced in for each run.
+"""
+
+import json
+import os
+import re
+import tempfile
+
+from IPython.nbformat.current import NotebookNode, to_notebook_json
+
+from ipyapp.cache import nb_view
+
+ANSI_ESCAPE = re.compile(r'\x1b[^m]*m')
+SPLICE      = re.compile(r'"\\u0000(\w+)\\u0000"') # a splice point in Payload JSON, as serialized
+
+def temp_path(suffix):
+    " an empty temporary file for a payload "
+    fd, path = tempfile.mkstemp(prefix='ipyapp-', suffix=suffix)
+    os.close(fd)
+    return path
+
+def strip_outputs(cell):
+    " `cell` without the outputs of a previous run (a copy, if it has any) "
+    if not cell.get('outputs') and 'prompt_number' not in cell:
+        return cell
+    cell = dict(cell, outputs=[])
+    cell.pop('prompt_number', None)
+    return cell
+
+class Payload(object):
+    """ Notebook JSON as sent to the process that runs it, pre-serialized: stripped of outputs, with the
+        notebook metadata and the input cell (number `input_index`) left as splice points
+    """
+
+    def __init__(self, nbjson, input_index):
+        nb = nb_view(nbjson)
+        for ws in nb['worksheets']:
+            ws['cells'] = [strip_outputs(cell) for cell in ws['cells']]
+        nb['metadata'] = u'\0metadata\0'
+        if nb['worksheets'] and nb['worksheets'][0]['cells']:
+            nb['worksheets'][0]['cells'][input_index] = u'\0input\0'
+
+        parts = SPLICE.split(json.dumps(nb, separators=(',', ':')))
+        self.parts = [part.encode('utf-8') for part in parts[::2]] # text between the splice points
+        self.names = parts[1::2]                                   # splice point names, in order
+
+    def fill(self, **values):
+        " the notebook JSON, as bytes, with `values` spliced in by name "
+        data = [self.parts[0]]
+        for name, part in zip(self.names, self.parts[1:]):
+            data.append(json.dumps(values[name], separators=(',', ':')).encode('utf-8'))
+            data.append(part)
+        return b"".join(data)
+
+def write_notebook(nbjson):
+    " write notebook JSON, or an already serialized payload, to a new temporary file, return its path "
+    path = temp_path('.ipynb')
+    with open(path, 'wb') as f:
+        if isinstance(nbjson, bytes):
+            f.write(nbjson)
+        else:
+            f.write(json.dumps(nbjson, separators=(',', ':')).encode('utf-8'))
+    return path
+
+def read_notebook(path):
+    " the notebook in the file at `path`, as a NotebookNode "
+    with open(path) as f:
+        return to_notebook_json(json.load(f))
+
+def strip_ansi(cell):
+    " remove ANSI colour codes from the text outputs and tracebacks of `cell`, in place "
+    for out in cell.get('outputs', []):
+        if 'text' in out:
+            out['text'] = ANSI_ESCAPE.sub('', out['text'])
+        if 'traceback' in out:
+            out['traceback'] = [ANSI_ESCAPE.sub('', line) for line in out['traceback']]
+    return cell
+
+def write_reply(path, result, nb, timeline=None):
+    """ write the reply for notebook `nb` to `path`, given the `result` of running it (see `run`), with
+        the phases of `timeline` (a `ipyapp.timing.Timeline`) if given
+    """
+    if result is nb: # ran in place
+        reply = dict(cells=[[ws_index, index, strip_ansi(cell)]
+                            for ws_index, ws in enumerate(nb.worksheets)
+                            for index, cell in enumerate(ws.cells) if cell.cell_type == 'code'])
+    elif isinstance(result, NotebookNode):
+        reply = dict(notebook=result)
+    else:
+        reply = dict(result=result)
+    if timeline is not None:
+        reply['timeline'] = timeline.export()
+    with open(path, 'w') as f:
+        json.dump(reply, f, separators=(',', ':'))
+
+def read_reply(path):
+    with open(path) as f:
+        return json.load(f)
+
+def failed(reply):
+    " did the run fail? then the `reply` carries an error report notebook, not cells or values "
+    return 'notebook' in reply
+
+def apply_reply(nbjson, reply):
+    """ the executed notebook (a NotebookNode) from the notebook JSON that was sent and the `reply`,
+        or the values if the reply has `output` values
+    """
+    if 'result' in reply:
+        return reply['result']
+    if 'notebook' in reply:
+        return to_notebook_json(reply['notebook'])
+
+    nb = nb_view(nbjson)
+    for ws_index, index, cell in reply['cells']:
+        nb['worksheets'][ws_index]['cells'][index] = cell
+    return to_notebook_json(nb)
+
+def remove(*paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass # never created, or already gone
@@ -0,0 +1,313 @@
+# (c) 2012-2014 Continuum Analytics, Inc. / http://continuum.io
+# All Rights Reserved
+#
+# conda is distributed under the terms of the BSD 3-clause license.
+# Consult LICENSE.txt or http://opensource.org/licenses/BSD-3-Clause.
+
+""" Kernels forked from a per-env zygote process that has already imported the app's libraries.
+
+    A zygote is a long running `conda launch --zygote SOCKET` process in an app's conda env.  It
+    imports the IPython kernel and the modules to preload (the app's `preload` meta data, or else its
+    `pkgs`) once, then listens on a Unix socket.  For each request it forks, and the child becomes the
+    kernel, so starting a kernel costs a `fork()` rather than an interpreter start and the imports.
+
+    Requests and replies are single JSON lines:
+
+        {}                                                      -> {"ready": true}
+        {"argv": [...], "cwd": ..., "preload": [...], "owner": pid}  -> {"pid": <kernel pid>}
+
+    A forked kernel exits when its owner (the process running the notebook) is gone.  The zygote
+    exits once it has no kernels left and has been idle for ZYGOTE_IDLE seconds.  Zygotes are shared
+    by every `conda launch` and app server on the machine, found by their socket path in ZYGOTE_DIR.
+    The app server starts them (ZYGOTE); a one-off `conda launch` only uses one that is running, and
+    starts one only with ZYGOTE_CLI, as it would be left running after the launch.
+"""
+
+import errno
+import hashlib
+import importlib
+import json
+import logging
+import os
+import random
+import re
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+
+from ipyapp.config  import ZYGOTE_CLI, ZYGOTE_DIR, ZYGOTE_IDLE, POOL_WAIT, LOG_LEVEL
+from ipyapp.execute import spawn_launcher
+
+logging.basicConfig(level=LOG_LEVEL)
+log = logging.getLogger(__name__)
+
+def preload_modules(pkgs):
+    " module names for conda package specs, e.g. 'scikit-image >=0.10' -> 'scikit_image' "
+    return [re.split(r'[\s=<>!]', spec, 1)[0].replace('-', '_') for spec in pkgs if spec.strip()]
+
+def request(path, message, timeout=POOL_WAIT):
+    " send `message` to the zygote listening on `path`, return its reply "
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+        sock.sendall((json.dumps(message) + "\n").encode('utf-8'))
+        return json.loads(sock.makefile('rb').readline())
+    finally:
+        sock.close()
+
+def ping(path):
+    " is a zygote listening on `path`? "
+    try:
+        return request(path, {}, timeout=1).get('ready', False)
+    except (socket.error, ValueError):
+        return False
+
+class Zygotes(object):
+    " Zygote processes, one per conda env, started on first use "
+
+    def __init__(self, directory=ZYGOTE_DIR, start=ZYGOTE_CLI):
+        self.directory = directory
+        self.start     = start # start zygotes that aren't running (the app server does, see ipyapp.server)
+        self.procs     = {} # socket path -> zygote process we started
+        self.lock      = threading.Lock()
+
+    def path(self, env_dict):
+        " socket path of the zygote for the conda env selected by `env_dict` "
+        key = json.dumps(env_dict, sort_keys=True).encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest()[:16] + ".sock")
+
+    def get(self, env_dict, preload=()):
+        " socket path of a running zygote for `env_dict`, or None if one could not be started "
+        path = self.path(env_dict)
+        with self.lock:
+            if ping(path):
+                return path
+            if not self.start:
+                return None
+
+            proc = self.procs.pop(path, None)
+            if proc is not None:
+                proc.poll() # reap the one that went away
+
+            log.info('starting kernel zygote %s, preloading: %s' % (path, ", ".join(preload)))
+            try:
+                if not os.path.isdir(self.directory):
+                    os.makedirs(self.directory)
+                proc = spawn_launcher(['launch', '--zygote', path, '--preload', ",".join(preload)],
+                                      env_dict, stderr=None)
+                readable, _, _ = select.select([proc.stdout], [], [], POOL_WAIT)
+                if not readable or not proc.stdout.readline():
+                    raise OSError('kernel zygote did not start within %s seconds' % POOL_WAIT)
+            except OSError as ex:
+                log.warn('kernel zygote not available, starting kernels the slow way: %s' % ex)
+                return None
+            self.procs[path] = proc
+            return path
+
+zygotes = Zygotes()
+
+class ForkedKernel(object):
+    " Stands in for the `Popen` of a kernel forked by a zygote, which is not our child "
+
+    def __init__(self, pid):
+        self.pid        = pid
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except OSError:
+                self.returncode = 0
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(0.05)
+        return self.returncode
+
+    def send_signal(self, signum):
+        os.kill(self.pid, signum)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+def fork_kernel(path, argv, cwd, preload=()):
+    " ask the zygote on `path` for a kernel started with `argv` in `cwd`, return its ForkedKernel "
+    reply = request(path, dict(argv=argv, cwd=cwd, preload=list(preload), owner=os.getpid()))
+    if 'pid' not in reply:
+        raise ValueError(reply.get('error', 'no kernel'))
+    return ForkedKernel(reply['pid'])
+
+def runner_class():
+    " runipy's NotebookRunner with a kernel forked from a zygote (imported late: it needs IPython) "
+    from IPython.kernel           import KernelManager
+    from IPython.utils.traitlets  import Unicode, List
+    from runipy.notebook_runner   import NotebookRunner
+
+    class ZygoteKernelManager(KernelManager):
+        zygote  = Unicode()
+        preload = List()
+
+        def _launch_kernel(self, kernel_cmd, **kw):
+            if kw.get('ipython_kernel', True) and kernel_cmd[1:2] == ['-c']:
+                try:
+                    return fork_kernel(self.zygote, kernel_cmd[3:], kw.get('cwd') or os.getcwd(), self.preload)
+                except (socket.error, ValueError) as ex:
+                    log.warn('could not fork a kernel from zygote %s, starting one: %s' % (self.zygote, ex))
+            return super(ZygoteKernelManager, self)._launch_kernel(kernel_cmd, **kw)
+
+    class ZygoteNotebookRunner(NotebookRunner):
+        def __init__(self, nb, zygote, preload=(), working_dir=None):
+            # as NotebookRunner.__init__, with a different kernel manager
+            self.km = ZygoteKernelManager(zygote=zygote, preload=list(preload))
+            self.km.start_kernel(cwd=working_dir)
+
+            self.kc = self.km.client()
+            self.kc.start_channels()
+            try: # the first cell's messages are lost if it runs before the kernel is listening
+                self.kc.wait_for_ready()
+            except AttributeError: # IPython < 3
+                self._wait_for_ready_backport()
+
+            self.shell = self.kc.shell_channel
+            self.iopub = self.kc.iopub_channel
+
+            self.nb = nb
+
+    return ZygoteNotebookRunner
+
+def zygote_runner(zygote, preload=(), working_dir=None):
+    " a NotebookRunner, without a notebook yet, whose kernel is forked from the zygote on `zygote` "
+    return runner_class()(None, zygote, preload, working_dir)
+
+_failed = set() # modules that could not be preloaded
+
+def import_modules(modules):
+    " import `modules` that are not imported yet, skipping any that fail "
+    for name in modules:
+        if name and name not in sys.modules and name not in _failed:
+            try:
+                importlib.import_module(name)
+            except Exception as ex:
+                log.warn('kernel zygote could not preload %s: %s' % (name, ex))
+                _failed.add(name)
+
+def watch_owner(pid):
+    " exit when process `pid` is gone, like IPython's ParentPollerUnix does for a kernel's parent "
+    def poll():
+        while True:
+            try:
+                os.kill(pid, 0)
+            except OSError:
+                os._exit(1)
+            time.sleep(1)
+    thread = threading.Thread(target=poll, name='owner-watch')
+    thread.daemon = True
+    thread.start()
+
+def serve_zygote(path, modules=(), idle=ZYGOTE_IDLE):
+    " zygote side: `conda launch --zygote SOCKET` "
+    try:
+        os.setsid() # outlive the `conda launch` that started us, and its terminal
+    except OSError:
+        pass # already a session leader
+
+    from IPython.kernel.zmq.kernelapp import IPKernelApp
+    import_modules(modules)
+
+    def ready():
+        sys.stdout.write(json.dumps(dict(ready=True)) + "\n")
+        sys.stdout.flush()
+
+    if ping(path): # another `conda launch` started one meanwhile
+        ready()
+        return 0
+    if os.path.exists(path):
+        os.unlink(path) # left behind by a zygote that died
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    sock.listen(16)
+    ready()
+
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    os.dup2(devnull, 1) # nobody reads our stdout any more
+
+    children = set()
+    def reap(signum, frame):
+        try:
+            while True:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                children.discard(pid)
+        except OSError:
+            pass # no children
+    signal.signal(signal.SIGCHLD, reap)
+    signal.siginterrupt(signal.SIGCHLD, False)
+
+    sock.settimeout(idle)
+    try:
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except socket.timeout:
+                if children:
+                    continue
+                log.info('kernel zygote %s idle, exiting' % path)
+                return 0
+            except socket.error as ex:
+                if ex.errno == errno.EINTR: # a kernel exited
+                    continue
+                raise
+
+            try:
+                conn.settimeout(POOL_WAIT)
+                message = json.loads(conn.makefile('rb').readline())
+                if 'argv' not in message:
+                    reply = dict(ready=True)
+                else:
+                    import_modules(message.get('preload', ()))
+                    pid = os.fork()
+                    if pid == 0: # the kernel
+                        sock.close()
+                        conn.close()
+                        start_kernel(IPKernelApp, message)
+                    children.add(pid)
+                    reply = dict(pid=pid)
+                conn.sendall((json.dumps(reply) + "\n").encode('utf-8'))
+            except Exception as ex:
+                log.warn('kernel zygote request failed: %s' % ex)
+            finally:
+                conn.close()
+    finally:
+        if os.path.exists(path):
+            os.unlink(path)
+
+def start_kernel(IPKernelApp, message):
+    " in a freshly forked child: run a kernel as asked by `message`, never return "
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        random.seed() # don't hand every kernel the zygote's random state
+        if 'numpy' in sys.modules:
+            sys.modules['numpy'].random.seed()
+        if message.get('owner'):
+            watch_owner(message['owner'])
+        os.chdir(message['cwd'])
+
+        app = IPKernelApp.instance()
+        app.initialize(message['argv'])
+        app.start()
+    except Exception as ex:
+        log.warn('forked kernel failed: %s' % ex)
+        os._exit(1)
+    finally:
+        os._exit(0)